@@ -1,68 +1,56 @@
-import re
-from tempfile import mkdtemp
-
-import cv2
-import requests
-from bs4 import BeautifulSoup
-from flask import Flask, redirect, render_template, request, session
-from flask_session import Session
-from random_word import RandomWords
-from sqlalchemy import (Column, ForeignKey, Integer, MetaData, String, Table,
-                        and_, create_engine, insert, select)
-from werkzeug.security import check_password_hash, generate_password_hash
-
-from app_model import grab_title_id, insert_title, update_tables
-from buttress import (check_extension, extract_strings, html_to_string,
-                      image_preprocessing, login_required, parse_image,
-                      remove_files, report_error)
+import logging
+import os
+import shutil
+import tempfile
+
+from flask import (Flask, Response, jsonify, make_response, redirect,
+                   render_template, request, session, url_for)
+from markupsafe import Markup
+from sqlalchemy import and_, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import cache
+import metrics
+import sessions
+from app_model import (find_titles_by_url, insert_title, load_recipe,
+                       owns_title, recipebook_page, update_tables)
+from auth import (MAX_PASSWORD_LENGTH, TRUSTED_PROXIES, AuthBusy,
+                  hash_password, limit_attempt, needs_rehash, verify_password)
+from bulk_import import MAX_URLS, clean_urls, import_urls
+from buttress import (check_extension, login_required, recipe_etag,
+                      report_error)
+from db import get_db, init_app, recipe_books, users
+from fetch import FetchError, fetch
+from jobs import get_job, submit_import, submit_job
+from scrapers import scrape
+from shopping import MAX_RECIPES, build_shopping_list
+from tags import clean_tags, tag_titles, untag_titles
+from transfer import TransferError, export_stream, import_records, is_admin
 
 # Initate and configure flask app
 app = Flask(__name__)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-Session(app)
-
-# Initiate metadata object so we can create Table objects to manipulate our data
-metadata = MetaData()
-
-# Create the table objects (corresponding to recipe.db)
-ingredients = Table("ingredients", metadata,
-                    Column("title_id", Integer(), ForeignKey("titles.id")),
-                    Column("ingredient", String(), nullable=False)
-                    )
-
-instructions = Table("instructions", metadata,
-                     Column("title_id", Integer(), ForeignKey("titles.id")),
-                     #Column("instruction_title", String()),
-                     Column("instruction", String(), nullable=False)
-                     )
-
-recipe_books = Table("recipe_books", metadata,
-                     Column("title_id", Integer(), ForeignKey("titles.id")),
-                     Column("user_id", Integer(), ForeignKey("users.id"))
-                     )
-
-titles = Table("titles", metadata,
-               Column("id", Integer(), primary_key=True),
-               Column("title", String(), nullable=False),
-               Column("url", String())
-               )
-
-users = Table("users", metadata,
-              Column("id", Integer(), primary_key=True),
-              Column("username", String(), nullable=False, unique=True),
-              Column("passhash", String(), nullable=False),
-              )
-
-# Initiate SQLAlchemy Engine
-engine = create_engine("sqlite:///recipe.db?check_same_thread=False", echo=True, future=True)
-
-# Create a connection object so we can execute commands/queries on the database.
-connection = engine.connect()
-
-# Create tables (if not created)
-metadata.create_all(engine)
+
+# Behind a proxy, take the client's address (which logins are rate limited by, see auth.py)
+# and scheme from the headers it adds, instead of seeing every request come from the proxy
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+# Cap the size of uploads, so a queued OCR job can't hold an arbitrarily large image in memory
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024
+
+# Keep logins in signed cookies, or a shared store (see sessions.py)
+sessions.init_app(app)
+
+# Log to stderr, at RECIPE_LOG_LEVEL (slow queries are logged as warnings, see metrics.py)
+logging.basicConfig(level=os.environ.get("RECIPE_LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+# Give each request its own database connection from the pool (see db.py)
+init_app(app)
+
+# Time every request, and serve the timings at /metrics (see metrics.py)
+metrics.init_app(app)
 
 @app.route("/", methods=["GET", "POST"])
 @login_required
@@ -94,48 +82,44 @@ def index():
             if not url.startswith("http"):
                 return report_error("not a url")
 
-            # Fetch contents of url
-            load = requests.get(url)
-
-            # Create an object containing the html Document Object Model (DOM) from the url entered above
-            soup = BeautifulSoup(load.text, "lxml")
+            # Attempt to fetch the url, provided by the user, from the database
+            title_id = find_titles_by_url([url]).get(url)
 
-            # Grab the recipe title from the DOM
-            recipe_title = soup.select("h1.c-recipe-details-header__title")[0].string.strip()
+            # If the url isn't in the database, scrape the page and update titles table, ingredients table
+            # and instructions table. This condition ensures that we don't duplicate recipes in the database.
+            if title_id is None:
 
-            # Grab the ingredients list from the DOM
-            # html_to_string converts the list elements to bare strings (see buttress.py)
-            ingredients_data = html_to_string(soup.select("ol > li"))
+                # Fetch contents of url (see fetch.py)
+                try:
+                    html = fetch(url)
+                except FetchError as e:
+                    return report_error(str(e))
 
-            # Grab the instruction_titles from the DOM
-            #instructions_title = html_to_string(soup.select("div.c-recipe-step__title.c-heading.c-heading--brand-7"))
+                # Grab the recipe title, ingredients and instructions from the html (see scrapers.py)
+                recipe = scrape(html, url)
+                if recipe is None:
+                    return report_error("Unable to locate the required ingredients at the given url")
+                recipe_title, ingredients_data, instructions_body = recipe
 
-            # Grab the actual instructions from the DOM
-            instructions_body = html_to_string(soup.select("div.col-12 > p"))
+                try:
+                    title_id, status = update_tables(recipe_title, instructions_body, ingredients_data, url)
 
-            # Check to make sure the last 3 'grabs' returned some value
-            if not recipe_title or not ingredients_data or not instructions_body:
-                return report_error("Unable to locate the required ingredients at the given url")
+                    # The same recipe may already be in their library, from another url
+                    if status == "owned":
+                        return report_error("you already have that recipe in your library")
+                    return redirect("/recipebook")
 
-            # Attempt to fetch the url, provided by the user, from the database
-            stmt = select(titles.c.url).where(titles.c.url == url)
-            urls = connection.execute(stmt).fetchall()
+                # Someone else imported the same url in the meantime
+                except IntegrityError:
+                    title_id = find_titles_by_url([url]).get(url)
 
-            # If the url isn't in the database, update titles table, ingredients table and instructions table,
-            # This condition ensures that we don't duplicate recipes in the database.
-            if not len(urls):
-                update_tables(recipe_title, instructions_body, ingredients_data, url)
-                return redirect("/recipebook")
             # If the url IS in the database, check to see if it's in the user's library
-            # i.e., a place in the db where the recipe title is associated with the user 
-            
-            # To do this, we first grab the title_id
-            title_id = grab_title_id(recipe_title)
+            # i.e., a place in the db where the recipe title is associated with the user
 
-            # Then, with the title_id, we attempt to select the recipe title from this user's library
+            # With the title_id, we attempt to select the recipe title from this user's library
             recipe_check = select(recipe_books).where(and_(recipe_books.c.title_id == title_id,
                                                         recipe_books.c.user_id == session["user_id"]))
-            recipe_check = connection.execute(recipe_check).fetchall()
+            recipe_check = get_db().execute(recipe_check).fetchall()
 
             # If the recipe isn't in their library, we add it
             if not recipe_check:
@@ -159,121 +143,337 @@ def index():
             # Check for valid extension (.jpg or .png)
             check_extension(ext)
 
-            # Save the image to filesystem
-            img = image.save(f"tmpimage.{ext}")
+            # Read the upload into memory. The worker decodes it straight from these bytes,
+            # so nothing is written to the filesystem
+            data = image.read()
+            if not data:
+                return report_error("no image sent.")
 
-            # Read the file into memory so we can manipulate the image with code
-            filename = f"tmpimage.{ext}"
-            img = cv2.imread(filename)
+            # Hand the image to the OCR worker pool. Tesseract takes seconds per image, so
+            # rather than hold this worker for the duration we send the user to a status page
+            job_id = submit_job(data, session["user_id"])
+            if job_id is None:
+                return report_error("We're busy reading other recipes right now. Try again in a minute."), 503
 
-            # Prepare the image for OCR text recognition
-            processed_image = image_preprocessing(img)
+            return redirect(f"/jobs/{job_id}")
 
-            # Create a list of image arrays, each containing a separate chunk of text
-            # from the original image
-            image_arrays = parse_image(processed_image)
+        # If we've made it this far then the user hit the upload button without
+        # attaching an image.
+        return report_error("no image sent.")
 
-            # Produce a list of strings containing
-            # the OCRed text from each
-            recipe_strings = extract_strings(image_arrays)
-            print(recipe_strings)
-            print()
 
-            # Remove the jpeg files generated by image.save and parse_image
-            #remove_files()
+@app.route("/import", methods=["GET", "POST"])
+@login_required
+def bulk_import():
+    """
+    The user can paste in a whole list of recipe urls (one per line) to add them all to
+    their 'Book o' Recipes' at once. Scripts can POST a JSON body of the form
+    {"urls": [...]} instead, and poll the job it starts for the per-url results as JSON
+    """
 
-            # Check to make sure the "extract_strings" function returns something
-            if not len(recipe_strings):
-                return report_error("Highly uncertain about that image. Resubmit material, glareless and straight.")
+    # If user arrives via GET, show them the form
+    if request.method == "GET":
+        return render_template("import.html")
+
+    # Gather the urls from the JSON body or the form
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        urls = payload.get("urls")
+        if not isinstance(urls, list):
+            return jsonify(error="expected a JSON body of the form {\"urls\": [...]}"), 400
+    else:
+        urls = (request.form.get("urls") or "").splitlines()
+
+    urls = clean_urls(urls)
+    if not urls:
+        if request.is_json:
+            return jsonify(error="no urls sent"), 400
+        return report_error("no urls sent.")
+    if len(urls) > MAX_URLS:
+        if request.is_json:
+            return jsonify(error=f"at most {MAX_URLS} urls per import"), 413
+        return report_error(f"at most {MAX_URLS} urls per import")
+
+    # Import them (see bulk_import.py) in the background, since a thousand urls take minutes.
+    # The user (or script) polls the job for how each url fared
+    job_id = submit_import(session["user_id"], "urls", import_urls, urls, session["user_id"])
+    if job_id is None:
+        if request.is_json:
+            return jsonify(error="too many imports are running, try again in a minute"), 503
+        return report_error("We're busy importing other recipes right now. Try again in a minute."), 503
+
+    if request.is_json:
+        return jsonify(job_id=job_id, status="queued", poll=f"/jobs/{job_id}?format=json"), 202
+    return redirect(f"/jobs/{job_id}")
+
+
+@app.route("/import/file", methods=["POST"])
+@login_required
+def import_file():
+    """
+    The user can upload an export (see transfer.py) to add all of its recipes to their
+    'Book o' Recipes', tags and all
+    """
 
-            # Split ingredients and instruction into smaller units, so we can more
-            # easily manipulate the data on the front-end
-            for recipe_str in recipe_strings:
-                if "prepare" in recipe_str.lower() or "preheat" in recipe_str.lower() or "assemble" in recipe_str.lower():
-                    list_of_instructions = re.split(r"\n\n", recipe_str)
-                    print(1)
-                    print(list_of_instructions)
-                elif "ingredients" in recipe_str.lower() and "cup" in recipe_str.lower():
-                    ingredients_list = re.split(r"\n", recipe_str)
-                    print(2)
-                    print(ingredients_list)
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        return report_error("no file sent.")
 
-            # TEMPORARY -- assign a random word to be our recipe title until we figure out how to get the actual title
-            # and a list of random words for ingredients
-            r = RandomWords()
-            random_title = r.get_random_word()
-            #random_ingredients = r. get_random_words(minCorpusCount=10, maxCorpusCount=12)
+    # The import runs in the background (see jobs.py), after this request is over, so the
+    # upload is copied aside first
+    spool = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload.stream, spool)
+    spool.seek(0)
+    user_id = session["user_id"]
 
-            # Update tables with recipe data gleaned via OCR
-            update_tables(random_title, list_of_instructions, ingredients_list, None)
+    def run_import():
+        with spool:
+            return import_records(spool, user_id)
 
-            # Fetch the autogenerated title_id so we can add it to the user's 'library'
-            # i.e. a place in the database where the title is associated with the user
-            title_id = grab_title_id(random_title)
+    job_id = submit_import(user_id, "file", run_import, errors=(TransferError,))
+    if job_id is None:
+        spool.close()
+        return report_error("We're busy importing other recipes right now. Try again in a minute."), 503
 
-            # Insert the title into their 'library'
-            insert_title(title_id)
+    return redirect(f"/jobs/{job_id}")
 
-            # Send user to their 'book o recipes' (the front end of their 'library')
-            return redirect("/recipebook")
 
-        # If we've made it this far then the user hit the upload button without
-        # attaching an image.
-        return report_error("no image sent.")
+def export_response(user_id, filename):
+    """
+    Streams an export (see transfer.py) to the user as a download
+    """
+
+    return Response(export_stream(user_id), mimetype="application/gzip",
+                    headers={"Content-Disposition": f"attachment; filename=\"{filename}\""})
+
+
+@app.route("/export")
+@login_required
+def export_library():
+    """
+    The user can download their whole library, to keep or to import elsewhere
+    """
+
+    return export_response(session["user_id"], "recipes.ndjson.gz")
+
+
+@app.route("/export/all")
+@login_required
+def export_all():
+    """
+    Admins (see RECIPE_ADMIN_USERS in transfer.py) can download every recipe in the database
+    """
+
+    if not is_admin(session["user_id"]):
+        return report_error("only admins can export every recipe"), 403
+
+    return export_response(None, "all-recipes.ndjson.gz")
+
+
+@app.route("/jobs/<job_id>")
+@login_required
+def job_status(job_id):
+    """
+    Status page for an uploaded image, or a bulk import. While the job is running, the
+    page refreshes itself. An uploaded image's recipe is added to the user's library as
+    soon as the job is done (see jobs.py), and then they're sent to their 'Book o' Recipes'.
+    An import shows how each of its recipes fared
+    """
+
+    job = get_job(job_id, session["user_id"])
+    if job is None:
+        return report_error("we couldn't find that job"), 404
+
+    # Scripts can poll with ?format=json instead of loading the status page
+    wants_json = request.args.get("format") == "json"
+
+    # Still waiting on tesseract, or on the import
+    if job["status"] in ("queued", "running"):
+        if wants_json:
+            return jsonify(status=job["status"])
+        return render_template("job.html", status=job["status"], kind=job["kind"])
+
+    # The job says why it failed, e.g. an unreadable image or no ingredients found on it
+    if job["status"] == "failed":
+        if wants_json:
+            return jsonify(status="failed", error=job["error"])
+        return report_error(job["error"])
+
+    # How each url of an import fared
+    if job["kind"] == "urls":
+        if wants_json:
+            return jsonify(status="done", results=job["result"])
+        return render_template("import.html", results=job["result"])
+
+    # How an imported export fared
+    if job["kind"] == "file":
+        if wants_json:
+            return jsonify(status="done", summary=job["result"])
+        return render_template("import.html", summary=job["result"])
+
+    # The recipe read from the image may have been in the user's library already
+    recipe = (job["result"] or {}).get("status", "imported")
+    if wants_json:
+        return jsonify(status="done", recipe=recipe, redirect="/recipebook")
+    if recipe == "owned":
+        return report_error("you already have that recipe in your library")
+
+    # Send user to their 'book o recipes' (the front end of their 'library')
+    return redirect("/recipebook")
 
 
 @app.route("/recipebook", methods=["GET", "POST"])
 @login_required
 def recipebook():
     """
-    Recipe book provides the user with a select menu containing all their recipes.
-    When they select one and press the "let's cook!" button,
-    a screen appears displaying the desired recipe.
+    Recipe book provides the user with a searchable, paginated list of their recipes.
+    When they select one, they're sent to a screen displaying the desired recipe.
     """
 
     # If user arrives via GET (that is, if they've clicked on "Book o' Recipes")
-    # display a select menu with all their recipes
+    # display a page of their recipes, optionally narrowed down by a search
     if request.method == "GET":
 
-        # Fetch the user's recipe titles to populate the select menu
-        stmt = select(titles.c.title).where(titles.c.id.in_(select(recipe_books.c.title_id).where(
-                                                                   recipe_books.c.user_id == session["user_id"]))).order_by(titles.c.title)
-        recipe_titles = connection.execute(stmt).fetchall()
+        query = request.args.get("q", "").strip()
+        cursor = request.args.get("after")
 
-        # Capture the number of titles returned by the above query.
-        # We can use this to set a max size of the select menu
-        # before it overflows and becomes scrollable.
-        titles_list_length = len(recipe_titles)
+        # Optionally narrow the book down to recipes with any (or all) of some tags
+        selected = clean_tags(request.args.getlist("tag"))
+        match = "all" if request.args.get("match") == "all" else "any"
 
-        return render_template("recipebook.html", recipe_titles=recipe_titles, titles_list_length=titles_list_length)
+        # Fetch one page of the user's recipe titles, with their tags (see app_model.py).
+        # Pages are cached until the user's library changes
+        page = recipebook_page(session["user_id"], query=query, cursor=cursor, tag_names=selected,
+                               match_all=match == "all")
+
+        return render_template("recipebook.html", recipe_titles=page["titles"], query=query,
+                               next_cursor=page["next_cursor"], first_page=not cursor,
+                               all_tags=page["all_tags"], selected_tags=selected,
+                               match=match, title_tags=page["title_tags"])
 
     # If user submits post request (i.e. if they select a recipe to open),
-    # return a page with the desired recipe
+    # send them to the page with the desired recipe
     if request.method == "POST":
 
-        # Retrieve the ingredients and instructions for the given recipe title
-        recipe_title = request.form.get("title")
-        stmt = select(ingredients.c.ingredient).where(ingredients.c.title_id.in_(select(titles.c.id).where(
-                                                                                 titles.c.title == recipe_title)))
-        recipe_ingredients = connection.execute(stmt).fetchall()
+        title_id = request.form.get("title", type=int)
+        if title_id is None:
+            return report_error("pick a recipe first")
+
+        return redirect(f"/recipe/{title_id}")
 
-        #stmt = select(instructions.c.instruction_title).where(instructions.c.title_id.in_(
-                                                              #select(titles.c.id).where(
-                                                                    #titles.c.title == recipe_title)))
-        #recipe_instruction_title = connection.execute(stmt).fetchall()
 
-        stmt = select(instructions.c.instruction).where(instructions.c.title_id.in_(select(titles.c.id).where(
-                                                                                    titles.c.title == recipe_title)))
-        recipe_instruction = connection.execute(stmt).fetchall()
+@app.route("/tags", methods=["POST"])
+@login_required
+def tag_recipes():
+    """
+    Puts tags on (or takes them off) a group of recipes from the user's book at once,
+    then sends the user back to the page they were on
+    """
 
-        stmt = select(titles.c.url).where(titles.c.title == recipe_title)
-        recipe_url = connection.execute(stmt).fetchone()
+    title_ids = request.form.getlist("title_id", type=int)
+    names = clean_tags(request.form.get("tags", ""))
+    if not title_ids:
+        return report_error("pick at least one recipe")
+    if not names:
+        return report_error("enter at least one tag")
 
-        # Pass the retrieved data into the recipe.html template and return that page. The user will now have a page
+    # All the changes happen in a single transaction (see tags.py)
+    if request.form.get("action") == "untag":
+        untag_titles(session["user_id"], title_ids, names)
+    else:
+        tag_titles(session["user_id"], title_ids, names)
+
+    return redirect(url_for("recipebook", q=request.form.get("q") or None,
+                            tag=request.form.getlist("tag"), match=request.form.get("match") or None))
+
+
+@app.route("/recipe/<int:title_id>")
+@login_required
+def recipe(title_id):
+    """
+    Shows a recipe from the user's 'Book o' Recipes'. The page carries an ETag, so a
+    browser that already has the current version gets a 304 instead of the whole page again
+    """
+
+    if not owns_title(title_id, session["user_id"]):
+        return report_error("that recipe isn't in your book"), 404
+
+    # The body of the page is the same for everyone who has the recipe, so it's rendered once
+    # and cached by title id (see cache.py), along with its ETag
+    def render_body():
+
+        # Retrieve the title, ingredients and instructions in one query (see app_model.py)
+        recipe_data = load_recipe(title_id, session["user_id"])
+        if recipe_data is None:
+            return None
+
+        # Pass the retrieved data into the recipe_body.html template. The user will now have a page
         # containing a clear readable recipe from their book o' recipes.
-        return render_template("recipe.html", recipe_title=recipe_title, recipe_ingredients=recipe_ingredients,
-                               instructions=recipe_instruction,
-                               recipe_url=recipe_url)
+        body = render_template("recipe_body.html", recipe_ingredients=recipe_data["ingredients"],
+                               recipe_title=recipe_data["title"], instructions=recipe_data["instructions"],
+                               recipe_url=recipe_data["url"])
+
+        # The ETag changes whenever anything shown on the page does
+        return {"title": recipe_data["title"], "body": body, "etag": recipe_etag(recipe_data)}
+
+    page = cache.get_or_set(f"title:{title_id}", "page", render_body)
+    if page is None:
+        return report_error("that recipe isn't in your book"), 404
+
+    etag = page["etag"]
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+
+    response = make_response(render_template("recipe.html", recipe_title=page["title"],
+                                             recipe_body=Markup(page["body"])))
+    response.set_etag(etag)
+
+    # Browsers may keep the page, but must check with us before showing it again
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@app.route("/shoppinglist", methods=["GET", "POST"])
+@login_required
+def shoppinglist():
+    """
+    The user picks a group of recipes from their book, and gets back a single shopping
+    list of their ingredients, without duplicates
+    """
+
+    # If user arrives via GET, show a page of their recipes to pick from
+    if request.method == "GET":
+
+        query = request.args.get("q", "").strip()
+        cursor = request.args.get("after")
+        page = recipebook_page(session["user_id"], query=query, cursor=cursor)
+
+        return render_template("shoppinglist.html", recipe_titles=page["titles"], query=query,
+                               next_cursor=page["next_cursor"], first_page=not cursor)
+
+    # If they've arrived via POST, they've picked their recipes
+    title_ids = request.form.getlist("title_id", type=int)
+    if not title_ids:
+        return report_error("pick at least one recipe")
+    if len(title_ids) > MAX_RECIPES:
+        return report_error(f"at most {MAX_RECIPES} recipes per shopping list")
+
+    # Merge the ingredients of the chosen recipes (see shopping.py)
+    shopping_list = build_shopping_list(title_ids, session["user_id"])
+
+    return render_template("shoppinglist.html", shopping_list=shopping_list)
+
+
+def too_many_attempts(wait):
+    """
+    Tells the user they've tried to log in or sign up too often, and when to try again
+    """
+
+    response = make_response(report_error("Too many attempts. Please wait a minute and try again."), 429)
+    response.headers["Retry-After"] = str(int(wait) + 1)
+    return response
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -302,18 +502,38 @@ def login():
             return report_error("please provide a username")
         if not password:
             return report_error("please provide a password")
+        if len(password) > MAX_PASSWORD_LENGTH:
+            return report_error("username and/or password does not exist")
+
+        # Turn away floods of attempts before doing any hashing (see auth.py)
+        wait = limit_attempt(request.remote_addr, username)
+        if wait:
+            return too_many_attempts(wait)
 
         # Check to see if the username/password pair are in the users table
+        db = get_db()
         sel = select(users).where(and_(users.c.username == username))
-        user_account = connection.execute(sel).fetchall()
+        user_account = db.execute(sel).fetchall()
 
         # If they're not in the table, tell the user as much
-        if len(user_account) != 1 or not check_password_hash(user_account[0]["passhash"], password):
+        if len(user_account) != 1:
             return report_error("username and/or password does not exist")
-        elif len(user_account) == 1:
-            session["user_id"] = user_account[0].id
+        try:
+            if not verify_password(user_account[0].passhash, password):
+                return report_error("username and/or password does not exist")
+
+            # Passwords hashed with an older method or cost are upgraded now that we have them
+            if needs_rehash(user_account[0].passhash):
+                db.execute(update(users)
+                           .where(users.c.id == user_account[0].id)
+                           .values(passhash=hash_password(password)))
+                db.commit()
+        except AuthBusy:
+            return report_error("We're busy logging other people in right now. Try again in a minute."), 503
+
+        session["user_id"] = user_account[0].id
 
-            return redirect("/")
+        return redirect("/")
 
 
 @app.route("/logout")
@@ -345,9 +565,6 @@ def register():
         password = request.form.get("password")
         confirmation = request.form.get("confirmation")
 
-        # Generate a hash for the password
-        passhash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=16)
-
         # Check to make sure they've provided input in each field
         if not username:
             return report_error("you didn't provide a username")
@@ -359,29 +576,44 @@ def register():
         # If the password doesn't match the password confirmation, let the user know
         elif password != confirmation:
             return report_error("passwords don't match")
+        elif len(password) > MAX_PASSWORD_LENGTH:
+            return report_error(f"passwords can be at most {MAX_PASSWORD_LENGTH} characters")
+
+        # Turn away floods of signups before doing any hashing (see auth.py)
+        wait = limit_attempt(request.remote_addr)
+        if wait:
+            return too_many_attempts(wait)
 
         # Check to make sure the username doesn't exist
-        sel = select([users.c.username]).where(users.c.username == username)
-        rp = connection.execute(sel)
+        db = get_db()
+        sel = select(users.c.username).where(users.c.username == username)
+        rp = db.execute(sel)
         user_account = rp.fetchall()
 
         # If the username exists, let the user know so they can try again
         if len(user_account) == 1:
             return report_error("username already exists")
 
+        # Only now that everything else checks out, hash the password
+        try:
+            passhash = hash_password(password)
+        except AuthBusy:
+            return report_error("We're busy signing other people up right now. Try again in a minute."), 503
+
         # Create a record for username and hash in users table
         ins = insert(users).values(
                 username=username,
                 passhash=passhash
         )
-        rp = connection.execute(ins)
-        connection.commit()
-
-        # Fetch the user's id number from the data base so we can use it later and log the sessionr
-        stmt = select(users.c.id).where(username == username)
-        user_id = connection.execute(stmt).fetchall()
+        try:
+            rp = db.execute(ins)
+            db.commit()
+        except IntegrityError:
+            # Someone took the username while the password was hashing
+            db.rollback()
+            return report_error("username already exists")
 
-        # Log the username in the session
-        session["user_id"] = user_id[0].id
+        # Log the new user's id (autogenerated by the insert) in the session
+        session["user_id"] = rp.inserted_primary_key[0]
 
         return redirect("/")
@@ -1,122 +1,503 @@
 # This module is devoted to database queries (insertions, selections, etc.).
 # TODO rewrite all sql code using ORM to reduce the clutter of MetaData
 
-from itertools import zip_longest
+import base64
+import json
+import os
+import re
 
 from flask import session
-from sqlalchemy import (Column, ForeignKey, Integer, MetaData, String, Table,
-                        and_, create_engine, insert, select)
-
-# Initiate metadata object so we can create Table objects to manipulate our data
-metadata = MetaData()
-
-# Create the table objects (corresponding to recipe.db)
-ingredients = Table("ingredients", metadata,
-                    Column("title_id", Integer(), ForeignKey("titles.id")),
-                    Column("ingredient", String(), nullable=False)
-                    )
-
-instructions = Table("instructions", metadata,
-                     Column("title_id", Integer(), ForeignKey("titles.id")),
-                     #Column("instruction_title", String()),
-                     Column("instruction", String(), nullable=False)
-                     )
-
-recipe_books = Table("recipe_books", metadata,
-                     Column("title_id", Integer(), ForeignKey("titles.id")),
-                     Column("user_id", Integer(), ForeignKey("users.id"))
-                     )
-
-titles = Table("titles", metadata,
-               Column("id", Integer(), primary_key=True),
-               Column("title", String(), nullable=False),
-               Column("url", String())
-               )
-
-users = Table("users", metadata,
-              Column("id", Integer(), primary_key=True),
-              Column("username", String(), nullable=False, unique=True),
-              Column("passhash", String(), nullable=False),
-              )
-
-# Initiate SQLAlchemy Engine
-engine = create_engine("sqlite:///recipe.db?check_same_thread=False", echo=True, future=True)
-
-# Create a connection object so we can execute commands/queries on the database.
-connection = engine.connect()
-
-# Create tables (if not created)
-metadata.create_all(engine)
+from sqlalchemy import (and_, bindparam, exists, false, func, insert,
+                        inspect, literal, literal_column, or_, select, table,
+                        text, true, union_all)
+from sqlalchemy.exc import IntegrityError
+
+import cache
+from compact import (content_hash, keep_instruction_rows, pack_recipe,
+                     unpack_recipe)
+from db import (engine, get_db, ingredients, instructions, recipe_blobs,
+                recipe_books, title_urls, titles)
+from ingredient_parser import parse_ingredient
+from metrics import stage
+from tags import find_tag_ids, get_tags, tag_filter, tags_for_titles
+
+# Number of titles per page of the recipe book
+PAGE_SIZE = int(os.environ.get("RECIPE_PAGE_SIZE", 50))
+
+# The full-text search index (see migration 4), if this database has one
+recipe_search = table("recipe_search")
+_search_index = None
+
 
 def update_tables(title, instructions_body, ingredients_list, url):
     """
     This function takes all the information scraped from the url -- or the
     OCRed image file -- and enters it into the database.
+
+    The title, its ingredients and instructions, and its place in the user's library are
+    written in a single transaction (see insert_recipes), so a failure part way through
+    can't leave an orphaned title behind. Returns the title id and what became of the
+    recipe ("imported", "linked" or "owned", as for insert_recipes)
+    """
+
+    # This function is only called if the recipe's url isn't in the db. If the same recipe
+    # is stored under another url (or none, e.g. the same card scanned by someone else),
+    # insert_recipes just adds that copy to the user's library.
+    return insert_recipes([(title, instructions_body, ingredients_list, url)], session["user_id"])[0]
+
+
+def insert_title(title_id):
+    """
+    This function inserts a title into the user's 'library', i.e., a place
+    in the database where the title is associated with the user
     """
 
-    # Insert recipe title into titles table (title_id is autogenerated) 
-    stmt = insert(titles).values(title=title, url=url)
-    connection.execute(stmt)
-    connection.commit()
+    db = get_db()
+    stmt = insert(recipe_books).values(user_id=session["user_id"], title_id=title_id)
+    db.execute(stmt)
+    db.commit()
+
+    # The user's cached recipe book pages no longer list everything in it
+    cache.invalidate_user(session["user_id"])
 
-    # Grab the title_id from the titles table so we can plug it in as a Foreign Key in other tables
-    title_id = grab_title_id(title)
+    return True
 
-    # Insert ingredients into ingredients table.
+
+def clean_ingredients(ingredients_list):
+    """
+    This function drops the entries of a scraped ingredients list that aren't ingredients
+    """
+
+    cleaned = []
     for ingredient in ingredients_list:
-        print(ingredient)
 
         # Stop at extraneous instruction
         if ingredient.lower().startswith("for full"):
             break
-        stmt = insert(ingredients).values(ingredient=ingredient, title_id=title_id)
-        connection.execute(stmt)
-    connection.commit()
+        cleaned.append(ingredient)
+
+    return cleaned
+
+
+def clean_instructions(instructions_body):
+    """
+    This function drops the entries of a scraped instructions list that are too short to be
+    an instruction
+    """
+
+    return [entry for entry in instructions_body if len(entry) >= 15]
+
+
+def find_titles_by_url(urls, conn=None):
+    """
+    This function returns a dictionary mapping each of the given urls that's already in the
+    database to its title id, whether it's the recipe's own url or one the same recipe was
+    also imported from (see insert_recipes)
+    """
+
+    conn = conn if conn is not None else get_db()
+    found = {}
 
-    # Insert instructions into instructions table
-    for entry in instructions_body:
-        print(entry)
-        print()
+    # Look the urls up a few hundred at a time, to stay under SQLite's limit on query parameters
+    urls = list(urls)
+    for i in range(0, len(urls), 500):
+        chunk = urls[i: i + 500]
+        stmt = union_all(select(titles.c.url, titles.c.id).where(titles.c.url.in_(chunk)),
+                         select(title_urls.c.url, title_urls.c.title_id.label("id"))
+                         .where(title_urls.c.url.in_(chunk)))
+        for row in conn.execute(stmt):
+            found.setdefault(row.url, row.id)
 
-        # If the instruction is short, then skip it
-        if len(entry) < 15:
+    return found
+
+
+def link_titles(title_ids, user_id, conn=None):
+    """
+    This function adds the given titles to a user's library, skipping the ones already in it.
+    Returns the set of title ids that were added.
+
+    Given a connection, it writes in that connection's transaction, and leaves committing
+    and invalidating the user's cache to the caller
+    """
+
+    title_ids = set(title_ids)
+    if not title_ids:
+        return set()
+
+    if conn is None:
+        with engine.begin() as conn:
+            added = link_titles(title_ids, user_id, conn)
+        if added:
+            cache.invalidate_user(user_id)
+        return added
+
+    stmt = select(recipe_books.c.title_id).where(and_(recipe_books.c.user_id == user_id,
+                                                      recipe_books.c.title_id.in_(title_ids)))
+    owned = {row.title_id for row in conn.execute(stmt)}
+    added = title_ids - owned
+    if added:
+        conn.execute(insert(recipe_books), [{"user_id": user_id, "title_id": title_id}
+                                             for title_id in added])
+
+    return added
+
+
+def find_titles_by_hash(hashes, conn=None):
+    """
+    This function returns a dictionary mapping each of the given content hashes (see
+    content_hash in compact.py) that's already in the database to its title id
+    """
+
+    conn = conn if conn is not None else get_db()
+    found = {}
+
+    hashes = list(hashes)
+    for i in range(0, len(hashes), 500):
+        stmt = select(titles.c.content_hash, titles.c.id).where(titles.c.content_hash.in_(hashes[i: i + 500]))
+        for row in conn.execute(stmt):
+            found[row.content_hash] = row.id
+
+    return found
+
+
+def insert_recipes(recipes, user_id, conn=None):
+    """
+    This function writes a batch of scraped recipes, and adds them to the user's library
+    (if user_id isn't None), in a single transaction. Each recipe is a (title,
+    instructions_body, ingredients_list, url) tuple. Returns a (title id, status) pair for
+    each recipe, in order, where the status is
+      imported - the recipe was stored
+      linked   - the same content was already stored (or earlier in the batch), and that
+                 copy was added to the user's library
+      owned    - the same content was already stored, and the user already had it (or
+                 there's no user)
+
+    A recipe whose content is already stored (however it got there -- see content_hash in
+    compact.py) isn't stored again: the existing copy is added to the user's library
+    instead, and the recipe's url is kept as another url of that copy (in title_urls), so
+    importing the url again finds it.
+
+    Given a connection (e.g. an async one's, through run_sync -- see asgi.py), it writes in
+    that connection's transaction, and leaves committing and invalidating the cache to the caller
+    """
+
+    stored_ids = []
+    new_ids = []
+    ingredient_rows = []
+    instruction_rows = []
+    blob_rows = []
+    search_rows = []
+    alias_urls = {}
+
+    if not recipes:
+        return []
+
+    if conn is None:
+        # If someone else stores the same content at the same time, the unique index on the
+        # content hash turns one of us away, and the second try finds their copy
+        for attempt in range(2):
+            try:
+                with stage("db_write"), engine.begin() as conn:
+                    results = insert_recipes(recipes, user_id, conn)
+                break
+            except IntegrityError:
+                if attempt:
+                    raise
+
+        # Only once the transaction is committed, drop what's cached about the user's library,
+        # and any page cached under a reused title id
+        if user_id is not None:
+            cache.invalidate_user(user_id)
+        for title_id, status in results:
+            if status == "imported":
+                cache.invalidate_recipe(title_id)
+
+        return results
+
+    cleaned = []
+    for title, instructions_body, ingredients_list, url in recipes:
+        cleaned_ingredients = clean_ingredients(ingredients_list)
+        cleaned_instructions = clean_instructions(instructions_body)
+        cleaned.append((title, cleaned_instructions, cleaned_ingredients, url,
+                        content_hash(title, cleaned_ingredients, cleaned_instructions)))
+
+    # Recipes already stored (or repeated within the batch) are only linked
+    stored = find_titles_by_hash({recipe[4] for recipe in cleaned}, conn)
+
+    # The titles go in one at a time, since we need each one's autogenerated id
+    title_ids = []
+    for title, cleaned_instructions, cleaned_ingredients, url, digest in cleaned:
+        if digest in stored:
+            title_ids.append(stored[digest])
+            stored_ids.append(stored[digest])
+            if url is not None:
+                alias_urls.setdefault(url, stored[digest])
             continue
 
-        # Otherwise contine entering the entries (with title_ids) into the database 
-        stmt = insert(instructions).values(instruction=entry,
-                                            title_id=title_id)
-        connection.execute(stmt)
-    connection.commit()
+        result = conn.execute(insert(titles).values(title=title, url=url, content_hash=digest))
+        title_id = result.inserted_primary_key[0]
+        title_ids.append(title_id)
+        new_ids.append(title_id)
+        stored[digest] = title_id
 
-    # This function is only called if the recipe doesn't exist in the db. 
-    # So we know it isn't in the user's library.
+        # Number the rows, so the recipe reads back in the order it was written
+        for position, ingredient in enumerate(cleaned_ingredients):
 
-    # Thus, we add it.
-    insert_title(title_id)
+            # Parse the line now (see ingredient_parser.py), so shopping lists don't have to
+            quantity, unit, food = parse_ingredient(ingredient)
+            ingredient_rows.append({"title_id": title_id, "ingredient": ingredient, "position": position,
+                                    "quantity": quantity, "unit": unit, "food": food})
+        if keep_instruction_rows():
+            instruction_rows.extend({"title_id": title_id, "instruction": entry, "position": position}
+                                    for position, entry in enumerate(cleaned_instructions))
 
-    return True
+        # The whole recipe, packed for reading back in one lookup (see compact.py)
+        blob_rows.append({"title_id": title_id, "body": pack_recipe(cleaned_ingredients, cleaned_instructions)})
+        search_rows.append({"id": title_id, "title": title, "ingredients": "\n".join(cleaned_ingredients),
+                            "instructions": "\n".join(cleaned_instructions)})
 
+    # Everything else goes in with one executemany per table
+    if ingredient_rows:
+        conn.execute(insert(ingredients), ingredient_rows)
+    if instruction_rows:
+        conn.execute(insert(instructions), instruction_rows)
+    if blob_rows:
+        conn.execute(insert(recipe_blobs), blob_rows)
 
-def grab_title_id(title):
+    # The urls of recipes that turned out to be stored already lead to the copy stored,
+    # unless they're known already
+    known = find_titles_by_url(alias_urls, conn) if alias_urls else {}
+    alias_rows = [{"url": url, "title_id": title_id} for url, title_id in alias_urls.items() if url not in known]
+    if alias_rows:
+        conn.execute(insert(title_urls), alias_rows)
+
+    # The new recipes join the user's library, along with the stored ones they already had
+    added = set()
+    if user_id is not None:
+        if new_ids:
+            conn.execute(insert(recipe_books), [{"user_id": user_id, "title_id": title_id}
+                                                 for title_id in new_ids])
+        added = link_titles(set(stored_ids) - set(new_ids), user_id, conn) | set(new_ids)
+
+    # Keep the search index in step with the recipes
+    if search_rows and search_index_available(conn):
+        conn.execute(text("INSERT INTO recipe_search (rowid, title, ingredients, instructions) "
+                          "VALUES (:id, :title, :ingredients, :instructions)"), search_rows)
+
+    # A recipe is imported where its title was made, and linked where it joined the library
+    # as a copy of one stored already (or stored earlier in the batch)
+    results = []
+    made = set(new_ids)
+    for title_id in title_ids:
+        if title_id in made:
+            results.append((title_id, "imported"))
+            made.discard(title_id)
+        else:
+            results.append((title_id, "linked" if title_id in added else "owned"))
+    return results
+
+
+def load_recipe(title_id, user_id):
     """
-    This function returns the title id for a given recipe
+    This function returns a recipe from a user's library, as a dictionary holding its title,
+    url, ingredients and instructions. Returns None if the recipe isn't in their library.
+
+    The recipe comes back from a single primary key lookup: the title row, joined to the
+    user's library (the ownership check), joined to the recipe's packed blob (see compact.py).
+    A recipe without a blob is read from its rows instead
     """
 
-    stmt = select(titles.c.id).where(titles.c.title == title)
-    title_id = connection.execute(stmt).fetchall()
-    title_id = title_id[0].id 
+    stmt = (select(titles.c.title, titles.c.url, recipe_blobs.c.body)
+            .join_from(titles, recipe_books, and_(recipe_books.c.title_id == titles.c.id,
+                                                  recipe_books.c.user_id == user_id))
+            .outerjoin(recipe_blobs, recipe_blobs.c.title_id == titles.c.id)
+            .where(titles.c.id == title_id))
+    row = get_db().execute(stmt).first()
 
-    return title_id
+    if row is None:
+        return None
+    if row.body is None:
+        return load_recipe_from_rows(title_id, user_id)
 
+    ingredients_list, instructions_body = unpack_recipe(row.body)
+    return {"id": title_id,
+            "title": row.title,
+            "url": row.url,
+            "ingredients": ingredients_list,
+            "instructions": instructions_body}
 
-def insert_title(title_id):
+
+def load_recipe_from_rows(title_id, user_id):
     """
-    This function inserts a title into the user's 'library', i.e., a place
-    in the database where the title is associated with the user
+    This function is load_recipe, reading the recipe from its ingredient and instruction rows.
+
+    Everything comes back from a single query: the title row, joined to the user's library
+    (the ownership check), joined to the recipe's ingredients and instructions in order
     """
 
-    stmt = insert(recipe_books).values(user_id=session["user_id"], title_id=title_id)
-    connection.execute(stmt)
-    connection.commit()
+    # The recipe's ingredients (kind 0) and instructions (kind 1), each in their stored order
+    lines = union_all(
+        select(literal(0).label("kind"), ingredients.c.position.label("position"),
+               ingredients.c.ingredient.label("body")).where(ingredients.c.title_id == title_id),
+        select(literal(1).label("kind"), instructions.c.position.label("position"),
+               instructions.c.instruction.label("body")).where(instructions.c.title_id == title_id)
+    ).subquery()
+
+    stmt = (select(titles.c.title, titles.c.url, lines.c.kind, lines.c.body)
+            .join_from(titles, recipe_books, and_(recipe_books.c.title_id == titles.c.id,
+                                                  recipe_books.c.user_id == user_id))
+            .outerjoin(lines, true())
+            .where(titles.c.id == title_id)
+            .order_by(lines.c.kind, lines.c.position))
+    rows = get_db().execute(stmt).fetchall()
+
+    if not rows:
+        return None
+
+    return {"id": title_id,
+            "title": rows[0].title,
+            "url": rows[0].url,
+            "ingredients": [row.body for row in rows if row.kind == 0],
+            "instructions": [row.body for row in rows if row.kind == 1]}
+
+
+def owns_title(title_id, user_id):
+    """
+    This function checks whether a recipe is in a user's library
+    """
+
+    stmt = select(recipe_books.c.title_id).where(and_(recipe_books.c.title_id == title_id,
+                                                      recipe_books.c.user_id == user_id))
+    return get_db().execute(stmt).first() is not None
+
+
+def search_index_available(conn=None):
+    """
+    This function checks (once per process) whether the database has a full-text search index
+    """
+
+    global _search_index
+    if _search_index is None:
+        _search_index = "recipe_search" in inspect(conn if conn is not None else engine).get_table_names()
+    return _search_index
+
+
+def encode_cursor(title, title_id):
+    """
+    This function turns the last title on a page into an opaque token for the next page's url
+    """
+
+    return base64.urlsafe_b64encode(json.dumps([title, title_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    This function turns a page token back into a (title, title_id) pair, or None if it's invalid
+    """
+
+    try:
+        title, title_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if not isinstance(title, str) or not isinstance(title_id, int):
+        return None
+    return title, title_id
+
+
+def search_clause(query):
+    """
+    This function returns a condition matching the titles whose title, ingredients or
+    instructions contain every word of a search query
+    """
+
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return false()
+
+    # Use the full-text index if there is one. Each word is quoted (so nothing the user
+    # types is read as FTS syntax) and matches as a prefix, e.g. "tom" finds "tomatoes"
+    if search_index_available():
+        match = " ".join(f'"{word}"*' for word in words)
+        matches = (select(literal_column("rowid")).select_from(recipe_search)
+                   .where(literal_column("recipe_search").op("MATCH")(bindparam("match", match))))
+        return titles.c.id.in_(matches)
+
+    # Otherwise, look for each word with LIKE
+    conditions = []
+    for word in words:
+        conditions.append(or_(
+            func.lower(titles.c.title).contains(word, autoescape=True),
+            exists().where(and_(ingredients.c.title_id == titles.c.id,
+                                func.lower(ingredients.c.ingredient).contains(word, autoescape=True))),
+            exists().where(and_(instructions.c.title_id == titles.c.id,
+                                func.lower(instructions.c.instruction).contains(word, autoescape=True)))))
+    return and_(*conditions)
+
+
+def list_titles(user_id, query=None, cursor=None, limit=PAGE_SIZE, tag_ids=None, match_all=False):
+    """
+    This function returns one page of the titles in a user's library, alphabetically,
+    optionally only those matching a search query and carrying any (or, if match_all, all)
+    of the given tags. Returns the page's rows (id, title) and the cursor for the next
+    page, which is None on the last page.
+
+    Pages are keyed on the last (title, id) of the previous page rather than numbered,
+    so a page deep into a large library costs the same as the first
+    """
+
+    stmt = (select(titles.c.id, titles.c.title)
+            .join_from(titles, recipe_books, and_(recipe_books.c.title_id == titles.c.id,
+                                                  recipe_books.c.user_id == user_id)))
+
+    if query:
+        stmt = stmt.where(search_clause(query))
+
+    if tag_ids:
+        stmt = stmt.where(tag_filter(user_id, tag_ids, match_all))
+
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None:
+        after_title, after_id = after
+        stmt = stmt.where(or_(titles.c.title > after_title,
+                              and_(titles.c.title == after_title, titles.c.id > after_id)))
+
+    # Fetch one extra row to find out whether there's another page
+    stmt = stmt.order_by(titles.c.title, titles.c.id).limit(limit + 1)
+    rows = get_db().execute(stmt).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].title, rows[-1].id)
+
+    return rows, next_cursor
+
+
+def recipebook_page(user_id, query=None, cursor=None, tag_names=(), match_all=False):
+    """
+    This function returns everything shown on one page of a user's recipe book, as a
+    dictionary: the page's titles (each a dictionary of id and title), the cursor for the
+    next page, the tags on each title, and all of the user's tags (for filtering by).
+
+    Pages are cached until the user's library or tags change (see cache.py). Tags the user doesn't have match nothing, so with match_all
+    neither does the whole filter
+    """
+
+    key = json.dumps([query or "", cursor or "", sorted(tag_names), bool(match_all)])
+
+    def compute():
+        tag_ids = find_tag_ids(user_id, tag_names)
+        if tag_names and (not tag_ids or (match_all and len(tag_ids) < len(tag_names))):
+            rows, next_cursor = [], None
+        else:
+            rows, next_cursor = list_titles(user_id, query=query, cursor=cursor,
+                                            tag_ids=tag_ids.values(), match_all=match_all)
+
+        title_tags = tags_for_titles(user_id, [row.id for row in rows])
+        return {"titles": [{"id": row.id, "title": row.title} for row in rows],
+                "next_cursor": next_cursor,
+                # JSON object keys are strings, so the tags are keyed by str(title id)
+                "title_tags": {str(title_id): names for title_id, names in title_tags.items()},
+                "all_tags": [{"id": tag.id, "name": tag.name} for tag in get_tags(user_id)]}
 
-    return True
\ No newline at end of file
+    return cache.get_or_set(f"user:{user_id}", key, compute, changes=True)
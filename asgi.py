@@ -0,0 +1,256 @@
+# This module serves the app under an ASGI server, e.g.
+#
+#     gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+#
+# URL imports spend nearly all their time waiting on other sites, so here they're answered
+# by async routes: the page is fetched with httpx and the database is reached through the
+# async engine (see import_urls_async in bulk_import.py), and a single worker can have
+# hundreds of imports in flight. A list of urls is imported as a background job on the
+# worker's event loop, polled at /jobs/<job_id> like the flask app's (see jobs.py). These
+# take the same slots as the flask app's imports, so a worker turns new ones away once it's
+# running as many as it would there.
+# Everything else -- including image uploads to / -- is the flask app, unchanged, run in
+# a thread pool.
+#
+# The async routes share flask's sessions (whichever backend sessions.py set up) and
+# templates, by opening a flask request context around the bits that need them.
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from flask import redirect, session
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import fetch
+from app import app as flask_app
+from bulk_import import MAX_URLS, clean_urls, import_urls_async
+from buttress import report_error
+from db import get_async_engine
+from jobs import (create_job, finish_job, release_import, reserve_import,
+                  start_job)
+from metrics import REQUEST_SECONDS
+
+# Threads the flask app runs in, per worker
+WSGI_THREADS = int(os.environ.get("RECIPE_ASGI_WSGI_THREADS", 10))
+
+# Paths answered by the async routes, for POSTs that aren't file uploads
+ASYNC_PATHS = {"/", "/import"}
+
+logger = logging.getLogger("recipe.asgi")
+
+# Imports running in the background on this worker's event loop. The loop only keeps weak
+# references to its tasks, so they're held here until they finish
+_imports = set()
+
+
+def in_flask(request, f, *args):
+    """
+    This function calls f(*args) inside a flask request context for the request, so it
+    can use flask's session and templates. Returns what f returns
+    """
+
+    with flask_app.test_request_context(request.url.path, method=request.method,
+                                        headers={"Cookie": request.headers.get("cookie", "")}):
+        return f(*args)
+
+
+async def flask_response(request, f, *args):
+    """
+    This function turns a flask response made by f(*args) (e.g. a rendered template, or
+    report_error) into a starlette response
+    """
+
+    def respond():
+        response = flask_app.make_response(f(*args))
+        return response.get_data(), response.status_code, dict(response.headers)
+
+    body, status, headers = await run_in_threadpool(in_flask, request, respond)
+    headers.pop("Content-Length", None)
+    return Response(body, status_code=status, headers=headers)
+
+
+async def current_user(request):
+    """
+    This function returns the id of the user logged in on the request, or None
+    """
+
+    return await run_in_threadpool(in_flask, request, lambda: session.get("user_id"))
+
+
+def too_large(request):
+    """
+    This function checks whether a request declares a body larger than flask would accept
+    """
+
+    length = request.headers.get("content-length", "")
+    return length.isdigit() and int(length) > flask_app.config["MAX_CONTENT_LENGTH"]
+
+
+def timed(route):
+    """
+    This decorator times an async route in the same histogram as the flask routes (see metrics.py)
+    """
+
+    def decorate(f):
+        async def timed_route(request):
+            start = time.perf_counter()
+            response = await f(request)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route, response.status_code)
+            return response
+        return timed_route
+    return decorate
+
+
+@timed("/")
+async def import_one(request):
+    """
+    The async version of posting a url to / (see index in app.py)
+    """
+
+    user_id = await current_user(request)
+    if user_id is None:
+        return await flask_response(request, redirect, "/login")
+    if too_large(request):
+        return await flask_response(request, lambda: (report_error("that's too much to send at once"), 413))
+
+    form = await request.form()
+    url = (form.get("url") or "").strip()
+    if not url:
+        return await flask_response(request, report_error, "no url sent.")
+    if not url.startswith("http"):
+        return await flask_response(request, report_error, "not a url")
+
+    result = (await import_urls_async([url], user_id))[0]
+
+    if result["status"] in ("imported", "linked"):
+        return await flask_response(request, redirect, "/recipebook")
+    if result["status"] == "owned":
+        return await flask_response(request, report_error, "you already have that recipe in your library")
+    return await flask_response(request, report_error, result["error"])
+
+
+@timed("/import")
+async def import_many(request):
+    """
+    The async version of /import (see bulk_import in app.py)
+    """
+
+    is_json = request.headers.get("content-type", "").startswith("application/json")
+
+    user_id = await current_user(request)
+    if user_id is None:
+        return await flask_response(request, redirect, "/login")
+    if too_large(request):
+        if is_json:
+            return JSONResponse({"error": "that's too much to send at once"}, status_code=413)
+        return await flask_response(request, lambda: (report_error("that's too much to send at once"), 413))
+
+    # Gather the urls from the JSON body or the form
+    if is_json:
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = None
+        urls = payload.get("urls") if isinstance(payload, dict) else None
+        if not isinstance(urls, list):
+            return JSONResponse({"error": "expected a JSON body of the form {\"urls\": [...]}"}, status_code=400)
+    else:
+        form = await request.form()
+        urls = (form.get("urls") or "").splitlines()
+
+    urls = clean_urls(urls)
+    if not urls:
+        if is_json:
+            return JSONResponse({"error": "no urls sent"}, status_code=400)
+        return await flask_response(request, report_error, "no urls sent.")
+    if len(urls) > MAX_URLS:
+        if is_json:
+            return JSONResponse({"error": f"at most {MAX_URLS} urls per import"}, status_code=413)
+        return await flask_response(request, report_error, f"at most {MAX_URLS} urls per import")
+
+    # Import them in the background, and send the user (or script) to poll the job.
+    # Backpressure, as in the flask app: give up if there are no slots left
+    if not reserve_import():
+        if is_json:
+            return JSONResponse({"error": "too many imports are running, try again in a minute"}, status_code=503)
+        return await flask_response(request, lambda: (report_error(
+            "We're busy importing other recipes right now. Try again in a minute."), 503))
+    try:
+        job_id = await run_in_threadpool(create_job, user_id, "urls")
+    except Exception:
+        release_import()
+        raise
+    task = asyncio.create_task(run_import(job_id, urls, user_id))
+    _imports.add(task)
+    task.add_done_callback(_imports.discard)
+
+    if is_json:
+        return JSONResponse({"job_id": job_id, "status": "queued", "poll": f"/jobs/{job_id}?format=json"},
+                            status_code=202)
+    return await flask_response(request, redirect, f"/jobs/{job_id}")
+
+
+async def run_import(job_id, urls, user_id):
+    """
+    This function imports a list of urls as a background job, keeping how each fared as
+    the job's result, and then hands back the import slot it was started with
+    """
+
+    try:
+        await run_in_threadpool(start_job, job_id)
+        results = await import_urls_async(urls, user_id)
+    except Exception:
+        logger.exception("urls import %s failed", job_id)
+        await run_in_threadpool(finish_job, job_id, "failed", None,
+                                "Something went wrong with that import. Please try again.")
+    else:
+        await run_in_threadpool(finish_job, job_id, "done", results)
+    finally:
+        release_import()
+
+
+@asynccontextmanager
+async def lifespan(starlette_app):
+    """
+    This function closes the pooled http and database connections when the worker stops
+    """
+
+    yield
+    await fetch.close_async_client()
+    await get_async_engine().dispose()
+
+
+async_routes = Starlette(routes=[Route("/", import_one, methods=["POST"]),
+                                 Route("/import", import_many, methods=["POST"])],
+                         lifespan=lifespan)
+wsgi_app = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+
+
+def is_async_import(scope):
+    """
+    This function checks whether a request goes to the async routes: a POST of a url, or a
+    list of them, rather than of an image
+    """
+
+    if scope["method"] != "POST" or scope["path"] not in ASYNC_PATHS:
+        return False
+    headers = dict(scope["headers"])
+    return not headers.get(b"content-type", b"").startswith(b"multipart/")
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI app: url imports go to the async routes, and everything else to flask
+    """
+
+    if scope["type"] == "lifespan" or (scope["type"] == "http" and is_async_import(scope)):
+        await async_routes(scope, receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
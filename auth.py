@@ -0,0 +1,168 @@
+# This module keeps password hashing and login attempts from starving the rest of the app.
+#
+# Password hashes are deliberately slow, so they're computed on a small pool of threads
+# (hashlib releases the GIL while it works), with a bounded queue in front: when it's full,
+# logins and signups are turned away instead of piling up. The hashing method and its cost
+# are configurable, and a password hashed with an older setting is rehashed when its owner
+# next logs in.
+#
+# Login and signup attempts are also rate limited in memory, per client address and per
+# username, with token buckets: each key can make `burst` attempts at once, and earns
+# another `rate` attempts per minute. The limits are per process. Behind a proxy (e.g.
+# Heroku's router) the client's address comes from X-Forwarded-For, as long as
+# RECIPE_TRUSTED_PROXIES says how many proxies there are (see app.py).
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# The werkzeug hashing method, with its cost, e.g. "pbkdf2:sha256:600000" or "scrypt:32768:8:1"
+HASH_METHOD = os.environ.get("RECIPE_PASSWORD_METHOD", "pbkdf2:sha256:600000")
+SALT_LENGTH = int(os.environ.get("RECIPE_PASSWORD_SALT_LENGTH", 16))
+
+# Threads hashing passwords, and how many more hashes may wait for one
+HASH_WORKERS = int(os.environ.get("RECIPE_HASH_WORKERS", 2))
+HASH_QUEUE_SIZE = int(os.environ.get("RECIPE_HASH_QUEUE_SIZE", 8))
+
+# Longest password accepted, so nobody can make us hash megabytes
+MAX_PASSWORD_LENGTH = 1024
+
+# Number of proxies in front of the app whose X-Forwarded-For and X-Forwarded-Proto headers
+# are trusted. With none (the default) the headers are ignored, since any client can send them
+TRUSTED_PROXIES = int(os.environ.get("RECIPE_TRUSTED_PROXIES", 0))
+
+# Attempts per minute (and at once) allowed per client address, and per username
+IP_RATE = float(os.environ.get("RECIPE_AUTH_IP_RATE", 20))
+IP_BURST = int(os.environ.get("RECIPE_AUTH_IP_BURST", 10))
+USER_RATE = float(os.environ.get("RECIPE_AUTH_USER_RATE", 5))
+USER_BURST = int(os.environ.get("RECIPE_AUTH_USER_BURST", 5))
+
+
+class AuthBusy(Exception):
+    """
+    Raised when every hashing thread is busy and the queue is full
+    """
+
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+_method_prefix = None
+
+
+def _run(f, *args, **kwargs):
+    """
+    This function runs f on the hashing pool and waits for its result, or raises AuthBusy
+    if there's no room in the queue
+    """
+
+    if not _slots.acquire(blocking=False):
+        raise AuthBusy()
+    try:
+        return _executor.submit(f, *args, **kwargs).result()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    """
+    This function returns the hash of a password, with the configured method and cost
+    """
+
+    return _run(generate_password_hash, password, method=HASH_METHOD, salt_length=SALT_LENGTH)
+
+
+def verify_password(passhash, password):
+    """
+    This function checks a password against its hash
+    """
+
+    return _run(check_password_hash, passhash, password)
+
+
+def _configured_prefix():
+    """
+    This function returns how hashes made with the configured method begin, e.g.
+    "pbkdf2:sha256:600000"
+    """
+
+    global _method_prefix
+    if _method_prefix is None:
+        parts = HASH_METHOD.split(":")
+
+        # A method given with its full cost is written just as it's configured
+        if (parts[0] == "pbkdf2" and len(parts) == 3) or (parts[0] == "scrypt" and len(parts) == 4):
+            _method_prefix = HASH_METHOD
+
+        # Otherwise werkzeug fills in its defaults (e.g. "pbkdf2" becomes "pbkdf2:sha256:600000"),
+        # which vary between versions, so learn them by hashing once -- at full cost, so on the pool
+        else:
+            _method_prefix = _run(generate_password_hash, "", method=HASH_METHOD,
+                                  salt_length=1).split("$", 1)[0]
+
+    return _method_prefix
+
+
+def needs_rehash(passhash):
+    """
+    This function checks whether a hash was made with a different method or cost than the
+    configured one
+    """
+
+    return passhash.split("$", 1)[0] != _configured_prefix()
+
+
+class RateLimiter:
+    """
+    A token bucket per key (a client address, or a username), kept in memory. Only the most
+    recently seen keys are kept, so a flood of new keys can't use up memory
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def hit(self, key):
+        """
+        This method takes a token for the key. Returns 0 if there was one, or else the
+        number of seconds until there will be
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens >= 1:
+                wait = 0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate if self.rate else 60
+
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        return wait
+
+
+ip_limiter = RateLimiter(IP_RATE, IP_BURST)
+user_limiter = RateLimiter(USER_RATE, USER_BURST)
+
+
+def limit_attempt(address, username=None):
+    """
+    This function counts a login or signup attempt against the client's address and the
+    username. Returns 0 if it may go ahead, or else the seconds to wait before trying again
+    """
+
+    wait = ip_limiter.hit(address or "unknown")
+    if username:
+        wait = max(wait, user_limiter.hit(username.lower()))
+    return wait
@@ -0,0 +1,92 @@
+# Benchmark of the multi-resolution OCR preprocessing (see ANALYSIS_SIZE in buttress.py).
+#
+# Runs image_preprocessing and parse_image over synthetic recipe cards blown up to the
+# size of a phone photo, once working on the full image throughout (the old pipeline) and
+# once finding the layout on a downscaled copy, and checks that both find the same card
+# and the same blocks of text. Run from the repository root:
+#
+#     python -m benchmarks.bench_preprocessing [--repeat N] [--megapixels 12]
+
+import argparse
+import math
+
+import cv2
+
+import buttress
+from benchmarks.run import measure, render_card
+from buttress import image_preprocessing, parse_image
+
+
+def photo(seed, megapixels):
+    """
+    This function renders a synthetic recipe card at roughly the given number of megapixels
+    """
+
+    card = render_card(seed)
+    factor = math.sqrt(megapixels * 1e6 / (card.shape[0] * card.shape[1]))
+    return cv2.resize(card, None, fx=factor, fy=factor, interpolation=cv2.INTER_CUBIC)
+
+
+def pipeline(image):
+    """
+    This function runs the preprocessing half of the OCR pipeline, returning the cleaned up
+    card and the blocks of text found on it
+    """
+
+    processed = image_preprocessing(image)
+    return processed, parse_image(processed)
+
+
+def compare_outputs(full, fast):
+    """
+    This function returns how far apart the outputs of the two modes are: the difference in
+    the size of the crop, whether they found the same number of blocks, and the largest
+    difference in size between matching blocks (all in pixels)
+    """
+
+    (full_card, full_regions), (fast_card, fast_regions) = full, fast
+    crop_diff = max(abs(a - b) for a, b in zip(full_card.shape, fast_card.shape))
+
+    full_sizes = sorted(region.shape[:2] for region in full_regions)
+    fast_sizes = sorted(region.shape[:2] for region in fast_regions)
+    region_diff = max((abs(a - b) for full_size, fast_size in zip(full_sizes, fast_sizes)
+                       for a, b in zip(full_size, fast_size)), default=0)
+
+    return crop_diff, len(full_regions) == len(fast_regions), region_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark multi-resolution OCR preprocessing")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per card and mode")
+    parser.add_argument("--cards", type=int, default=3, help="number of synthetic recipe cards")
+    parser.add_argument("--megapixels", type=float, default=12, help="size of the synthetic photos")
+    args = parser.parse_args()
+
+    original_size = buttress.ANALYSIS_SIZE
+    analysis_size = original_size or 1600
+    modes = (("full", 0), (f"scaled {analysis_size}", analysis_size))
+
+    print(f"{'card':<8}{'mode':<14}{'p50 ms':>10}{'p95 ms':>10}{'peak MiB':>10}{'speedup':>9}"
+          f"{'crop diff':>11}{'same blocks':>13}{'block diff':>12}")
+    for i in range(args.cards):
+        image = photo(i + 1, args.megapixels)
+        outputs = {}
+        baseline = None
+        for name, size in modes:
+            buttress.ANALYSIS_SIZE = size
+            result = measure(name, lambda: pipeline(image), args.repeat)
+            outputs[name] = pipeline(image)
+            baseline = baseline or result["p50_ms"]
+
+            line = (f"card{i:<4}{name:<14}{result['p50_ms']:>10.0f}{result['p95_ms']:>10.0f}"
+                    f"{result['peak_kib'] / 1024:>10.0f}{baseline / result['p50_ms']:>8.1f}x")
+            if size:
+                crop_diff, same_count, region_diff = compare_outputs(outputs["full"], outputs[name])
+                line += f"{crop_diff:>11}{str(same_count):>13}{region_diff:>12}"
+            print(line)
+
+    buttress.ANALYSIS_SIZE = original_size
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Benchmark of recipe scraping over the saved pages in benchmarks/pages.
+#
+# Compares scrapers.scrape against the old approach (a full lxml BeautifulSoup tree
+# queried with the Purple Carrot selectors). Run from the repository root:
+#
+#     python -m benchmarks.bench_scrapers [--repeat N]
+
+import argparse
+import json
+import os
+import statistics
+import time
+
+from bs4 import BeautifulSoup
+
+from scrapers import html_to_string, scrape
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "pages")
+
+
+def load_pages():
+    """
+    This function returns a list of (filename, url, html) for every saved page
+    """
+
+    with open(os.path.join(PAGES_DIR, "index.json")) as f:
+        urls = json.load(f)
+
+    pages = []
+    for filename in sorted(urls):
+        with open(os.path.join(PAGES_DIR, filename), encoding="utf-8") as f:
+            pages.append((filename, urls[filename], f.read()))
+    return pages
+
+
+def full_dom_scrape(html, url=None):
+    """
+    This function scrapes a page the way index() used to: by building the whole DOM
+    """
+
+    soup = BeautifulSoup(html, "lxml")
+    title_tags = soup.select("h1.c-recipe-details-header__title")
+    if not title_tags:
+        return None
+    return (title_tags[0].get_text(strip=True), html_to_string(soup.select("ol > li")),
+            html_to_string(soup.select("div.col-12 > p")))
+
+
+def time_scraper(scraper, html, url, repeat):
+    """
+    This function returns the per-call times, in milliseconds, of running a scraper over a page
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        scraper(html, url)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recipe scraping over saved pages")
+    parser.add_argument("--repeat", type=int, default=50, help="runs per page and scraper")
+    args = parser.parse_args()
+
+    print(f"{'page':<28}{'scraper':<12}{'found':>7}{'median ms':>12}{'p95 ms':>10}")
+    for filename, url, html in load_pages():
+        for name, scraper in (("full DOM", full_dom_scrape), ("scrapers", scrape)):
+            found = scraper(html, url) is not None
+            times = sorted(time_scraper(scraper, html, url, args.repeat))
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            print(f"{filename:<28}{name:<12}{str(found):>7}{statistics.median(times):>12.2f}{p95:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Benchmark of the compact recipe storage (see compact.py) against the row per ingredient
+# and instruction layout.
+#
+# Works on a copy of the generated corpus (see benchmarks/run.py). Reports the space each
+# layout takes on disk (tables and their indexes, from SQLite's dbstat), the size of the
+# blobs under each available codec, and how long a recipe page takes to read back from
+# each layout. Run from the repository root:
+#
+#     python -m benchmarks.bench_storage [--corpus-size 2000] [--repeat 500]
+
+import argparse
+import random
+import shutil
+import sqlite3
+
+from benchmarks.run import measure, use_corpus_copy
+
+# The tables (and their indexes) each layout reads recipe pages from
+ROW_TABLES = ("ingredients", "instructions")
+BLOB_TABLES = ("recipe_blobs",)
+
+
+def table_sizes(path):
+    """
+    This function returns the bytes on disk taken by each table of a SQLite database,
+    counting its indexes with it
+    """
+
+    conn = sqlite3.connect(path)
+    try:
+        owners = dict(conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')"))
+        sizes = {}
+        for name, size in conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"):
+            table = owners.get(name, name)
+            sizes[table] = sizes.get(table, 0) + size
+    finally:
+        conn.close()
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compact recipe storage")
+    parser.add_argument("--corpus-size", type=int, default=2000, help="recipes in the generated library")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generated library")
+    parser.add_argument("--repeat", type=int, default=500, help="recipes read per layout")
+    args = parser.parse_args()
+
+    workdir, working_copy = use_corpus_copy(args.corpus_size, args.seed)
+    try:
+        from flask import Flask
+        from sqlalchemy import select
+
+        import compact
+        from app_model import load_recipe, load_recipe_from_rows
+        from db import engine, recipe_blobs, recipe_books
+
+        # Space on disk, per recipe
+        sizes = table_sizes(working_copy)
+        print(f"{'layout':<24}{'bytes/recipe':>14}")
+        for name, tables in (("rows", ROW_TABLES), ("compact", ("ingredients",) + BLOB_TABLES),
+                             ("blobs alone", BLOB_TABLES)):
+            print(f"{name:<24}{sum(sizes.get(table, 0) for table in tables) / args.corpus_size:>14.0f}")
+
+        # The blobs under each codec
+        with engine.connect() as conn:
+            recipes = [compact.unpack_recipe(row.body) for row in conn.execute(select(recipe_blobs.c.body))]
+        codecs = [("zlib", compact.ZLIB)] + ([("zstd", compact.ZSTD)] if compact.zstandard is not None else [])
+        print(f"\n{'codec':<24}{'bytes/recipe':>14}")
+        for name, codec in codecs:
+            total = sum(len(compact.pack_recipe(*recipe, codec=codec)) for recipe in recipes)
+            print(f"{name:<24}{total / len(recipes):>14.0f}")
+
+        # Reading a recipe page back
+        with engine.connect() as conn:
+            user_id, = conn.execute(select(recipe_books.c.user_id).limit(1)).first()
+            title_ids = [row.title_id for row in conn.execute(select(recipe_books.c.title_id)
+                                                              .where(recipe_books.c.user_id == user_id))]
+
+        app = Flask(__name__)
+        rng = random.Random(args.seed)
+        print(f"\n{'read':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        with app.app_context():
+            for name, load in (("rows", load_recipe_from_rows), ("compact", load_recipe)):
+                result = measure(name, lambda: load(rng.choice(title_ids), user_id), args.repeat)
+                print(f"{name:<24}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
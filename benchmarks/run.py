@@ -0,0 +1,428 @@
+# Benchmark harness for the slow paths of the app: scraping, OCR and the database.
+#
+# Everything runs offline. Scraping uses the saved pages in benchmarks/pages, OCR uses
+# recipe cards rendered with opencv, and the database benchmarks use a generated library
+# of --corpus-size recipes (built once and kept in benchmarks/.corpus, then copied for
+# each run so the writes don't pile up). Run from the repository root:
+#
+#     python -m benchmarks.run [--suite scrape,ocr,db] [--output results.json]
+#     python -m benchmarks.run --compare baseline.json --output results.json
+#
+# Each stage reports its latency percentiles, throughput and peak Python memory
+# (from tracemalloc, which doesn't see opencv's own buffers -- the process' peak
+# resident size is reported per suite for that). Results can be written as JSON, and
+# compared against an earlier run: a stage whose median got more than --threshold slower
+# counts as a regression, and the exit status is 1.
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from benchmarks.bench_scrapers import load_pages
+
+BENCH_DIR = os.path.dirname(__file__)
+CORPUS_DIR = os.path.join(BENCH_DIR, ".corpus")
+
+SUITES = ("scrape", "ocr", "db")
+
+# Words the generated recipes and cards are made of
+FOODS = ["flour", "sugar", "butter", "garlic", "onion", "carrot", "tomato", "basil", "lemon",
+         "chickpeas", "rice", "spinach", "tahini", "cumin", "paprika", "olive oil", "salt",
+         "black pepper", "white beans", "kale", "ginger", "soy sauce", "coconut milk", "lime",
+         "potato", "mushroom", "cilantro", "parsley", "honey", "oats", "almonds", "yogurt"]
+UNITS = ["cup", "cups", "tbsp", "tsp", "oz", "g", "can", "clove", "cloves", ""]
+QUANTITIES = ["1", "2", "3", "1/2", "1/4", "1 1/2", "3/4", "4", "6", "200"]
+ADJECTIVES = ["Lemony", "Smoky", "Crispy", "Creamy", "Spiced", "Roasted", "Golden", "Herby",
+              "Charred", "Zesty", "Hearty", "Quick"]
+DISHES = ["Skillet", "Bowls", "Tacos", "Curry", "Soup", "Salad", "Pasta", "Stew", "Flatbreads",
+          "Risotto", "Noodles", "Casserole"]
+VERBS = ["Prepare", "Preheat", "Chop", "Whisk", "Stir", "Roast", "Simmer", "Fold", "Season",
+         "Assemble"]
+TAGS = ["dinner", "lunch", "quick", "vegan", "spicy", "baking", "weeknight", "freezer"]
+
+
+def percentile(times, p):
+    """
+    This function returns the p-th percentile (nearest rank) of a sorted list of times
+    """
+
+    rank = max(1, math.ceil(p / 100 * len(times)))
+    return times[min(rank, len(times)) - 1]
+
+
+def measure(name, f, repeat, items=1, warmup=1):
+    """
+    This function times repeated calls of f (which takes no arguments) and returns a
+    dictionary of its latency percentiles in milliseconds, its throughput in items per
+    second (items being how many things one call handles) and its peak Python memory
+    """
+
+    for _ in range(warmup):
+        f()
+
+    # Memory is measured on a run of its own, since tracing slows every allocation down
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+
+    total = sum(times) / 1000
+    return {"stage": name, "runs": repeat, "items": items,
+            "p50_ms": percentile(times, 50), "p95_ms": percentile(times, 95),
+            "p99_ms": percentile(times, 99), "mean_ms": sum(times) / len(times),
+            "throughput_per_s": repeat * items / total if total else None,
+            "peak_kib": peak / 1024}
+
+
+def max_rss_kib():
+    """
+    This function returns the peak resident size of the process so far, in KiB, if the
+    platform can tell us
+    """
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports bytes, Linux kilobytes
+    return rss / 1024 if sys.platform == "darwin" else rss
+
+
+def scrape_suite(args):
+    """
+    This function benchmarks scraping the saved pages
+    """
+
+    from bs4 import BeautifulSoup
+
+    from scrapers import html_to_string, scrape, scrape_json_ld
+
+    results = []
+    for filename, url, html in load_pages():
+        page = os.path.splitext(filename)[0]
+        results.append(measure(f"scrape/{page}", lambda: scrape(html, url), args.repeat))
+        results.append(measure(f"scrape_json_ld/{page}", lambda: scrape_json_ld(html), args.repeat))
+
+        # html_to_string on its own, over the elements the adapters hand it. It rewrites
+        # the list it's given, so each call gets a fresh copy
+        elements = BeautifulSoup(html, "lxml").select("ol > li, div.col-12 > p")
+        if elements:
+            results.append(measure(f"html_to_string/{page}", lambda: html_to_string(list(elements)),
+                                   args.repeat, items=len(elements)))
+
+    return results
+
+
+def render_card(seed, width=1700, height=2200):
+    """
+    This function draws a synthetic recipe card: a title, an ingredients list and numbered
+    instructions in black on white, photographed slightly askew against a dark table
+    """
+
+    import cv2
+    import numpy as np
+
+    rng = random.Random(seed)
+    card = np.full((height, width, 3), 255, np.uint8)
+    font = cv2.FONT_HERSHEY_DUPLEX
+
+    title = f"{rng.choice(ADJECTIVES)} {rng.choice(FOODS).title()} {rng.choice(DISHES)}"
+    cv2.putText(card, title, (100, 180), font, 2.2, (0, 0, 0), 4, cv2.LINE_AA)
+
+    # Ingredients down the left
+    y = 380
+    cv2.putText(card, "INGREDIENTS", (100, y), font, 1.3, (0, 0, 0), 3, cv2.LINE_AA)
+    for _ in range(rng.randint(8, 14)):
+        y += 70
+        line = f"{rng.choice(QUANTITIES)} {rng.choice(UNITS)} {rng.choice(FOODS)}".replace("  ", " ")
+        cv2.putText(card, line, (100, y), font, 1.1, (0, 0, 0), 2, cv2.LINE_AA)
+
+    # Instructions down the right, wrapped to the column
+    y = 380
+    for step in range(1, rng.randint(4, 6) + 1):
+        words = [rng.choice(VERBS), "the"] + [rng.choice(FOODS) for _ in range(rng.randint(6, 12))]
+        words += ["with", "salt", "over", "medium", "heat."]
+        line = f"{step}."
+        for word in words:
+            if len(line) + len(word) > 26:
+                cv2.putText(card, line, (880, y), font, 1.1, (0, 0, 0), 2, cv2.LINE_AA)
+                y += 55
+                line = "  " + word
+            else:
+                line += " " + word
+        cv2.putText(card, line, (880, y), font, 1.1, (0, 0, 0), 2, cv2.LINE_AA)
+        y += 100
+
+    # Lay the card on a dark table, turn it a little and add sensor noise
+    margin = 200
+    photo = np.full((height + 2 * margin, width + 2 * margin, 3), 50, np.uint8)
+    photo[margin: margin + height, margin: margin + width] = card
+    h, w = photo.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w // 2, h // 2), rng.uniform(-3, 3), 1.0)
+    photo = cv2.warpAffine(photo, matrix, (w, h), borderValue=(50, 50, 50))
+    noise = np.random.default_rng(seed).normal(0, 6, photo.shape)
+
+    return np.clip(photo + noise, 0, 255).astype(np.uint8)
+
+
+def ocr_suite(args):
+    """
+    This function benchmarks the OCR pipeline over synthetic recipe cards
+    """
+
+    from buttress import extract_blocks, image_preprocessing, parse_image
+    from structure import structure_recipe
+
+    cards = [render_card(args.seed + i) for i in range(args.cards)]
+    results = []
+    for i, card in enumerate(cards):
+        results.append(measure(f"image_preprocessing/card{i}", lambda: image_preprocessing(card), args.ocr_repeat))
+        processed = image_preprocessing(card)
+        results.append(measure(f"parse_image/card{i}", lambda: parse_image(processed), args.ocr_repeat))
+        regions = parse_image(processed)
+
+        # Tesseract is a separate program, which may not be installed where this runs
+        if shutil.which("tesseract") is None:
+            continue
+        if regions:
+            results.append(measure(f"extract_blocks/card{i}", lambda: extract_blocks(regions),
+                                   args.ocr_repeat, items=len(regions)))
+            blocks = extract_blocks(regions)[0]
+            results.append(measure(f"structure_recipe/card{i}", lambda: structure_recipe(blocks), args.repeat))
+
+    return results
+
+
+def corpus_recipe(rng, i):
+    """
+    This function generates one recipe for the database corpus, as the
+    (title, instructions_body, ingredients_list, url) tuple insert_recipes takes
+    """
+
+    title = f"{rng.choice(ADJECTIVES)} {rng.choice(FOODS).title()} {rng.choice(DISHES)} {i}"
+    ingredients_list = [f"{rng.choice(QUANTITIES)} {rng.choice(UNITS)} {rng.choice(FOODS)}".replace("  ", " ")
+                        for _ in range(rng.randint(6, 14))]
+    instructions_body = [f"{rng.choice(VERBS)} the {rng.choice(FOODS)} and the {rng.choice(FOODS)} "
+                         f"for {rng.randint(2, 30)} minutes, stirring now and then."
+                         for _ in range(rng.randint(3, 8))]
+    return title, instructions_body, ingredients_list, f"https://bench.example.com/recipe/{i}"
+
+
+def build_corpus(path, size, seed):
+    """
+    This function generates a SQLite library of size recipes, owned by one user, a fifth
+    of them tagged. Runs in a fresh interpreter, since the database is chosen when db.py is imported
+    """
+
+    script = f"""
+import random
+from sqlalchemy import insert
+from app_model import insert_recipes
+from benchmarks.run import TAGS, corpus_recipe
+from db import engine, users
+from tags import tag_titles
+
+rng = random.Random({seed})
+with engine.begin() as conn:
+    user_id = conn.execute(insert(users).values(username="bench", passhash="-")).inserted_primary_key[0]
+title_ids = []
+for start in range(0, {size}, 500):
+    batch = [corpus_recipe(rng, i) for i in range(start, min(start + 500, {size}))]
+    title_ids.extend(title_id for title_id, status in insert_recipes(batch, user_id))
+for tag in TAGS:
+    tag_titles(user_id, rng.sample(title_ids, len(title_ids) // 5), [tag])
+"""
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}")
+    subprocess.run([sys.executable, "-c", script], env=env, check=True,
+                   cwd=os.path.dirname(os.path.abspath(BENCH_DIR)))
+
+
+def use_corpus_copy(size, seed):
+    """
+    This function points the app at a fresh copy of the generated corpus (building the
+    corpus first if need be), and returns the temporary directory holding the copy and its path.
+    It must be called before db.py is imported
+    """
+
+    corpus = os.path.join(CORPUS_DIR, f"recipes-{size}-{seed}.db")
+    if not os.path.exists(corpus):
+        os.makedirs(CORPUS_DIR, exist_ok=True)
+        print(f"building a corpus of {size} recipes in {corpus}", file=sys.stderr)
+        build_corpus(corpus + ".tmp", size, seed)
+        os.replace(corpus + ".tmp", corpus)
+
+    workdir = tempfile.mkdtemp(prefix="recipe-bench-")
+    working_copy = os.path.join(workdir, "recipe.db")
+    shutil.copyfile(corpus, working_copy)
+
+    # db.py picks its database when it's first imported
+    if "db" in sys.modules:
+        raise RuntimeError("the database benchmarks must run before db.py is imported")
+    os.environ["DATABASE_URL"] = f"sqlite:///{working_copy}"
+
+    return workdir, working_copy
+
+
+def db_suite(args):
+    """
+    This function benchmarks the database writes and the recipe book queries over a
+    copy of the generated corpus
+    """
+
+    workdir, working_copy = use_corpus_copy(args.corpus_size, args.seed)
+
+    from flask import Flask, session
+
+    from app_model import (encode_cursor, list_titles, load_recipe,
+                           update_tables)
+    from shopping import build_shopping_list
+    from tags import find_tag_ids
+
+    app = Flask(__name__)
+    app.secret_key = "bench"
+    rng = random.Random(args.seed)
+    results = []
+
+    try:
+        with app.test_request_context():
+            session["user_id"] = user_id = 1
+
+            # Writing a newly scraped recipe
+            counter = iter(range(args.corpus_size, sys.maxsize))
+            results.append(measure("update_tables", lambda: update_tables(*corpus_recipe(rng, next(counter))),
+                                   args.repeat))
+
+            # The recipe book: its first page, a page halfway through, a search, and tag filters
+            rows, _ = list_titles(user_id, limit=args.corpus_size // 2)
+            middle = encode_cursor(rows[-1].title, rows[-1].id)
+            tag_ids = list(find_tag_ids(user_id, TAGS[:2]).values())
+            results.append(measure("list_titles/first_page", lambda: list_titles(user_id), args.repeat))
+            results.append(measure("list_titles/middle_page", lambda: list_titles(user_id, cursor=middle),
+                                   args.repeat))
+            results.append(measure("list_titles/search", lambda: list_titles(user_id, query="garlic lemon"),
+                                   args.repeat))
+            results.append(measure("list_titles/tags_any", lambda: list_titles(user_id, tag_ids=tag_ids),
+                                   args.repeat))
+            results.append(measure("list_titles/tags_all",
+                                   lambda: list_titles(user_id, tag_ids=tag_ids, match_all=True), args.repeat))
+
+            # Opening recipes, and a shopping list for a week's worth of them
+            title_ids = [row.id for row in rows]
+            results.append(measure("load_recipe", lambda: load_recipe(rng.choice(title_ids), user_id),
+                                   args.repeat))
+            results.append(measure("build_shopping_list",
+                                   lambda: build_shopping_list(rng.sample(title_ids, 7), user_id),
+                                   args.repeat, items=7))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def git_commit():
+    """
+    This function returns the commit being benchmarked, if this is a git checkout
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=BENCH_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, threshold):
+    """
+    This function prints how each stage's median moved since a baseline run, and returns
+    the names of the stages that got more than threshold (a fraction) slower
+    """
+
+    before = {result["stage"]: result for result in baseline["results"]}
+    regressions = []
+
+    print(f"\n{'stage':<40}{'base p50':>10}{'p50':>10}{'change':>9}")
+    for result in current["results"]:
+        old = before.get(result["stage"])
+        if old is None or not old["p50_ms"]:
+            continue
+        change = result["p50_ms"] / old["p50_ms"] - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(result["stage"])
+            flag = "  REGRESSION"
+        print(f"{result['stage']:<40}{old['p50_ms']:>10.2f}{result['p50_ms']:>10.2f}{change:>+9.0%}{flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scraping, OCR and database hot paths")
+    parser.add_argument("--suite", default=",".join(SUITES),
+                        help=f"comma separated suites to run, out of {', '.join(SUITES)}")
+    parser.add_argument("--repeat", type=int, default=50, help="runs per scraping and database stage")
+    parser.add_argument("--ocr-repeat", type=int, default=5, help="runs per OCR stage")
+    parser.add_argument("--cards", type=int, default=3, help="number of synthetic recipe cards")
+    parser.add_argument("--corpus-size", type=int, default=20000, help="recipes in the database corpus")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the generated cards and corpus")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against the results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown in a median (as a fraction) that counts as a regression")
+    args = parser.parse_args()
+
+    suites = [suite.strip() for suite in args.suite.split(",") if suite.strip()]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suite: {', '.join(sorted(unknown))}")
+
+    # The db suite goes first, since it has to choose the database before anything imports db.py
+    run_order = [suite for suite in ("db", "scrape", "ocr") if suite in suites]
+    functions = {"scrape": scrape_suite, "ocr": ocr_suite, "db": db_suite}
+
+    report = {"commit": git_commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "cpus": os.cpu_count(), "args": vars(args), "results": [], "max_rss_kib": {}}
+
+    print(f"{'stage':<40}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'items/s':>10}{'peak KiB':>10}")
+    for suite in run_order:
+        for result in functions[suite](args):
+            result["suite"] = suite
+            report["results"].append(result)
+            print(f"{result['stage']:<40}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                  f"{result['p99_ms']:>10.2f}{result['throughput_per_s'] or 0:>10.1f}{result['peak_kib']:>10.0f}")
+        report["max_rss_kib"][suite] = max_rss_kib()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
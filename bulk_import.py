@@ -0,0 +1,318 @@
+# This module imports a whole list of recipe urls at once, e.g. a user's library
+# migrated from another app.
+#
+# Pages are fetched concurrently over a bounded number of connections (see fetch.py),
+# parsed in parallel in a pool of worker processes, and written to the database in
+# batched transactions. Every url gets its own result, so one bad url doesn't sink the rest.
+#
+# import_urls_async does the same for the async routes (see asgi.py), with every page in
+# flight at once (up to RECIPE_IMPORT_ASYNC_CONCURRENCY) and the database reached through
+# the async engine.
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+import cache
+from app_model import find_titles_by_url, insert_recipes, link_titles
+from db import engine, get_async_engine
+from fetch import FetchError, fetch, fetch_async
+from metrics import record_stages, run_collected, stage
+from scrapers import scrape
+
+# Most urls accepted in a single import
+MAX_URLS = int(os.environ.get("RECIPE_IMPORT_MAX_URLS", 2000))
+
+# Number of pages fetched at the same time
+FETCH_CONCURRENCY = int(os.environ.get("RECIPE_IMPORT_CONCURRENCY", 16))
+
+# Number of pages fetched at the same time by an async import
+ASYNC_FETCH_CONCURRENCY = int(os.environ.get("RECIPE_IMPORT_ASYNC_CONCURRENCY", 200))
+
+# Number of processes parsing html
+PARSE_WORKERS = int(os.environ.get("RECIPE_IMPORT_PARSE_WORKERS", os.cpu_count() or 1))
+
+# Number of recipes written per transaction
+BATCH_SIZE = int(os.environ.get("RECIPE_IMPORT_BATCH_SIZE", 100))
+
+_parse_executor = None
+_lock = threading.Lock()
+
+
+def _get_parse_executor():
+    """
+    This function lazily starts the pool of html parsing processes
+    """
+
+    global _parse_executor
+    with _lock:
+        if _parse_executor is None:
+            _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=get_context("spawn"))
+    return _parse_executor
+
+
+def clean_urls(urls):
+    """
+    This function strips and de-duplicates a list of urls, keeping the order they came in
+    """
+
+    cleaned = []
+    seen = set()
+    for url in urls:
+        url = url.strip() if isinstance(url, str) else ""
+        if url and url not in seen:
+            seen.add(url)
+            cleaned.append(url)
+
+    return cleaned
+
+
+def _insert_one(recipe, user_id, result):
+    """
+    This function saves a single recipe, linking the existing copy instead if its url is
+    already in the database, and records the outcome in result
+    """
+
+    url = recipe[3]
+    try:
+        # insert_recipes retries a clash on the content hash itself, so a clash still
+        # there is on the url
+        title_id, status = insert_recipes([recipe], user_id)[0]
+        result.update(status=status, title_id=title_id)
+    except IntegrityError:
+        with engine.begin() as conn:
+            title_id = find_titles_by_url([url], conn).get(url)
+            if title_id is None:
+                result.update(status="error", error="we couldn't save that recipe")
+                return
+            added = link_titles([title_id], user_id, conn)
+        if added:
+            cache.invalidate_user(user_id)
+        result.update(status="linked" if added else "owned", title_id=title_id)
+    except SQLAlchemyError:
+        result.update(status="error", error="we couldn't save that recipe")
+
+
+def _start_results(urls):
+    """
+    This function cleans up a list of urls, and returns them along with a dictionary
+    holding the result of each, where anything that isn't a url is already an error
+    """
+
+    urls = clean_urls(urls)
+    results = {url: {"url": url, "status": None, "title_id": None, "error": None} for url in urls}
+
+    # Weed out anything that isn't a url
+    for url in urls:
+        if not url.startswith("http"):
+            results[url].update(status="error", error="not a url")
+    return [url for url in urls if results[url]["status"] is None], results
+
+
+def _record_existing(urls, results, existing, added):
+    """
+    This function records the results of the urls already in the database (existing maps
+    them to title ids, and added holds those just added to the user's library), and returns
+    the urls left to fetch
+    """
+
+    for url, title_id in existing.items():
+        results[url].update(status="linked" if title_id in added else "owned", title_id=title_id)
+    return [url for url in urls if url not in existing]
+
+
+def _parsed_recipe(recipe, url, results):
+    """
+    This function turns what scrape returned for a url into the tuple insert_recipes takes,
+    or records the error and returns None if no recipe was found
+    """
+
+    if recipe is None:
+        results[url].update(status="error", error="Unable to locate the required ingredients at the given url")
+        return None
+    recipe_title, ingredients_data, instructions_body = recipe
+    return recipe_title, instructions_body, ingredients_data, url
+
+
+def _record_saved(batch, saved, user_id, results):
+    """
+    This function records the results of a batch written by insert_recipes (saved holds its
+    (title id, status) pairs), once it's committed, and drops what's cached about it
+    """
+
+    cache.invalidate_user(user_id)
+    for recipe, (title_id, status) in zip(batch, saved):
+        if status == "imported":
+            cache.invalidate_recipe(title_id)
+        results[recipe[3]].update(status=status, title_id=title_id)
+
+
+def import_urls(urls, user_id):
+    """
+    This function imports each url into the user's library and returns a list with one
+    result per url: a dictionary holding the url, a status ("imported", "linked",
+    "owned" or "error"), the title id and, for errors, a message.
+
+    It runs outside of any request (as a background job, see jobs.py), so it opens its
+    own connections rather than using the request's
+    """
+
+    urls, results = _start_results(urls)
+
+    # Recipes already in the database don't need fetching, just a place in the user's library
+    with engine.begin() as conn:
+        existing = find_titles_by_url(urls, conn)
+        added = link_titles(existing.values(), user_id, conn)
+    if added:
+        cache.invalidate_user(user_id)
+    urls = _record_existing(urls, results, existing, added)
+
+    # Fetch the rest concurrently, handing each page off to be parsed as soon as it arrives
+    def fetch_one(url):
+        try:
+            return fetch(url)
+        except FetchError as e:
+            results[url].update(status="error", error=str(e))
+            return None
+
+    parse_executor = _get_parse_executor()
+    parsed = {}
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as fetch_executor:
+        for url, html in zip(urls, fetch_executor.map(fetch_one, urls)):
+            if html is not None:
+                parsed[url] = parse_executor.submit(run_collected, scrape, html, url)
+
+    # Gather the parsed recipes
+    recipes = []
+    for url, future in parsed.items():
+        try:
+            recipe, timings = future.result()
+            record_stages(timings)
+        except Exception:
+            recipe = None
+        recipe = _parsed_recipe(recipe, url, results)
+        if recipe is not None:
+            recipes.append(recipe)
+
+    # Write them to the database, a batch per transaction
+    for i in range(0, len(recipes), BATCH_SIZE):
+        batch = recipes[i: i + BATCH_SIZE]
+        try:
+            with stage("db_write"), engine.begin() as conn:
+                saved = insert_recipes(batch, user_id, conn)
+        except IntegrityError:
+            # Some url in the batch was imported by someone else in the meantime,
+            # so fall back to saving the recipes one at a time
+            for recipe in batch:
+                _insert_one(recipe, user_id, results[recipe[3]])
+            continue
+        except SQLAlchemyError:
+            for recipe in batch:
+                results[recipe[3]].update(status="error", error="we couldn't save that recipe")
+            continue
+
+        # Only once the batch is committed, drop what's cached about it
+        _record_saved(batch, saved, user_id, results)
+
+    return list(results.values())
+
+
+async def _insert_one_async(engine, recipe, user_id, result):
+    """
+    This function is _insert_one, through the async engine
+    """
+
+    url = recipe[3]
+    try:
+        # As in insert_recipes, if someone else stores the same content at the same time, the
+        # second try links their copy. A clash that's still there is on the url
+        for attempt in range(2):
+            try:
+                async with engine.begin() as conn:
+                    title_id, status = (await conn.run_sync(
+                        lambda sync_conn: insert_recipes([recipe], user_id, sync_conn)))[0]
+                break
+            except IntegrityError:
+                if attempt:
+                    raise
+        cache.invalidate_user(user_id)
+        if status == "imported":
+            cache.invalidate_recipe(title_id)
+        result.update(status=status, title_id=title_id)
+    except IntegrityError:
+        async with engine.begin() as conn:
+            title_id = (await conn.run_sync(lambda sync_conn: find_titles_by_url([url], sync_conn))).get(url)
+            if title_id is None:
+                result.update(status="error", error="we couldn't save that recipe")
+                return
+            added = await conn.run_sync(lambda sync_conn: link_titles([title_id], user_id, sync_conn))
+        if added:
+            cache.invalidate_user(user_id)
+        result.update(status="linked" if added else "owned", title_id=title_id)
+    except SQLAlchemyError:
+        result.update(status="error", error="we couldn't save that recipe")
+
+
+async def import_urls_async(urls, user_id):
+    """
+    This function is import_urls for the async routes: it returns the same results, but
+    never blocks the event loop waiting on a site or the database, so one worker can have
+    many imports in flight
+    """
+
+    urls, results = _start_results(urls)
+    engine = get_async_engine()
+
+    # Recipes already in the database don't need fetching, just a place in the user's library
+    async with engine.begin() as conn:
+        existing = await conn.run_sync(lambda sync_conn: find_titles_by_url(urls, sync_conn))
+        added = await conn.run_sync(lambda sync_conn: link_titles(existing.values(), user_id, sync_conn))
+    if added:
+        cache.invalidate_user(user_id)
+    urls = _record_existing(urls, results, existing, added)
+
+    # Fetch the rest concurrently, handing each page off to be parsed as soon as it arrives
+    loop = asyncio.get_running_loop()
+    parse_executor = _get_parse_executor()
+    fetch_slots = asyncio.Semaphore(ASYNC_FETCH_CONCURRENCY)
+
+    async def fetch_and_parse(url):
+        async with fetch_slots:
+            try:
+                html = await fetch_async(url)
+            except FetchError as e:
+                results[url].update(status="error", error=str(e))
+                return None
+        try:
+            recipe, timings = await loop.run_in_executor(parse_executor, run_collected, scrape, html, url)
+            record_stages(timings)
+        except Exception:
+            recipe = None
+        return _parsed_recipe(recipe, url, results)
+
+    recipes = [recipe for recipe in await asyncio.gather(*map(fetch_and_parse, urls)) if recipe is not None]
+
+    # Write them to the database, a batch per transaction
+    for i in range(0, len(recipes), BATCH_SIZE):
+        batch = recipes[i: i + BATCH_SIZE]
+        try:
+            with stage("db_write"):
+                async with engine.begin() as conn:
+                    saved = await conn.run_sync(lambda sync_conn: insert_recipes(batch, user_id, sync_conn))
+        except IntegrityError:
+            for recipe in batch:
+                await _insert_one_async(engine, recipe, user_id, results[recipe[3]])
+            continue
+        except SQLAlchemyError:
+            for recipe in batch:
+                results[recipe[3]].update(status="error", error="we couldn't save that recipe")
+            continue
+
+        # Only once the batch is committed, drop what's cached about it
+        _record_saved(batch, saved, user_id, results)
+
+    return list(results.values())
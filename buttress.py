@@ -1,6 +1,10 @@
-import glob
+import hashlib
+import json
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from tempfile import mkdtemp
 
 import cv2
 import numpy as np
@@ -8,6 +12,34 @@ import pytesseract
 from flask import redirect, render_template, session
 from pytesseract import Output
 
+from metrics import stage
+from structure import MIN_CONFIDENCE, block_confidence, data_to_lines
+
+# Number of worker processes running the OCR pipeline (see jobs.py), and the number of
+# regions each of them OCRs at the same time in extract_blocks. Every region is its own
+# tesseract process, so by default the cores are shared out between the workers rather
+# than each one starting a tesseract per core
+OCR_WORKERS = int(os.environ.get("RECIPE_OCR_WORKERS", os.cpu_count() or 1))
+OCR_THREADS = int(os.environ.get("RECIPE_OCR_THREADS", max(1, (os.cpu_count() or 1) // max(1, OCR_WORKERS))))
+
+# Longest side, in pixels, of the copy of an image its layout is worked out on. Finding
+# the card, its tilt and its blocks of text doesn't need every pixel of a 12MP photo, so
+# only the crops are processed at full resolution. 0 works on the full image throughout
+ANALYSIS_SIZE = int(os.environ.get("RECIPE_OCR_ANALYSIS_SIZE", 1600))
+
+# Regions smaller than this on either side aren't OCRed, nor are those whose share of
+# dark pixels is outside [MIN_INK, MAX_INK]
+MIN_REGION_SIDE = 40
+MIN_INK = 0.01
+MAX_INK = 0.5
+
+# If set, parse_image dumps the regions it finds into a fresh subdirectory of this directory
+OCR_DEBUG_DIR = os.environ.get("RECIPE_OCR_DEBUG_DIR")
+
+# Keep each tesseract process to a single thread, since we're already running as many of
+# them as there are cores. Tesseract inherits this from the environment it's started with
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 
 def check_extension(extension):
     """
@@ -20,6 +52,40 @@ def check_extension(extension):
         return True
 
 
+def decode_image(data):
+    """
+    This function decodes the bytes of an uploaded image straight into an image array,
+    without writing the upload to disk. Returns None if the bytes aren't an image opencv can read
+    """
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if not buffer.size:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def analysis_scale(shape):
+    """
+    This function returns the factor an image of the given shape is scaled by to find its
+    layout: small enough that its longest side is at most ANALYSIS_SIZE, or 1 to leave it be
+    """
+
+    longest = max(shape[:2])
+    if not ANALYSIS_SIZE or longest <= ANALYSIS_SIZE:
+        return 1.0
+    return ANALYSIS_SIZE / longest
+
+
+def downscale(image, scale):
+    """
+    This function shrinks an image by a factor (area averaging, so thin strokes aren't lost)
+    """
+
+    if scale >= 1:
+        return image
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
 def image_preprocessing(image):
     """
     This function prepares the image for OCR with the following steps:
@@ -33,6 +99,9 @@ def image_preprocessing(image):
 
     Then returns the final dilated image
 
+    The rotation and crop are worked out on a copy no larger than ANALYSIS_SIZE, and only
+    the cropped card is rotated and cleaned up at full resolution
+
     Largely based on, "Python Tutorials for Digital Humanities," 
     https://www.youtube.com/watch?v=ADV-AjAXHdc&t=1337
     https://www.youtube.com/watch?v=9FCw1xo_s0I&list=PL2VXyKi-KpYuTAZz__9KVl1jQz74bDG7i&index=8
@@ -52,36 +121,53 @@ def image_preprocessing(image):
     # Binarize the image            
     thresh, im_bw = cv2.threshold(gray_image, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
 
-    # Rotate the image
-    # specifically drawn from https://www.pyimagesearch.com/2017/02/20/text-skew-correction-opencv-python/
-    def rotate_image(image, contour):
-        rect = cv2.minAreaRect(contour)
-        box = cv2.boxPoints(rect)
-        box = np.int0(box)
-        cv2.drawContours(image,[box],0,(0,0,255),2)
-
-        angle = -(rect[-1])
-        if angle < -45:
-            angle = -(90 + angle)
-        else:
-            angle = -angle
-
-        (h, w) = image.shape[:2]
-        center = (w // 2, h // 2)
-        M = cv2.getRotationMatrix2D(center, angle, 1.0)
-        image = cv2.warpAffine(image, M, (w, h),
-            flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-        return image
-
-    contours, hierarchy = cv2.findContours(im_bw, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(contours, key=lambda x: cv2.contourArea(x))
-    rotated = rotate_image(im_bw, contours[-1])
+    # Finding the card (and how far it's turned) only needs its outline, so large photos are
+    # analyzed at a smaller size, binarized with the same threshold
+    scale = analysis_scale(im_bw.shape)
+    if scale < 1:
+        small_bw = cv2.threshold(downscale(gray_image, scale), thresh, 255, cv2.THRESH_BINARY)[1]
+    else:
+        small_bw = im_bw
 
-    # Crop the image
-    contours, hierarchy = cv2.findContours(rotated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(contours, key=lambda x: cv2.contourArea(x))
-    x, y, w, h = cv2.boundingRect(contours[-1])
-    cropped = rotated[y: y + h, x: x + w]
+    # Find the angle to rotate the image by
+    # specifically drawn from https://www.pyimagesearch.com/2017/02/20/text-skew-correction-opencv-python/
+    # The card is the largest contour, which is always an outer one, so the inner ones aren't needed
+    contours, hierarchy = cv2.findContours(small_bw, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rect = cv2.minAreaRect(max(contours, key=cv2.contourArea))
+
+    # Outline the card, at both sizes
+    box = cv2.boxPoints(rect)
+    cv2.drawContours(im_bw, [np.intp(box / scale)], 0, 0, 2)
+    if scale < 1:
+        cv2.drawContours(small_bw, [np.intp(box)], 0, 0, 1)
+
+    angle = -(rect[-1])
+    if angle < -45:
+        angle = -(90 + angle)
+    else:
+        angle = -angle
+
+    # Rotate the small copy, and find the card's bounding box on it
+    (h, w) = small_bw.shape[:2]
+    M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
+    rotated = cv2.warpAffine(small_bw, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    contours, hierarchy = cv2.findContours(rotated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+
+    # Map the box back to full resolution, with a margin for the rounding
+    (full_h, full_w) = im_bw.shape[:2]
+    pad = math.ceil(1 / scale) + 1 if scale < 1 else 0
+    x0 = max(0, math.floor(x / scale) - pad)
+    y0 = max(0, math.floor(y / scale) - pad)
+    x1 = min(full_w, math.ceil((x + w) / scale) + pad)
+    y1 = min(full_h, math.ceil((y + h) / scale) + pad)
+
+    # Rotate and crop the image in one go, at full resolution: the same rotation as turning
+    # the whole image, shifted so only the crop is computed
+    M = cv2.getRotationMatrix2D((full_w // 2, full_h // 2), angle, 1.0)
+    M[:, 2] -= (x0, y0)
+    cropped = cv2.warpAffine(im_bw, M, (x1 - x0, y1 - y0),
+                             flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
 
     # Remove noise from the image 
     def noise_removal(image):
@@ -120,89 +206,132 @@ def parse_image(image):
     # can separate out chunks of text
     # Based on Python Tutorials for Digital Humanities: 
     # https://www.youtube.com/watch?v=9FCw1xo_s0I&t=995s
-    blur = cv2.GaussianBlur(image, (7, 7), 0)
+    # Large images are analyzed at a smaller size, with the blur and kernel scaled to match
+    scale = analysis_scale(image.shape)
+    small = downscale(image, scale)
+    blur_size = max(1, round(7 * scale)) | 1
+    blur = cv2.GaussianBlur(small, (blur_size, blur_size), 0)
     invert = cv2.bitwise_not(blur)
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (10, 50))
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(1, round(10 * scale)), max(1, round(50 * scale))))
     over_dilate = cv2.dilate(invert, kernel, iterations=3)
 
-    # Identify the larger blocks of text (this is the structural analysis part), 
-    # crop out those blocks, and save them to disk -- each with their own file 
+    # Identify the larger blocks of text (this is the structural analysis part),
+    # and crop out those blocks at full resolution. The crops are views into the image, not copies
     image_arrays = []
+    (full_h, full_w) = image.shape[:2]
     contours, hierarchy = cv2.findContours(over_dilate, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     for i, c in enumerate(contours):
         x, y, w, h = cv2.boundingRect(c)
-        if h > 200:
-            roi_image = image[y: y + h, x: x + w]
-            filename = f"roi{i}.jpg"
-            cv2.imwrite(filename, roi_image) 
-            image_arrays.append(cv2.imread(filename))
+        x0, y0 = math.floor(x / scale), math.floor(y / scale)
+        x1, y1 = min(full_w, math.ceil((x + w) / scale)), min(full_h, math.ceil((y + h) / scale))
+        if y1 - y0 > 200:
+            image_arrays.append(image[y0: y1, x0: x1])
+
+    # Optionally write the regions to disk, so we can see what tesseract was given
+    if OCR_DEBUG_DIR:
+        dump_regions(image_arrays)
 
     return image_arrays
 
 
-def extract_strings(newfiles):
+def dump_regions(image_arrays):
     """
-    This function takes a list of image arrays, then converts those images to strings. The
-    function then returns a list of those strings.
+    This function writes each region to its own png file in a new directory under
+    OCR_DEBUG_DIR, and returns the path of that directory
     """
 
-    # Declare an empty string list we can fill with the OCRed text
-    string_list = []
+    os.makedirs(OCR_DEBUG_DIR, exist_ok=True)
+    debug_dir = mkdtemp(prefix="regions-", dir=OCR_DEBUG_DIR)
+    for i, roi_image in enumerate(image_arrays):
+        cv2.imwrite(os.path.join(debug_dir, f"roi{i}.png"), roi_image)
 
-    # Declare variable to hold the total sum of confidence scores in 'data' (see below)
-    conf_sum = 0
+    return debug_dir
 
-    # Go through each element in the list of images passed in as an argument
-    for j in range(len(newfiles)):
 
-        # Flags passed to tesseract
-        # --psm 4 --> Assume a single column of text of variable sizes.
-        # --oem 1 --> Neural nets LSTM engine only.
-        config = r"--psm 11 --oem 1"
+def worth_reading(image):
+    """
+    This function cheaply weeds out regions that can't hold useful text before they're sent
+    to tesseract: slivers (rules and borders), near blank regions, and ones too dark to be
+    text on paper (photos, shadows)
+    """
 
-        # Convert image to string and extract dictionary of pertinent data (in 'data') so we can access the confidence score
-        # Check out Murtaza's Workshop - Robotics and AI (https://youtu.be/6DjFscX4I_c) for an brief explanation of
-        # confidence scores
-        text = pytesseract.image_to_string(newfiles[j], config=config)
-        data = pytesseract.image_to_data(newfiles[j], config=config, output_type=Output.DICT)
+    (h, w) = image.shape[:2]
+    if h < MIN_REGION_SIDE or w < MIN_REGION_SIDE or w > 20 * h or h > 20 * w:
+        return False
 
-        # Check for keywords that tell us this is relevant text
-        # TODO use different --psm for different types of input (ingredient's list vs. instructions)
-        if "ingredients" in text.lower() or "prepare" in text.lower() or "medium" \
-            in text.lower() or "salt" in text.lower():
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    ink = cv2.countNonZero(cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY_INV)[1]) / (h * w)
+    return MIN_INK <= ink <= MAX_INK
 
-            # Calculate the average confidence score for this OCR output
-            for i in range(len(data["conf"])):
-                conf_sum += int(data["conf"][i])
-            conf_avg = conf_sum / len(data["conf"])
-            
-            # Check to make sure the average confidence score meets the minimum requirement
-            if conf_avg < 50:
-                print(text)
-                print(conf_avg)
-                print("^")
-                continue
-            
-            # If it meets requirement, add it to our list of strings.
-            else:
-                print(text)
-                print(conf_avg)
-                print("^^^")
-                conf_sum = 0
-                string_list.append(text)
- 
-    return string_list
 
+def ocr_region(image):
+    """
+    This function runs a single tesseract pass over one image and returns its lines of
+    text, with their layout (see data_to_lines in structure.py), along with the average
+    confidence score of the pass
+    """
+
+    # Flags passed to tesseract
+    # --psm 4 --> A single column of text of variable sizes. Each region is already one
+    #             block of text, and this keeps its lines in order along with their sizes
+    # --oem 1 --> Neural nets LSTM engine only.
+    config = r"--psm 4 --oem 1"
+
+    # Extract dictionary of pertinent data (in 'data'), from which we get the text, its layout and
+    # the confidence score. Check out Murtaza's Workshop - Robotics and AI (https://youtu.be/6DjFscX4I_c)
+    # for an brief explanation of confidence scores
+    with stage("ocr_region"):
+        data = pytesseract.image_to_data(image, config=config, output_type=Output.DICT)
+    lines = data_to_lines(data)
+
+    return lines, block_confidence(lines)
+
+
+def extract_blocks(newfiles):
+    """
+    This function takes a list of image arrays, then OCRs them into blocks of lines (see
+    structure.py). The function then returns a list of those blocks, along with a list of
+    their confidence scores.
+
+    Regions that can't hold useful text are dropped before OCR, and blocks tesseract isn't
+    confident about after it. Each tesseract run is its own process, so the images are
+    OCRed on a thread pool of OCR_THREADS threads. Results come back in the order of the
+    images passed in.
+    """
+
+    block_list = []
+    conf_list = []
+
+    # Skip the regions not worth the time tesseract would spend on them
+    newfiles = [image for image in newfiles if worth_reading(image)]
+    if not newfiles:
+        return block_list, conf_list
+
+    # OCR every image, in parallel. map() hands the results back in input order,
+    # so the output doesn't depend on which region finishes first
+    workers = min(OCR_THREADS, len(newfiles))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(ocr_region, newfiles))
+
+    for lines, conf_avg in results:
+
+        # Check to make sure the average confidence score meets the minimum requirement
+        if not lines or conf_avg < MIN_CONFIDENCE:
+            continue
+
+        block_list.append(lines)
+        conf_list.append(conf_avg)
 
-def html_to_string(recipe_part):
+    return block_list, conf_list
+
+
+def recipe_etag(recipe):
     """
-    This function changes the html elements -- in a given list -- to clean strings
-    e.g. <li>List Item</li> --> "List Item"
+    This function returns an ETag for a recipe: a hash of everything shown on its page
     """
 
-    for i in range(len(recipe_part)):
-        recipe_part[i] = recipe_part[i].string.strip()
-    return recipe_part
+    payload = json.dumps(recipe, sort_keys=True).encode()
+    return hashlib.sha1(payload).hexdigest()
 
 
 def login_required(f):
@@ -219,18 +348,6 @@ def login_required(f):
     return decorated_function
 
 
-def remove_files():
-    """
-    This function removes the jpeg files generated in by 
-    parse_image() (above) and image.save (in app.py)
-    """
-
-    filelist = glob.glob("*.jpg")
-    for filename in filelist:
-        os.remove(filename)
-    return True
-
-
 def report_error(message):
     """
     Sends an error message (passed from app.py) to the user
@@ -0,0 +1,239 @@
+# This module caches what the app reads far more often than it writes: the rendered body of
+# each recipe page, and the pages of each user's recipe book.
+#
+# Entries live in a bounded in-process LRU. If RECIPE_CACHE_URL points at a redis server
+# (redis://host:6379/0, needs the redis package), entries are shared through it as well, so
+# every worker process benefits from a page any of them rendered. memory:// stands in for
+# that shared store inside the process, for development and tests.
+#
+# Nothing is ever updated in place. Each key includes a generation number for what it depends
+# on (a user's library, or a recipe), and writes bump the generation (see invalidate_user and
+# invalidate_recipe), so stale entries are simply never read again and age out of the LRU.
+#
+# Without a shared store, generations are kept per process, and a write in one worker can't
+# reach the others. A worker sees its own writes straight away, but values that change (a
+# user's recipe book pages) are only trusted for RECIPE_CACHE_LOCAL_TTL seconds, which bounds
+# how stale another worker's copy can be. Recipe bodies never change, and get the full TTL.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# The shared store, if any: redis://... or memory://
+CACHE_URL = os.environ.get("RECIPE_CACHE_URL")
+
+# Most entries kept in this process, and seconds an entry is trusted for
+CACHE_SIZE = int(os.environ.get("RECIPE_CACHE_SIZE", 2048))
+CACHE_TTL = int(os.environ.get("RECIPE_CACHE_TTL", 300))
+
+# Seconds a value that changes is trusted for when there's no shared store, as other
+# processes' writes can't invalidate it
+CACHE_LOCAL_TTL = int(os.environ.get("RECIPE_CACHE_LOCAL_TTL", 10))
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe least recently used cache whose entries expire after a number of seconds
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class MemoryBackend:
+    """
+    An in-process stand-in for the shared store, with the same interface as RedisBackend
+    """
+
+    def __init__(self):
+        self.values = LRUCache(CACHE_SIZE)
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ttl):
+        self.values.set(key, value, ttl)
+
+    def counter(self, key):
+        with self.lock:
+            return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+
+class RedisBackend:
+    """
+    The shared store, kept in redis. Values are JSON strings
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("RECIPE_CACHE_URL points at redis, but the redis package isn't installed")
+        self.client = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=ttl)
+
+    def counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+def make_backend(url):
+    """
+    This function returns the shared store for a url, or None to keep the cache in-process only
+    """
+
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise RuntimeError(f"unsupported RECIPE_CACHE_URL: {url}")
+
+
+_local = LRUCache(CACHE_SIZE)
+_shared = make_backend(CACHE_URL)
+_generations = MemoryBackend()
+
+# The cache is an optimization, so a shared store that's down means a miss, not an error
+_backend_errors = (redis.RedisError,) if redis is not None else ()
+
+
+def _generation_store():
+    """
+    This function returns where generation numbers are kept: the shared store if there is
+    one, so a write in one process is seen by all of them
+    """
+
+    return _shared if _shared is not None else _generations
+
+
+def generation(scope):
+    """
+    This function returns the current generation of a scope, e.g. "user:1" or "title:7"
+    """
+
+    try:
+        return _generation_store().counter(f"gen:{scope}")
+    except _backend_errors:
+        return None
+
+
+def invalidate(scope):
+    """
+    This function bumps the generation of a scope, so everything cached under it is dropped
+    """
+
+    try:
+        _generation_store().incr(f"gen:{scope}")
+    except _backend_errors:
+        pass
+
+
+def invalidate_user(user_id):
+    """
+    This function drops everything cached about a user's library (call it after the
+    write has been committed, so the next read sees it)
+    """
+
+    invalidate(f"user:{user_id}")
+
+
+def invalidate_recipe(title_id):
+    """
+    This function drops the cached page of a recipe
+    """
+
+    invalidate(f"title:{title_id}")
+
+
+def get_or_set(scope, key, compute, ttl=CACHE_TTL, changes=False):
+    """
+    This function returns the value cached for a key under a scope, or computes it with
+    compute(), caches it and returns it. Values must survive a trip through JSON. A computed
+    value of None isn't cached.
+
+    Values that change when the scope is invalidated must say so with changes: without a
+    shared store, other processes don't see the invalidation, so they're only kept for
+    CACHE_LOCAL_TTL seconds
+    """
+
+    if changes and _shared is None:
+        ttl = min(ttl, CACHE_LOCAL_TTL)
+
+    gen = generation(scope)
+    if gen is None:
+        return compute()
+    full_key = f"{scope}:{gen}:{key}"
+
+    value = _local.get(full_key)
+    if value is not None:
+        return value
+
+    if _shared is not None:
+        try:
+            cached = _shared.get(full_key)
+        except _backend_errors:
+            cached = None
+        if cached is not None:
+            value = json.loads(cached)
+            _local.set(full_key, value, ttl)
+            return value
+
+    value = compute()
+    if value is None:
+        return None
+
+    _local.set(full_key, value, ttl)
+    if _shared is not None:
+        try:
+            _shared.set(full_key, json.dumps(value), ttl)
+        except _backend_errors:
+            pass
+
+    return value
@@ -0,0 +1,135 @@
+# This module packs a recipe's ingredients and instructions into a single compressed blob,
+# kept in the recipe_blobs table (one row per recipe, keyed by title id), so a recipe page
+# is read with one primary key lookup instead of a scan of its ingredient and instruction rows.
+#
+# A blob is a one byte header naming the codec, followed by the compressed JSON of
+# [ingredients, instructions]. RECIPE_BLOB_CODEC picks the codec new blobs are written with:
+#   zlib (the default) - in the standard library, so any node can read the blobs
+#   zstd               - smaller and faster, but needs the zstandard package on every node
+#                        that reads the database (e.g. one an export is imported into)
+# Blobs written with either are read back whatever the setting.
+#
+# RECIPE_STORAGE picks what else is kept:
+#   rows (the default) - the blob, plus a row per ingredient and instruction, as before
+#   compact            - the blob, plus a row per ingredient (shopping lists are built
+#                        from those), but no instruction rows. Searches then find words in
+#                        instructions only through the full-text index (SQLite with FTS5)
+#
+# Each recipe's content is also fingerprinted (see content_hash), so the same recipe
+# imported twice -- e.g. the same card scanned by many users -- is only stored once.
+#
+# A database switched to compact can drop the instruction rows it already has with
+#
+#     python compact.py --drop-instruction-rows [database url]
+
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+from sqlalchemy import create_engine, text
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STORAGE = os.environ.get("RECIPE_STORAGE", "rows")
+if STORAGE not in ("rows", "compact"):
+    raise RuntimeError(f"unknown RECIPE_STORAGE: {STORAGE} (expected rows or compact)")
+
+# The header byte of each codec
+ZSTD = b"Z"
+ZLIB = b"D"
+
+BLOB_CODEC = os.environ.get("RECIPE_BLOB_CODEC", "zlib")
+if BLOB_CODEC not in ("zlib", "zstd"):
+    raise RuntimeError(f"unknown RECIPE_BLOB_CODEC: {BLOB_CODEC} (expected zlib or zstd)")
+if BLOB_CODEC == "zstd" and zstandard is None:
+    raise RuntimeError("RECIPE_BLOB_CODEC is zstd, but the zstandard package isn't installed")
+
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+
+def keep_instruction_rows():
+    """
+    This function checks whether instructions are also written a row each
+    """
+
+    return STORAGE == "rows"
+
+
+def pack_recipe(ingredients_list, instructions_body, codec=None):
+    """
+    This function packs a recipe's ingredients and instructions (each a list of strings,
+    in order) into a blob, with the configured codec unless given another
+    """
+
+    codec = codec or (ZSTD if BLOB_CODEC == "zstd" else ZLIB)
+    data = json.dumps([ingredients_list, instructions_body], separators=(",", ":"),
+                      ensure_ascii=False).encode("utf-8")
+
+    if codec == ZSTD:
+        return ZSTD + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return ZLIB + zlib.compress(data, ZLIB_LEVEL)
+
+
+def unpack_recipe(blob):
+    """
+    This function unpacks a blob made by pack_recipe, returning the ingredients and the instructions
+    """
+
+    blob = bytes(blob)
+    codec, payload = blob[:1], blob[1:]
+
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("this recipe was packed with zstd, but the zstandard package isn't installed")
+        data = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == ZLIB:
+        data = zlib.decompress(payload)
+    else:
+        raise ValueError(f"unknown recipe blob codec: {codec!r}")
+
+    ingredients_list, instructions_body = json.loads(data)
+    return ingredients_list, instructions_body
+
+
+def content_hash(title, ingredients_list, instructions_body):
+    """
+    This function returns a fingerprint of a recipe's content (its cleaned up title,
+    ingredients and instructions), which is the same for two copies of a recipe however
+    their case and spacing differ
+    """
+
+    def normalize(line):
+        return " ".join(line.lower().split())
+
+    content = [normalize(title or ""), [normalize(line) for line in ingredients_list],
+               [normalize(line) for line in instructions_body]]
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def drop_instruction_rows(conn):
+    """
+    This function deletes the instruction rows of every recipe that has a blob, and returns
+    how many were deleted
+    """
+
+    result = conn.execute(text("DELETE FROM instructions WHERE title_id IN (SELECT title_id FROM recipe_blobs)"))
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    # Usage: python compact.py --drop-instruction-rows [database url]
+    if len(sys.argv) < 2 or sys.argv[1] != "--drop-instruction-rows":
+        sys.exit("usage: python compact.py --drop-instruction-rows [database url]")
+
+    from migrations import migrate
+
+    engine = create_engine(sys.argv[2] if len(sys.argv) > 2 else "sqlite:///recipe.db", future=True)
+    migrate(engine)
+    with engine.begin() as conn:
+        print(f"dropped {drop_instruction_rows(conn)} instruction rows")
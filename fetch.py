@@ -0,0 +1,369 @@
+# This module fetches recipe pages for URL imports.
+#
+# All requests go through one pooled session, with connect/read timeouts and a cap on
+# the size of the page, so a slow or huge site can't tie up a worker. Pages are kept in
+# an on-disk cache: within RECIPE_HTTP_CACHE_TTL seconds a re-import doesn't touch the
+# network at all, and after that the page is revalidated with its ETag/Last-Modified,
+# so an unchanged page costs a 304. The cache is bounded: entries not refreshed within
+# RECIPE_HTTP_CACHE_MAX_AGE seconds are deleted, and so are the ones fetched longest ago
+# once it takes more than RECIPE_HTTP_CACHE_MAX_BYTES on disk.
+#
+# fetch_async does the same with httpx, for the async import routes (see asgi.py): there,
+# hundreds of pages can be in flight at once without a thread each.
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from metrics import stage
+
+# Seconds to wait for a connection, and then between bytes of the response
+CONNECT_TIMEOUT = float(os.environ.get("RECIPE_HTTP_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.environ.get("RECIPE_HTTP_READ_TIMEOUT", 10))
+
+# Largest page we're willing to download
+MAX_BODY_SIZE = int(os.environ.get("RECIPE_HTTP_MAX_BODY_SIZE", 5 * 1024 * 1024))
+
+# Number of connections kept open per host
+POOL_SIZE = int(os.environ.get("RECIPE_HTTP_POOL_SIZE", 16))
+
+# Most connections open at once across all hosts, for async fetches
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("RECIPE_HTTP_ASYNC_MAX_CONNECTIONS", 200))
+
+# Where cached pages are kept, and for how many seconds they're served without revalidating
+CACHE_DIR = os.environ.get("RECIPE_HTTP_CACHE_DIR", ".http_cache")
+CACHE_TTL = int(os.environ.get("RECIPE_HTTP_CACHE_TTL", 24 * 60 * 60))
+
+# Most bytes the cache may take on disk, and seconds an entry is kept without being refreshed
+CACHE_MAX_BYTES = int(os.environ.get("RECIPE_HTTP_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+CACHE_MAX_AGE = int(os.environ.get("RECIPE_HTTP_CACHE_MAX_AGE", 7 * 24 * 60 * 60))
+
+# Seconds between sweeps of the cache, per process. A process that has written a tenth of
+# CACHE_MAX_BYTES since its last sweep (e.g. during a bulk import) sweeps straight away
+CACHE_PRUNE_INTERVAL = 60
+
+USER_AGENT = "recipe/1.0 (+https://github.com/seanlally8/recipe)"
+
+
+class FetchError(Exception):
+    """
+    Raised when a page can't be fetched. The message is fit to show the user
+    """
+
+
+def _make_session():
+    """
+    This function creates the session shared by every fetch, so connections
+    (and TLS handshakes) are reused across imports
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+http = _make_session()
+_async_http = None
+
+_prune_lock = threading.Lock()
+_last_prune = 0.0
+_written_since_prune = 0
+
+
+def _get_async_client():
+    """
+    This function lazily creates the httpx client shared by every async fetch
+    """
+
+    global _async_http
+    if httpx is None:
+        raise RuntimeError("async fetches need the httpx package")
+    if _async_http is None:
+        _async_http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=POOL_SIZE),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            headers={"User-Agent": USER_AGENT},
+            follow_redirects=True)
+    return _async_http
+
+
+async def close_async_client():
+    """
+    This function closes the async httpx client, if one was created
+    """
+
+    global _async_http
+    if _async_http is not None:
+        await _async_http.aclose()
+        _async_http = None
+
+
+def _cache_path(url):
+    """
+    This function returns the file a url is cached in
+    """
+
+    return os.path.join(CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+
+def _read_cache(url):
+    """
+    This function returns the cache entry for a url, or None if there isn't one
+    """
+
+    try:
+        with open(_cache_path(url), encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Guard against (very unlikely) hash collisions
+    if entry.get("url") != url:
+        return None
+    return entry
+
+
+def _write_cache(entry):
+    """
+    This function writes a cache entry. The file is written aside and moved into place,
+    so a concurrent reader never sees half an entry
+    """
+
+    path = _cache_path(entry["url"])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        return
+
+    _maybe_prune(size)
+
+
+def _maybe_prune(size):
+    """
+    This function counts the bytes just written to the cache, and sweeps it if it's been
+    CACHE_PRUNE_INTERVAL seconds since the last sweep, or a tenth of CACHE_MAX_BYTES
+    """
+
+    global _last_prune, _written_since_prune
+    now = time.monotonic()
+    with _prune_lock:
+        _written_since_prune += size
+        if now - _last_prune < CACHE_PRUNE_INTERVAL and _written_since_prune < CACHE_MAX_BYTES // 10:
+            return
+        _last_prune = now
+        _written_since_prune = 0
+
+    prune_cache()
+
+
+def prune_cache():
+    """
+    This function deletes the cache entries not refreshed within CACHE_MAX_AGE, then the
+    ones fetched longest ago until the cache fits in CACHE_MAX_BYTES. Returns how many
+    files it deleted
+    """
+
+    # Every file in the directory is ours, including temporary files left by a crash
+    files = []
+    try:
+        with os.scandir(CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return 0
+
+    # Oldest first: each entry's file is rewritten whenever the page is fetched or revalidated
+    files.sort()
+    total = sum(size for mtime, size, path in files)
+    cutoff = time.time() - CACHE_MAX_AGE
+
+    deleted = 0
+    for mtime, size, path in files:
+        if mtime >= cutoff and total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            deleted += 1
+        except OSError:
+            # Most likely another process got to it first
+            pass
+        total -= size
+
+    return deleted
+
+
+def _check_length(headers):
+    """
+    This function refuses a response whose declared length is larger than MAX_BODY_SIZE
+    """
+
+    length = headers.get("Content-Length")
+    if length and length.isdigit() and int(length) > MAX_BODY_SIZE:
+        raise FetchError("that page is too big to import")
+
+
+def _decode(body, headers):
+    """
+    This function decodes the body of a response to text
+    """
+
+    # Pages without a declared charset are nearly always utf-8 these days
+    encoding = "utf-8"
+    if "charset" in headers.get("Content-Type", "").lower():
+        encoding = requests.utils.get_encoding_from_headers(headers)
+
+    try:
+        return body.decode(encoding, errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+
+def _read_body(response):
+    """
+    This function downloads the body of a streamed response, giving up once it's
+    larger than MAX_BODY_SIZE
+    """
+
+    _check_length(response.headers)
+
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            raise FetchError("that page is too big to import")
+        chunks.append(chunk)
+
+    return _decode(b"".join(chunks), response.headers)
+
+
+async def _read_body_async(response):
+    """
+    This function is _read_body for an httpx response
+    """
+
+    _check_length(response.headers)
+
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes(chunk_size=64 * 1024):
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            raise FetchError("that page is too big to import")
+        chunks.append(chunk)
+
+    return _decode(b"".join(chunks), response.headers)
+
+
+def _revalidation_headers(entry):
+    """
+    This function returns the headers asking a site for a page only if it changed since
+    it was cached
+    """
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+@stage("fetch")
+def fetch(url):
+    """
+    This function returns the html of the page at url, from the cache if we can
+    """
+
+    entry = _read_cache(url)
+
+    # Fresh enough to use without asking the site
+    if entry is not None and time.time() - entry["fetched_at"] < CACHE_TTL:
+        return entry["text"]
+
+    # Otherwise ask the site, letting it answer 304 if the page hasn't changed
+    headers = _revalidation_headers(entry)
+
+    try:
+        with http.get(url, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=True) as response:
+            if response.status_code == 304 and entry is not None:
+                entry["fetched_at"] = time.time()
+                _write_cache(entry)
+                return entry["text"]
+
+            if response.status_code >= 400:
+                raise FetchError(f"that page returned an error ({response.status_code})")
+
+            text = _read_body(response)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except requests.Timeout:
+        raise FetchError("that site took too long to respond")
+    except requests.RequestException:
+        raise FetchError("we couldn't reach that site")
+
+    _write_cache({"url": url, "etag": etag, "last_modified": last_modified,
+                  "fetched_at": time.time(), "text": text})
+
+    return text
+
+
+async def fetch_async(url):
+    """
+    This function is fetch, without holding a thread while the site answers
+    """
+
+    with stage("fetch"):
+        entry = await asyncio.to_thread(_read_cache, url)
+
+        if entry is not None and time.time() - entry["fetched_at"] < CACHE_TTL:
+            return entry["text"]
+
+        headers = _revalidation_headers(entry)
+
+        try:
+            async with _get_async_client().stream("GET", url, headers=headers) as response:
+                if response.status_code == 304 and entry is not None:
+                    entry["fetched_at"] = time.time()
+                    await asyncio.to_thread(_write_cache, entry)
+                    return entry["text"]
+
+                if response.status_code >= 400:
+                    raise FetchError(f"that page returned an error ({response.status_code})")
+
+                text = await _read_body_async(response)
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except httpx.TimeoutException:
+            raise FetchError("that site took too long to respond")
+        except (httpx.HTTPError, httpx.InvalidURL):
+            raise FetchError("we couldn't reach that site")
+
+        await asyncio.to_thread(_write_cache, {"url": url, "etag": etag, "last_modified": last_modified,
+                                               "fetched_at": time.time(), "text": text})
+
+        return text
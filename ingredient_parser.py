@@ -0,0 +1,206 @@
+# This module parses ingredient lines, for the shopping lists built in shopping.py.
+#
+# Each ingredient line is parsed when it's saved (see insert_recipes in app_model.py) into
+# a quantity, a unit and the name of the food, e.g.
+#
+#     "1 1/2 cups shredded carrots, packed" --> (354.9, "ml", "carrot")
+#
+# Volumes are stored in millilitres and weights in grams, so "2 tbsp" of olive oil in one
+# recipe and "1/4 cup" in another add up. Everything else (cloves, cans, bare counts) is
+# stored in its own unit.
+#
+# Nothing here touches the database, so migrations can use it too.
+
+import re
+from fractions import Fraction
+
+# Unicode fraction characters, as plain text fractions
+VULGAR_FRACTIONS = {"½": " 1/2", "⅓": " 1/3", "⅔": " 2/3", "¼": " 1/4", "¾": " 3/4",
+                    "⅕": " 1/5", "⅛": " 1/8", "⅜": " 3/8", "⅝": " 5/8", "⅞": " 7/8", "⁄": "/"}
+
+# Volume units, in millilitres
+VOLUME_UNITS = {"tsp": 4.92892, "tbsp": 14.7868, "fl oz": 29.5735, "cup": 236.588,
+                "pint": 473.176, "quart": 946.353, "gallon": 3785.41, "ml": 1, "l": 1000}
+
+# Weight units, in grams
+WEIGHT_UNITS = {"oz": 28.3495, "lb": 453.592, "g": 1, "kg": 1000}
+
+# Every spelling of a unit we recognize, and the unit it stands for
+UNIT_ALIASES = {
+    "teaspoon": "tsp", "teaspoons": "tsp", "tsp": "tsp", "tsps": "tsp",
+    "tablespoon": "tbsp", "tablespoons": "tbsp", "tbsp": "tbsp", "tbsps": "tbsp", "tbs": "tbsp", "tbl": "tbsp",
+    "fluid ounce": "fl oz", "fluid ounces": "fl oz", "fl oz": "fl oz", "fl. oz": "fl oz",
+    "cup": "cup", "cups": "cup", "c": "cup",
+    "pint": "pint", "pints": "pint", "pt": "pint",
+    "quart": "quart", "quarts": "quart", "qt": "quart",
+    "gallon": "gallon", "gallons": "gallon", "gal": "gallon",
+    "milliliter": "ml", "milliliters": "ml", "millilitre": "ml", "millilitres": "ml", "ml": "ml",
+    "liter": "l", "liters": "l", "litre": "l", "litres": "l", "l": "l",
+    "ounce": "oz", "ounces": "oz", "oz": "oz",
+    "pound": "lb", "pounds": "lb", "lb": "lb", "lbs": "lb",
+    "gram": "g", "grams": "g", "g": "g",
+    "kilogram": "kg", "kilograms": "kg", "kg": "kg",
+    "clove": "clove", "cloves": "clove",
+    "can": "can", "cans": "can",
+    "package": "package", "packages": "package", "pkg": "package",
+    "bunch": "bunch", "bunches": "bunch",
+    "head": "head", "heads": "head",
+    "sprig": "sprig", "sprigs": "sprig",
+    "slice": "slice", "slices": "slice",
+    "stalk": "stalk", "stalks": "stalk",
+    "pinch": "pinch", "pinches": "pinch",
+    "dash": "dash", "dashes": "dash",
+    "handful": "handful", "handfuls": "handful",
+    "block": "block", "blocks": "block",
+}
+
+# A quantity at the start of a line: a mixed number, fraction or decimal, optionally a range
+NUMBER = r"(?:\d+\s+\d+/\d+|\d+/\d+|\d+(?:\.\d+)?|\.\d+)"
+QUANTITY = re.compile(rf"^\s*(?P<low>{NUMBER})(?:\s*(?:-|–|to)\s*(?P<high>{NUMBER}))?\s*")
+
+# A fraction over zero, e.g. an OCR misreading of "1/2", which isn't a quantity at all
+ZERO_DENOMINATOR = re.compile(r"/0+(?!\d)")
+
+# A unit right after the quantity (longest spellings first, so "fl oz" wins over "oz")
+UNIT = re.compile(r"^(?P<unit>" + "|".join(re.escape(alias) for alias in
+                                            sorted(UNIT_ALIASES, key=len, reverse=True))
+                  + r")\.?(?=\s|$)\s*(?:of\s+)?", re.IGNORECASE)
+
+# Words in a food name that are about preparation, not the food itself
+PREPARATION = re.compile(r"\b(?:finely|roughly|coarsely|thinly|freshly|chopped|minced|diced|sliced|"
+                         r"grated|shredded|peeled|rinsed|drained|divided|packed|softened|melted|"
+                         r"small|medium|large|to taste|optional)\b", re.IGNORECASE)
+
+# Lines that aren't ingredients at all (e.g. the heading of an OCRed list)
+NOT_FOOD = {"", "ingredients", "ingredient", "for full nutrition information see below"}
+
+
+def _number(text):
+    """
+    This function reads a number written as an integer, decimal, fraction or mixed number
+    """
+
+    parts = text.split()
+    return float(sum(Fraction(part) for part in parts))
+
+
+def singular(word):
+    """
+    This function makes a rough guess at the singular of an English food word
+    """
+
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith("oes"):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def normalize_food(text):
+    """
+    This function turns the rest of an ingredient line into the name of the food, so the
+    same food is spelled the same way across recipes
+    """
+
+    # Notes after a comma, and anything in parentheses, aren't part of the food
+    text = text.split(",")[0]
+    text = re.sub(r"\([^)]*\)", " ", text)
+    text = PREPARATION.sub(" ", text.lower())
+    words = re.findall(r"[a-z]+(?:['-][a-z]+)*", text)
+    if not words:
+        return ""
+
+    # Only the last word is the noun, e.g. "red onions" --> "red onion"
+    words[-1] = singular(words[-1])
+    return " ".join(words)
+
+
+def parse_ingredient(line):
+    """
+    This function splits an ingredient line into (quantity, unit, food). The quantity is
+    None when the line doesn't give one (e.g. "salt, to taste"). Volumes come back in
+    millilitres ("ml") and weights in grams ("g"); other units as their own name, and
+    bare counts with a unit of ""
+    """
+
+    for character, replacement in VULGAR_FRACTIONS.items():
+        line = line.replace(character, replacement)
+    line = line.strip()
+
+    quantity = None
+    unit = ""
+
+    # A line starting with a fraction over zero is read as having no quantity
+    match = QUANTITY.match(line)
+    if match and ZERO_DENOMINATOR.search(match.group(0)):
+        match = None
+
+    if match:
+        # For a range, buy enough for the top of it
+        quantity = _number(match.group("high") or match.group("low"))
+        line = line[match.end():]
+
+        # Skip a parenthetical size, e.g. "2 (15 oz) cans beans"
+        line = re.sub(r"^\([^)]*\)\s*", "", line)
+
+        match = UNIT.match(line)
+        if match:
+            unit = UNIT_ALIASES[match.group("unit").lower()]
+            line = line[match.end():]
+
+    food = normalize_food(line)
+
+    # Convert volumes and weights to their base unit, so they can be added up
+    if quantity is not None and unit in VOLUME_UNITS:
+        quantity, unit = quantity * VOLUME_UNITS[unit], "ml"
+    elif quantity is not None and unit in WEIGHT_UNITS:
+        quantity, unit = quantity * WEIGHT_UNITS[unit], "g"
+
+    return quantity, unit, food
+
+
+def format_quantity(quantity):
+    """
+    This function writes a quantity the way a recipe would, to the nearest eighth, e.g. 1.5 --> "1 1/2"
+    """
+
+    eighths = round(quantity * 8)
+    if eighths == 0:
+        return f"{quantity:.2g}"
+
+    whole, remainder = divmod(eighths, 8)
+    fraction = str(Fraction(remainder, 8)) if remainder else ""
+    return " ".join(part for part in (str(whole) if whole else "", fraction) if part)
+
+
+def format_amount(quantity, unit):
+    """
+    This function writes a merged quantity in a convenient unit, e.g. (44.4, "ml") --> "3 tbsp"
+    """
+
+    if quantity is None:
+        return ""
+
+    if unit == "ml":
+        if quantity >= VOLUME_UNITS["cup"] / 4 * 0.99:
+            name = "cup"
+        elif quantity >= VOLUME_UNITS["tbsp"] * 0.99:
+            name = "tbsp"
+        else:
+            name = "tsp"
+        amount = quantity / VOLUME_UNITS[name]
+        return f"{format_quantity(amount)} {name}{'s' if name == 'cup' and amount > 1 else ''}"
+
+    if unit == "g":
+        if quantity >= WEIGHT_UNITS["lb"] * 0.99:
+            return f"{format_quantity(quantity / WEIGHT_UNITS['lb'])} lb"
+        return f"{format_quantity(quantity / WEIGHT_UNITS['oz'])} oz"
+
+    if not unit:
+        return format_quantity(quantity)
+
+    # Pluralize the count units, e.g. "3 cloves"
+    plural = unit + ("es" if unit.endswith(("ch", "sh")) else "s")
+    return f"{format_quantity(quantity)} {unit if quantity <= 1 else plural}"
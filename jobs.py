@@ -0,0 +1,356 @@
+# This module runs slow work in the background: the request asking for it returns right
+# away with a job id, and the user polls /jobs/<job_id> until it's done.
+#
+# OCR uploads run the pipeline (see buttress.py) in a pool of worker processes. Bulk
+# imports (of a list of urls, or of an export) run on a few threads of the web process,
+# since they spend their time waiting on other sites and the database, and their results
+# (e.g. how each url fared) are kept with the job for the user to collect.
+#
+# Jobs are kept in the jobs table, not in this process's memory, so a poll can land on any
+# worker process (or node). The recipe read from an upload is saved by the process that ran
+# the job, as soon as it finishes, whether or not the user ever comes back to check.
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+from sqlalchemy import and_, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+import cache
+import ocr_cache
+from app_model import insert_recipes
+from buttress import (OCR_WORKERS, decode_image, extract_blocks,
+                      image_preprocessing, parse_image)
+from db import engine, jobs
+from metrics import record_stages, run_collected, stage
+from structure import structure_recipe
+
+# Number of jobs allowed to wait for a free worker. Once every worker is busy and the
+# queue is full, new uploads are turned away instead of piling up images in memory
+OCR_QUEUE_SIZE = int(os.environ.get("RECIPE_OCR_QUEUE_SIZE", 2 * OCR_WORKERS))
+
+# Number of bulk imports run at the same time by each process, and how many more may wait
+# for a turn before new ones are turned away
+IMPORT_WORKERS = int(os.environ.get("RECIPE_IMPORT_JOB_WORKERS", 2))
+IMPORT_QUEUE_SIZE = int(os.environ.get("RECIPE_IMPORT_JOB_QUEUE_SIZE", 8))
+
+# Seconds a finished job is kept around for the user to check on before it's dropped.
+# Its result is already saved by then, so this only bounds the jobs table
+JOB_TTL = int(os.environ.get("RECIPE_JOB_TTL", 600))
+
+# Seconds after which a job that still hasn't finished is given up on, e.g. because the
+# process running it was restarted
+JOB_TIMEOUT = int(os.environ.get("RECIPE_JOB_TIMEOUT", 3600))
+
+# Statuses of a job that hasn't finished yet
+UNFINISHED = ("queued", "running")
+
+logger = logging.getLogger("recipe.jobs")
+
+_executor = None
+_slots = threading.BoundedSemaphore(OCR_WORKERS + OCR_QUEUE_SIZE)
+_lock = threading.Lock()
+
+_import_executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix="import")
+_import_slots = threading.BoundedSemaphore(IMPORT_WORKERS + IMPORT_QUEUE_SIZE)
+
+
+def run_pipeline(data):
+    """
+    This function runs in a worker process. It takes the raw bytes of an upload and
+    returns the recipe read from it, as a dictionary holding its title, ingredients and instructions
+    """
+
+    # Decode the upload into an image array. Only the (compressed) bytes cross the
+    # process boundary, not the much larger decoded image
+    image = decode_image(data)
+    if image is None:
+        raise ValueError("not a readable image")
+
+    # If we've read this image (or, optionally, one nearly identical) before, reuse the result
+    digest, phash = ocr_cache.image_key(image)
+    cached = ocr_cache.lookup(digest, phash)
+    if cached is not None:
+        return structure_recipe(cached[0])
+
+    # Prepare the image for OCR text recognition
+    with stage("preprocess"):
+        processed_image = image_preprocessing(image)
+
+    # Create a list of image arrays, each containing a separate chunk of text
+    # from the original image
+    with stage("region_detection"):
+        image_arrays = parse_image(processed_image)
+
+    # OCR each chunk into lines of text, keeping their layout
+    blocks, confidences = extract_blocks(image_arrays)
+
+    # The OCR is what's cached, so improvements to structuring apply to cached images too
+    ocr_cache.store(digest, phash, blocks, confidences)
+
+    # Pick out the title, ingredients and instructions (see structure.py)
+    return structure_recipe(blocks)
+
+
+def run_ocr_job(job_id, data):
+    """
+    This function runs in a worker process. It marks the job as running, then reads the
+    recipe from the upload, returning it along with the timings of each stage (see run_collected)
+    """
+
+    start_job(job_id)
+    return run_collected(run_pipeline, data)
+
+
+def _get_executor():
+    """
+    This function lazily starts the process pool, so importing the module
+    (e.g. in gunicorn's master process) doesn't spawn any workers
+    """
+
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawn, not fork: the web process has threads and an open database connection
+            # that a forked child would inherit
+            _executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, mp_context=get_context("spawn"))
+    return _executor
+
+
+def _reset_executor():
+    """
+    This function throws away a broken process pool so the next submission starts a new one
+    """
+
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _prune():
+    """
+    This function drops finished jobs nobody came back for
+    """
+
+    with engine.begin() as conn:
+        conn.execute(delete(jobs).where(jobs.c.finished_at < time.time() - JOB_TTL))
+
+
+def create_job(user_id, kind):
+    """
+    This function records a new job of a kind (e.g. "ocr") for a user, and returns its id
+    """
+
+    job_id = uuid.uuid4().hex
+    with engine.begin() as conn:
+        conn.execute(insert(jobs).values(id=job_id, user_id=user_id, kind=kind, status="queued",
+                                         created_at=time.time()))
+    return job_id
+
+
+def start_job(job_id):
+    """
+    This function marks a queued job as running
+    """
+
+    with engine.begin() as conn:
+        conn.execute(update(jobs).where(and_(jobs.c.id == job_id, jobs.c.status == "queued"))
+                     .values(status="running"))
+
+
+def finish_job(job_id, status, result=None, error=None, conn=None):
+    """
+    This function records the outcome of a job ("done" with its result, or "failed" with an
+    error message fit to show the user). Only the first call for a job does anything, so
+    returns whether this one did.
+
+    Given a connection, it writes in that connection's transaction
+    """
+
+    if conn is None:
+        with engine.begin() as conn:
+            return finish_job(job_id, status, result, error, conn)
+
+    stmt = (update(jobs).where(and_(jobs.c.id == job_id, jobs.c.status.in_(UNFINISHED)))
+            .values(status=status, result=json.dumps(result) if result is not None else None,
+                    error=error, finished_at=time.time()))
+    return conn.execute(stmt).rowcount == 1
+
+
+def save_recipe(job_id, user_id, recipe_data):
+    """
+    This function adds the recipe read from an upload to the user's library, and marks the
+    job done, keeping the title id and whether it was imported, linked or already owned (see
+    insert_recipes). If the job was already finished (e.g. given up on), nothing is saved
+    """
+
+    # Check to make sure the worker found both ingredients and instructions (see structure.py)
+    if not recipe_data["instructions"] or not recipe_data["ingredients"]:
+        finish_job(job_id, "failed",
+                   error="Highly uncertain about that image. Resubmit material, glareless and straight.")
+        return
+
+    # The title is the largest text on the card. If there wasn't any, the user can rename it later
+    title = recipe_data["title"] or "Untitled recipe"
+    recipe = (title, recipe_data["instructions"], recipe_data["ingredients"], None)
+
+    # The job is claimed and the recipe saved in one transaction, so a job is only ever saved
+    # once. If someone else stores the same content at the same time, the second try links their copy
+    for attempt in range(2):
+        try:
+            with stage("db_write"), engine.begin() as conn:
+                if not finish_job(job_id, "done", conn=conn):
+                    return
+                title_id, status = insert_recipes([recipe], user_id, conn)[0]
+                conn.execute(update(jobs).where(jobs.c.id == job_id)
+                             .values(result=json.dumps({"title_id": title_id, "status": status})))
+            break
+        except IntegrityError:
+            if attempt:
+                raise
+
+    # Only once the transaction is committed, drop what's cached about the user's library
+    cache.invalidate_user(user_id)
+    cache.invalidate_recipe(title_id)
+
+
+def submit_job(data, user_id):
+    """
+    This function queues the bytes of an uploaded image for OCR and returns the new job id, or None if the
+    queue is full and the caller should ask the user to try again later
+    """
+
+    _prune()
+
+    # Backpressure: take a slot without waiting, give up if there are none left
+    if not _slots.acquire(blocking=False):
+        return None
+
+    try:
+        job_id = create_job(user_id, "ocr")
+        try:
+            future = _get_executor().submit(run_ocr_job, job_id, data)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for running out of memory), so start a fresh pool
+            _reset_executor()
+            future = _get_executor().submit(run_ocr_job, job_id, data)
+    except Exception:
+        _slots.release()
+        raise
+
+    def on_done(future):
+        # Save the outcome of the job and hand the slot back
+        try:
+            # The worker sends back how long each stage took along with the recipe (see metrics.py)
+            recipe_data, timings = future.result()
+            record_stages(timings)
+        except Exception:
+            recipe_data = None
+        try:
+            if recipe_data is None:
+                finish_job(job_id, "failed", error="We couldn't read that image. Please try again with a jpg or png.")
+            else:
+                save_recipe(job_id, user_id, recipe_data)
+        except SQLAlchemyError:
+            finish_job(job_id, "failed", error="we couldn't save that recipe")
+        except Exception:
+            # Anything else would leave the job running until it timed out
+            logger.exception("ocr job %s failed", job_id)
+            finish_job(job_id, "failed", error="we couldn't save that recipe")
+        finally:
+            _slots.release()
+
+    future.add_done_callback(on_done)
+
+    return job_id
+
+
+def reserve_import():
+    """
+    This function takes one of the slots bulk imports share in this process without
+    waiting, and returns whether there was one. Whoever takes a slot hands it back with release_import
+    """
+
+    return _import_slots.acquire(blocking=False)
+
+
+def release_import():
+    """
+    This function hands back a slot taken with reserve_import
+    """
+
+    _import_slots.release()
+
+
+def submit_import(user_id, kind, f, *args, errors=()):
+    """
+    This function runs f(*args) as a background job of a kind (e.g. "urls") for a user, on
+    one of this process's import threads, and returns the job id, or None if too many
+    imports are waiting already and the caller should ask the user to try again later.
+
+    What f returns is kept as the job's result. If it raises one of the exception types in
+    errors, whose messages are fit to show the user, the job fails with that message
+    """
+
+    _prune()
+
+    # Backpressure, as for OCR jobs
+    if not reserve_import():
+        return None
+
+    def run():
+        try:
+            start_job(job_id)
+            try:
+                result = f(*args)
+            except errors as e:
+                finish_job(job_id, "failed", error=str(e))
+            except Exception:
+                logger.exception("%s import %s failed", kind, job_id)
+                finish_job(job_id, "failed", error="Something went wrong with that import. Please try again.")
+            else:
+                finish_job(job_id, "done", result)
+        finally:
+            release_import()
+
+    try:
+        job_id = create_job(user_id, kind)
+        _import_executor.submit(run)
+    except Exception:
+        release_import()
+        raise
+
+    return job_id
+
+
+def get_job(job_id, user_id):
+    """
+    This function returns the job with the given id, as a dictionary holding its kind,
+    status, result and error, as long as it belongs to the given user
+    """
+
+    stmt = select(jobs).where(and_(jobs.c.id == job_id, jobs.c.user_id == user_id))
+    with engine.connect() as conn:
+        row = conn.execute(stmt).first()
+    if row is None:
+        return None
+
+    # A job that's been going this long has been lost, e.g. with the process running it
+    if row.status in UNFINISHED and row.created_at < time.time() - JOB_TIMEOUT:
+        finish_job(job_id, "failed", error="That took too long. Please try again.")
+        return get_job(job_id, user_id)
+
+    return {"id": row.id,
+            "kind": row.kind,
+            "status": row.status,
+            "result": json.loads(row.result) if row.result is not None else None,
+            "error": row.error}
@@ -0,0 +1,279 @@
+# This module collects timings from the running app and serves them at /metrics, in the
+# Prometheus text format.
+#
+# It tracks:
+#   - how long each stage of importing a recipe takes (fetch, parse, preprocess, region
+#     detection, OCR of each region, DB write), timed with `with stage("name"):` or @stage("name")
+#   - how long each route takes to answer, and how many database queries it runs
+#   - database queries slower than RECIPE_SLOW_QUERY_MS, which are also logged
+#   - whatever other modules keep themselves and register with a Collector, e.g. the OCR
+#     cache's hits, misses and size (see ocr_cache.py), read when /metrics is scraped
+#
+# Metrics live in the memory of each process (collected ones excepted). Stages that run in a worker process (OCR
+# jobs, parsing for bulk imports) are timed there with run_collected, and the timings are
+# sent back with the result and recorded by the web process.
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, abort, g, has_app_context, request
+from sqlalchemy import event
+
+# Queries taking longer than this many milliseconds are logged and counted
+SLOW_QUERY_MS = float(os.environ.get("RECIPE_SLOW_QUERY_MS", 200))
+
+# If set, /metrics only answers requests carrying "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("RECIPE_METRICS_TOKEN")
+
+# Upper bounds of the histogram buckets, in seconds and in queries
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+sql_logger = logging.getLogger("recipe.sql")
+logger = logging.getLogger("recipe.metrics")
+
+_lock = threading.Lock()
+
+# Stage timings being gathered for a worker's result (see run_collected)
+_collected = None
+
+
+class Histogram:
+    """
+    A Prometheus histogram, with one series of buckets per combination of label values
+    """
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        with _lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = _format_labels(self.labels, label_values)
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le=bound)} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le='+Inf')} "
+                             f"{series['count']}")
+                lines.append(f"{self.name}_sum{labels} {series['sum']}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Counter:
+    """
+    A Prometheus counter, with one value per combination of label values
+    """
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with _lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Collector:
+    """
+    Metrics kept somewhere else (e.g. in a database), read each time the metrics are
+    rendered. read() returns a dictionary of values, and metrics lists a (key, name, type,
+    help text) tuple for each metric taken from it. If read() fails, they're left out
+    """
+
+    def __init__(self, read, metrics):
+        self.read = read
+        self.metrics = metrics
+
+    def render(self):
+        try:
+            values = self.read()
+        except Exception:
+            logger.exception("couldn't collect metrics")
+            return []
+
+        lines = []
+        for key, name, metric_type, help_text in self.metrics:
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}",
+                          f"{name} {values[key]}"])
+        return lines
+
+
+def _format_labels(names, values, le=None):
+    """
+    This function renders label names and values as {name="value",...}, escaped as
+    the Prometheus text format requires
+    """
+
+    pairs = list(zip(names, values))
+    if le is not None:
+        pairs.append(("le", le))
+    if not pairs:
+        return ""
+
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f"{name}=\"{value}\"")
+    return "{" + ",".join(escaped) + "}"
+
+
+STAGE_SECONDS = Histogram("recipe_stage_seconds", "Time spent in each stage of importing a recipe",
+                          ("stage",), TIME_BUCKETS)
+STAGE_ERRORS = Counter("recipe_stage_errors_total", "Stages that raised an exception", ("stage",))
+REQUEST_SECONDS = Histogram("recipe_request_seconds", "Time taken to answer a request",
+                            ("method", "route", "status"), TIME_BUCKETS)
+REQUEST_QUERIES = Histogram("recipe_request_db_queries", "Database queries run by a request",
+                            ("method", "route"), COUNT_BUCKETS)
+SLOW_QUERIES = Counter("recipe_slow_queries_total", f"Database queries slower than {SLOW_QUERY_MS:g}ms", ())
+
+METRICS = [STAGE_SECONDS, STAGE_ERRORS, REQUEST_SECONDS, REQUEST_QUERIES, SLOW_QUERIES]
+
+
+def register(metric):
+    """
+    This function adds a metric (e.g. a Collector) to the ones served at /metrics
+    """
+
+    with _lock:
+        METRICS.append(metric)
+
+
+def record_stage(name, seconds, failed=False):
+    """
+    This function records one run of a stage
+    """
+
+    STAGE_SECONDS.observe(seconds, name)
+    if failed:
+        STAGE_ERRORS.inc(name)
+    if _collected is not None:
+        with _lock:
+            _collected.append((name, seconds, failed))
+
+
+@contextmanager
+def stage(name):
+    """
+    This context manager (or decorator) times a stage of the pipeline
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        record_stage(name, time.perf_counter() - start, failed=True)
+        raise
+    record_stage(name, time.perf_counter() - start)
+
+
+def run_collected(f, *args):
+    """
+    This function runs f(*args) in a worker process and returns (result, timings), where
+    timings lists the stages timed along the way, so the caller can record them with record_stages
+    """
+
+    global _collected
+    _collected = []
+    try:
+        result = f(*args)
+        return result, _collected
+    finally:
+        _collected = None
+
+
+def record_stages(timings):
+    """
+    This function records the stage timings sent back by a worker process
+    """
+
+    for name, seconds, failed in timings:
+        record_stage(name, seconds, failed)
+
+
+def render():
+    """
+    This function returns every metric in the Prometheus text format
+    """
+
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrument_engine(engine):
+    """
+    This function counts the queries an engine runs for each request, and logs the slow ones
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info["query_start"].pop()) * 1000
+
+        if has_app_context():
+            g.db_queries = g.get("db_queries", 0) + 1
+
+        if elapsed_ms >= SLOW_QUERY_MS:
+            SLOW_QUERIES.inc()
+            sql_logger.warning("slow query (%.1fms): %s", elapsed_ms, " ".join(statement.split())[:1000])
+
+
+def init_app(app):
+    """
+    This function times every request to a flask app, and adds the /metrics endpoint
+    """
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.db_queries = 0
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("request_start", None)
+        if start is None:
+            return response
+
+        # Label by the route's pattern, not the url, so /recipe/1 and /recipe/2 are one series
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route, response.status_code)
+        REQUEST_QUERIES.observe(g.get("db_queries", 0), request.method, route)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            abort(401)
+        return Response(render(), mimetype="text/plain; version=0.0.4")
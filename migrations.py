@@ -0,0 +1,443 @@
+# This module keeps the database schema up to date.
+#
+# Each migration is a function registered with @migration(version, description). Pending
+# migrations run in version order when the app starts (or with `python migrations.py`),
+# and the versions that have been applied are recorded in the schema_migrations table.
+# Every migration must be idempotent (CREATE ... IF NOT EXISTS and the like), since a
+# database created before migrations existed already has some of the schema.
+#
+# Before a SQLite database is upgraded, a copy of it is saved next to it as
+# <database>.bak-v<version>-<timestamp>.
+#
+# Migrations describe the schema as it was at that version, so they must never import the
+# table definitions from app_model.py, which only describe the latest one.
+
+import os
+import sqlite3
+import sys
+import time
+
+from sqlalchemy import (Column, Float, ForeignKey, Index, Integer,
+                        LargeBinary, MetaData, String, Table, Text,
+                        UniqueConstraint, bindparam, create_engine, insert,
+                        inspect, select, text)
+from sqlalchemy.exc import IntegrityError
+
+# Registered migrations, as (version, description, function) tuples
+MIGRATIONS = []
+
+migration_metadata = MetaData()
+
+schema_migrations = Table("schema_migrations", migration_metadata,
+                          Column("version", Integer(), primary_key=True, autoincrement=False),
+                          Column("description", String(), nullable=False),
+                          Column("applied_at", Integer(), nullable=False)
+                          )
+
+
+def migration(version, description):
+    """
+    This decorator registers a migration function, which is passed a connection
+    inside the transaction the migration runs in
+    """
+
+    def register(f):
+        MIGRATIONS.append((version, description, f))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return f
+    return register
+
+
+def applied_versions(engine):
+    """
+    This function returns the set of migration versions already applied to a database
+    """
+
+    migration_metadata.create_all(engine)
+    with engine.connect() as conn:
+        return {row.version for row in conn.execute(select(schema_migrations.c.version))}
+
+
+def backup_sqlite(engine, version):
+    """
+    This function saves a copy of a SQLite database file (using SQLite's online backup,
+    so it's consistent even if another process is using the database) and returns its path
+    """
+
+    path = engine.url.database
+    if engine.dialect.name != "sqlite" or not path or path == ":memory:" or not os.path.exists(path):
+        return None
+
+    backup_path = f"{path}.bak-v{version}-{time.strftime('%Y%m%d%H%M%S')}"
+    source = sqlite3.connect(path)
+    destination = sqlite3.connect(backup_path)
+    try:
+        with destination:
+            source.backup(destination)
+    finally:
+        destination.close()
+        source.close()
+
+    return backup_path
+
+
+def migrate(engine):
+    """
+    This function applies every pending migration to a database, and returns the
+    versions it applied
+    """
+
+    applied = applied_versions(engine)
+    pending = [m for m in MIGRATIONS if m[0] not in applied]
+    if not pending:
+        return []
+
+    # Keep a copy of the database as it was, in case an upgrade goes wrong
+    if applied or _has_tables(engine):
+        backup_sqlite(engine, max(applied, default=0))
+
+    done = []
+    for version, description, upgrade in pending:
+        try:
+            with engine.begin() as conn:
+                # Claim the version first. If several workers start at once, the others
+                # wait here and then fail to insert, so each migration runs exactly once
+                conn.execute(insert(schema_migrations).values(version=version, description=description,
+                                                              applied_at=int(time.time())))
+                upgrade(conn)
+        except IntegrityError:
+            continue
+        done.append(version)
+
+    return done
+
+
+def _has_tables(engine):
+    """
+    This function checks whether a database holds anything besides schema_migrations
+    """
+
+    names = set(inspect(engine).get_table_names())
+    return bool(names - {"schema_migrations"})
+
+
+def _dedupe_rows_sql(conn, table, columns):
+    """
+    This function returns a statement deleting all but one of each group of rows in a
+    table that share the given columns
+    """
+
+    # Tables without a primary key are told apart by Postgres' ctid or SQLite's rowid
+    if conn.dialect.name == "postgresql":
+        same = " AND ".join(f"a.{column} = b.{column}" for column in columns)
+        return text(f"DELETE FROM {table} a USING {table} b WHERE a.ctid > b.ctid AND {same}")
+
+    group = ", ".join(columns)
+    return text(f"DELETE FROM {table} WHERE rowid NOT IN "
+                f"(SELECT MIN(rowid) FROM {table} GROUP BY {group})")
+
+
+@migration(1, "create the original tables")
+def create_original_tables(conn):
+    metadata = MetaData()
+
+    Table("titles", metadata,
+          Column("id", Integer(), primary_key=True),
+          Column("title", String(), nullable=False),
+          Column("url", String())
+          )
+
+    Table("users", metadata,
+          Column("id", Integer(), primary_key=True),
+          Column("username", String(), nullable=False, unique=True),
+          Column("passhash", String(), nullable=False),
+          )
+
+    Table("ingredients", metadata,
+          Column("title_id", Integer(), ForeignKey("titles.id")),
+          Column("ingredient", String(), nullable=False)
+          )
+
+    Table("instructions", metadata,
+          Column("title_id", Integer(), ForeignKey("titles.id")),
+          Column("instruction", String(), nullable=False)
+          )
+
+    Table("recipe_books", metadata,
+          Column("title_id", Integer(), ForeignKey("titles.id")),
+          Column("user_id", Integer(), ForeignKey("users.id"))
+          )
+
+    metadata.create_all(conn)
+
+
+@migration(2, "index recipe lookups, and make urls and library entries unique")
+def add_lookup_indexes(conn):
+
+    # Recipes saved more than once under the same url (possible before the unique index)
+    # are merged into the oldest copy
+    duplicate_ids = ("SELECT t.id FROM titles t WHERE t.url IS NOT NULL AND t.id > "
+                     "(SELECT MIN(t2.id) FROM titles t2 WHERE t2.url = t.url)")
+    conn.execute(text("UPDATE recipe_books SET title_id = "
+                      "(SELECT MIN(t2.id) FROM titles t1 JOIN titles t2 ON t2.url = t1.url "
+                      "WHERE t1.id = recipe_books.title_id) "
+                      f"WHERE title_id IN ({duplicate_ids})"))
+    conn.execute(text(f"DELETE FROM ingredients WHERE title_id IN ({duplicate_ids})"))
+    conn.execute(text(f"DELETE FROM instructions WHERE title_id IN ({duplicate_ids})"))
+    conn.execute(text(f"DELETE FROM titles WHERE id IN ({duplicate_ids})"))
+
+    # A recipe could end up in a user's library twice, so keep only one of each
+    conn.execute(_dedupe_rows_sql(conn, "recipe_books", ["user_id", "title_id"]))
+
+    # Listing a user's library, and checking whether a recipe is in it
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_recipe_books_user_title "
+                      "ON recipe_books (user_id, title_id)"))
+
+    # Loading a recipe's ingredients and instructions
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ingredients_title_id ON ingredients (title_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_instructions_title_id ON instructions (title_id)"))
+
+    # Looking recipes up by title, and checking whether a url has been imported already
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_titles_title ON titles (title)"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_titles_url ON titles (url)"))
+
+
+def _has_column(conn, table, column):
+    """
+    This function checks whether a table already has a column
+    """
+
+    return column in {c["name"] for c in inspect(conn).get_columns(table)}
+
+
+@migration(3, "store the order of ingredients and instructions")
+def add_positions(conn):
+    for table in ("ingredients", "instructions"):
+        if not _has_column(conn, table, "position"):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN position INTEGER"))
+
+        # Number each recipe's existing rows in the order they were inserted
+        if conn.dialect.name == "postgresql":
+            conn.execute(text(f"UPDATE {table} SET position = numbered.n FROM "
+                              f"(SELECT ctid AS row_id, ROW_NUMBER() OVER (PARTITION BY title_id ORDER BY ctid) - 1 AS n "
+                              f"FROM {table}) AS numbered WHERE {table}.ctid = numbered.row_id"))
+        else:
+            conn.execute(text(f"UPDATE {table} SET position = (SELECT COUNT(*) FROM {table} AS earlier "
+                              f"WHERE earlier.title_id = {table}.title_id AND earlier.rowid < {table}.rowid)"))
+
+        # Reading a recipe's rows in order. This covers the plain title_id index, so that one goes
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_title_position ON {table} (title_id, position)"))
+        conn.execute(text(f"DROP INDEX IF EXISTS ix_{table}_title_id"))
+
+
+def has_fts5(conn):
+    """
+    This function checks whether a database is SQLite built with the FTS5 full-text search extension
+    """
+
+    if conn.dialect.name != "sqlite":
+        return False
+    options = {row[0] for row in conn.execute(text("PRAGMA compile_options"))}
+    return "ENABLE_FTS5" in options
+
+
+@migration(4, "add a full-text search index over recipes")
+def add_recipe_search(conn):
+
+    # Only SQLite gets the index. Elsewhere (or without FTS5), searches fall back to LIKE
+    if not has_fts5(conn):
+        return
+
+    # One row per recipe, whose rowid is the title id
+    conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search USING fts5("
+                      "title, ingredients, instructions, tokenize = 'porter unicode61')"))
+
+    # Index the recipes already in the database
+    conn.execute(text("INSERT INTO recipe_search (rowid, title, ingredients, instructions) "
+                      "SELECT t.id, t.title, "
+                      "(SELECT group_concat(ingredient, char(10)) FROM ingredients WHERE title_id = t.id), "
+                      "(SELECT group_concat(instruction, char(10)) FROM instructions WHERE title_id = t.id) "
+                      "FROM titles t WHERE t.id NOT IN (SELECT rowid FROM recipe_search)"))
+
+
+@migration(5, "store ingredients parsed into quantity, unit and food")
+def add_parsed_ingredients(conn):
+    from ingredient_parser import parse_ingredient
+
+    for column, column_type in (("quantity", "FLOAT"), ("unit", "VARCHAR"), ("food", "VARCHAR")):
+        if not _has_column(conn, "ingredients", column):
+            conn.execute(text(f"ALTER TABLE ingredients ADD COLUMN {column} {column_type}"))
+
+    # Parse the ingredients already in the database
+    rows = conn.execute(text("SELECT title_id, position, ingredient FROM ingredients WHERE food IS NULL")).fetchall()
+    updates = []
+    for row in rows:
+        quantity, unit, food = parse_ingredient(row.ingredient)
+        updates.append({"quantity": quantity, "unit": unit, "food": food,
+                        "title_id": row.title_id, "position": row.position})
+    if updates:
+        conn.execute(text("UPDATE ingredients SET quantity = :quantity, unit = :unit, food = :food "
+                          "WHERE title_id = :title_id AND position = :position"), updates)
+
+    # Building a shopping list reads only these columns, so it never has to touch the table itself
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ingredients_title_food "
+                      "ON ingredients (title_id, food, unit, quantity)"))
+
+
+@migration(6, "add user tags for recipes")
+def add_tags(conn):
+    metadata = MetaData()
+
+    Table("titles", metadata, Column("id", Integer(), primary_key=True))
+    Table("users", metadata, Column("id", Integer(), primary_key=True))
+
+    # A user's tags. Names are unique per user
+    Table("tags", metadata,
+          Column("id", Integer(), primary_key=True),
+          Column("user_id", Integer(), ForeignKey("users.id"), nullable=False),
+          Column("name", String(), nullable=False),
+          UniqueConstraint("user_id", "name", name="ux_tags_user_name")
+          )
+
+    # Which of a user's recipes carry which of their tags. The primary key serves
+    # filtering by tag; the index serves showing a page of recipes with their tags
+    Table("recipe_tags", metadata,
+          Column("tag_id", Integer(), ForeignKey("tags.id"), primary_key=True),
+          Column("title_id", Integer(), ForeignKey("titles.id"), primary_key=True),
+          Column("user_id", Integer(), ForeignKey("users.id"), nullable=False),
+          Index("ix_recipe_tags_user_title", "user_id", "title_id", "tag_id")
+          )
+
+    metadata.create_all(conn, tables=[metadata.tables["tags"], metadata.tables["recipe_tags"]])
+
+
+@migration(7, "pack each recipe's ingredients and instructions into one blob")
+def add_recipe_blobs(conn):
+    from compact import pack_recipe
+
+    metadata = MetaData()
+
+    Table("titles", metadata, Column("id", Integer(), primary_key=True))
+
+    # One row per recipe, read with a single primary key lookup (see compact.py)
+    recipe_blobs = Table("recipe_blobs", metadata,
+                         Column("title_id", Integer(), ForeignKey("titles.id"), primary_key=True,
+                                autoincrement=False),
+                         Column("body", LargeBinary(), nullable=False)
+                         )
+    metadata.create_all(conn, tables=[recipe_blobs])
+
+    # Pack the recipes already in the database, a few hundred at a time
+    title_ids = [row.id for row in conn.execute(text("SELECT id FROM titles WHERE id NOT IN "
+                                                     "(SELECT title_id FROM recipe_blobs) ORDER BY id"))]
+    for i in range(0, len(title_ids), 500):
+        chunk = title_ids[i: i + 500]
+        lines = {title_id: ([], []) for title_id in chunk}
+        for kind, table, column in ((0, "ingredients", "ingredient"), (1, "instructions", "instruction")):
+            stmt = (text(f"SELECT title_id, {column} AS body FROM {table} "
+                         f"WHERE title_id IN :ids ORDER BY title_id, position")
+                    .bindparams(bindparam("ids", expanding=True)))
+            for row in conn.execute(stmt, {"ids": chunk}):
+                lines[row.title_id][kind].append(row.body)
+
+        conn.execute(insert(recipe_blobs), [{"title_id": title_id, "body": pack_recipe(*lines[title_id])}
+                                            for title_id in chunk])
+
+
+@migration(8, "fingerprint recipes by content, merging the duplicates")
+def add_content_hashes(conn):
+    from compact import content_hash, unpack_recipe
+
+    metadata = MetaData()
+
+    Table("titles", metadata, Column("id", Integer(), primary_key=True))
+
+    # The urls a recipe was also imported from, besides its own, so importing any of them
+    # again finds the recipe without fetching it
+    title_urls = Table("title_urls", metadata,
+                       Column("url", String(), primary_key=True),
+                       Column("title_id", Integer(), ForeignKey("titles.id"), nullable=False)
+                       )
+    metadata.create_all(conn, tables=[title_urls])
+
+    if not _has_column(conn, "titles", "content_hash"):
+        conn.execute(text("ALTER TABLE titles ADD COLUMN content_hash VARCHAR"))
+    has_search = "recipe_search" in inspect(conn).get_table_names()
+
+    # Fingerprint every recipe from its blob (see migration 7). The oldest copy of each
+    # recipe keeps it, and the rest are merged into that one
+    keepers = {}
+    merges = []
+    aliases = []
+    stmt = text("SELECT t.id, t.title, t.url, b.body FROM titles t "
+                "LEFT JOIN recipe_blobs b ON b.title_id = t.id ORDER BY t.id")
+    for row in conn.execute(stmt.execution_options(stream_results=True, yield_per=500)):
+        if row.body is None:
+            continue
+        digest = content_hash(row.title, *unpack_recipe(row.body))
+        if digest in keepers:
+            merges.append({"dup": row.id, "keep": keepers[digest]})
+            if row.url is not None:
+                aliases.append({"url": row.url, "title_id": keepers[digest]})
+        else:
+            keepers[digest] = row.id
+
+    if merges:
+        # Move the duplicates' places in libraries and their tags over to the copy kept,
+        # except where the user already has it, or the tag is already on it
+        conn.execute(text("DELETE FROM recipe_books WHERE title_id = :dup AND user_id IN "
+                          "(SELECT user_id FROM recipe_books WHERE title_id = :keep)"), merges)
+        conn.execute(text("UPDATE recipe_books SET title_id = :keep WHERE title_id = :dup"), merges)
+        conn.execute(text("DELETE FROM recipe_tags WHERE title_id = :dup AND tag_id IN "
+                          "(SELECT tag_id FROM recipe_tags WHERE title_id = :keep)"), merges)
+        conn.execute(text("UPDATE recipe_tags SET title_id = :keep WHERE title_id = :dup"), merges)
+
+        # Then drop the duplicates themselves, keeping their urls pointing at the copy kept
+        for table in ("ingredients", "instructions", "recipe_blobs"):
+            conn.execute(text(f"DELETE FROM {table} WHERE title_id = :dup"), merges)
+        if has_search:
+            conn.execute(text("DELETE FROM recipe_search WHERE rowid = :dup"), merges)
+        conn.execute(text("DELETE FROM titles WHERE id = :dup"), merges)
+        if aliases:
+            conn.execute(insert(title_urls), aliases)
+
+    if keepers:
+        conn.execute(text("UPDATE titles SET content_hash = :digest WHERE id = :id"),
+                     [{"digest": digest, "id": title_id} for digest, title_id in keepers.items()])
+
+    # Checking whether a recipe is already stored, whatever its url
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_titles_content_hash ON titles (content_hash)"))
+
+
+@migration(9, "keep background jobs in the database")
+def add_jobs(conn):
+    metadata = MetaData()
+
+    Table("users", metadata, Column("id", Integer(), primary_key=True))
+
+    # One row per background job (see jobs.py), so any worker process can report on it.
+    # Finished jobs are swept by finished_at
+    jobs = Table("jobs", metadata,
+                 Column("id", String(32), primary_key=True),
+                 Column("user_id", Integer(), ForeignKey("users.id"), nullable=False),
+                 Column("kind", String(), nullable=False),
+                 Column("status", String(), nullable=False),
+                 Column("result", Text()),
+                 Column("error", String()),
+                 Column("created_at", Float(), nullable=False),
+                 Column("finished_at", Float()),
+                 Index("ix_jobs_finished_at", "finished_at")
+                 )
+    metadata.create_all(conn, tables=[jobs])
+
+
+if __name__ == "__main__":
+    # Usage: python migrations.py [database url]
+    url = sys.argv[1] if len(sys.argv) > 1 else "sqlite:///recipe.db"
+    engine = create_engine(url, future=True)
+
+    applied = migrate(engine)
+    if applied:
+        print(f"applied migrations {', '.join(str(v) for v in applied)}")
+    else:
+        print("database is up to date")
@@ -0,0 +1,233 @@
+# This module is a persistent cache of OCR results, so an image we've already read
+# (e.g. the same recipe card uploaded twice) skips tesseract entirely.
+#
+# Entries are keyed by a hash of the decoded image. Optionally, a perceptual hash (dHash)
+# also lets near-duplicates hit, e.g. the same photo re-saved at a different jpeg quality.
+# The cache is bounded: once it holds more than RECIPE_OCR_CACHE_SIZE entries, the least
+# recently used ones are evicted.
+
+import hashlib
+import json
+import os
+import time
+
+import cv2
+from sqlalchemy import (BigInteger, Column, Float, Integer, MetaData, String,
+                        Table, Text, create_engine, delete, event, func,
+                        insert, or_, select, update)
+from sqlalchemy.exc import SQLAlchemyError
+
+from metrics import Collector, register
+
+# Where the cache lives. It's kept apart from recipe.db since it's safe to throw away
+CACHE_URL = os.environ.get("RECIPE_OCR_CACHE_URL", "sqlite:///ocr_cache.db")
+
+# Maximum number of cached images
+CACHE_SIZE = int(os.environ.get("RECIPE_OCR_CACHE_SIZE", 1000))
+
+# Maximum number of differing bits between two perceptual hashes for the images to count
+# as the same. 0 (the default) turns near-duplicate matching off, so only identical images hit.
+# Keep this small: different cards from the same publisher can look alike at 9x8 pixels.
+# Matches are only guaranteed to be found up to a distance of 3 (see _bands)
+PHASH_DISTANCE = int(os.environ.get("RECIPE_OCR_CACHE_PHASH_DISTANCE", 0))
+
+# Version of what's cached (the OCRed blocks of lines, see structure.py). It's part of every
+# key, so bumping it when the payload changes makes old entries miss instead of being misread
+PAYLOAD_VERSION = 2
+
+metadata = MetaData()
+
+ocr_results = Table("ocr_results", metadata,
+                    Column("digest", String(64), primary_key=True),
+                    Column("phash", BigInteger()),
+                    Column("band0", Integer(), index=True),
+                    Column("band1", Integer(), index=True),
+                    Column("band2", Integer(), index=True),
+                    Column("band3", Integer(), index=True),
+                    Column("strings", Text(), nullable=False),
+                    Column("confidences", Text(), nullable=False),
+                    Column("last_used", Float(), nullable=False, index=True)
+                    )
+
+cache_stats = Table("cache_stats", metadata,
+                    Column("name", String(), primary_key=True),
+                    Column("value", Integer(), nullable=False)
+                    )
+
+_engine = None
+
+
+def _get_engine():
+    """
+    This function lazily creates the engine, once per process (the cache is used from the
+    OCR worker processes)
+    """
+
+    global _engine
+    if _engine is None:
+        connect_args = {"timeout": 15} if CACHE_URL.startswith("sqlite") else {}
+        engine = create_engine(CACHE_URL, future=True, connect_args=connect_args)
+
+        # Several worker processes read and write the cache at once, so let readers
+        # and the writer work side by side
+        if engine.dialect.name == "sqlite":
+            @event.listens_for(engine, "connect")
+            def set_sqlite_pragma(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+                cursor.close()
+
+        metadata.create_all(engine)
+        _engine = engine
+    return _engine
+
+
+def image_key(image):
+    """
+    This function returns the exact hash and the perceptual hash of an image array
+    """
+
+    # Hash the pixels along with the shape, so two images with the same bytes but
+    # different dimensions don't collide
+    digest = hashlib.sha256(f"{PAYLOAD_VERSION}:{image.shape}".encode())
+    digest.update(image.tobytes())
+
+    # dHash: shrink to 9x8 grayscale and record whether each pixel is brighter than its
+    # right-hand neighbour. Small changes in scale, compression or exposure leave it alone
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    phash = 0
+    for bit in bits:
+        phash = (phash << 1) | int(bit)
+
+    return digest.hexdigest(), phash
+
+
+def _bands(phash):
+    """
+    This function splits a 64 bit hash into four 16 bit bands. Two hashes that differ in
+    at most 3 bits must agree on at least one band, so near-duplicate candidates can be
+    found with indexed equality lookups instead of scanning every entry
+    """
+
+    return [(phash >> shift) & 0xFFFF for shift in (48, 32, 16, 0)]
+
+
+def _to_signed(phash):
+    """
+    This function maps a 64 bit hash into the range of a signed SQL integer
+    """
+
+    return phash - (1 << 64) if phash >= (1 << 63) else phash
+
+
+def _bump(connection, name):
+    """
+    This function increments one of the hit/miss counters
+    """
+
+    result = connection.execute(update(cache_stats).where(cache_stats.c.name == name)
+                                .values(value=cache_stats.c.value + 1))
+    if not result.rowcount:
+        connection.execute(insert(cache_stats).values(name=name, value=1))
+
+
+def _is_current(row):
+    """
+    This function checks whether an entry holds the current payload (blocks of lines, not
+    the plain strings cached before PAYLOAD_VERSION 2). Exact matches can't be stale, since
+    the version is part of the digest, but near-duplicates are found by perceptual hash alone
+    """
+
+    blocks = json.loads(row.strings)
+    return all(isinstance(block, list) for block in blocks)
+
+
+def lookup(digest, phash):
+    """
+    This function returns the cached (blocks, confidences) for an image, or None on a miss
+    """
+
+    try:
+        with _get_engine().begin() as connection:
+
+            # Try an exact match first
+            stmt = select(ocr_results).where(ocr_results.c.digest == digest)
+            row = connection.execute(stmt).fetchone()
+
+            # Then, if it's turned on, a near-duplicate
+            if row is None and PHASH_DISTANCE:
+                bands = _bands(phash)
+                stmt = select(ocr_results).where(or_(ocr_results.c.band0 == bands[0],
+                                                     ocr_results.c.band1 == bands[1],
+                                                     ocr_results.c.band2 == bands[2],
+                                                     ocr_results.c.band3 == bands[3]))
+                candidates = connection.execute(stmt).fetchall()
+                matches = [(bin((candidate.phash ^ _to_signed(phash)) & ((1 << 64) - 1)).count("1"), candidate)
+                           for candidate in candidates]
+                matches = [match for match in matches if match[0] <= PHASH_DISTANCE and _is_current(match[1])]
+                if matches:
+                    row = min(matches, key=lambda match: match[0])[1]
+
+            if row is None:
+                _bump(connection, "misses")
+                return None
+
+            # Mark the entry as recently used so it isn't evicted
+            connection.execute(update(ocr_results).where(ocr_results.c.digest == row.digest)
+                               .values(last_used=time.time()))
+            _bump(connection, "hits")
+
+            return json.loads(row.strings), json.loads(row.confidences)
+
+    # The cache is an optimization. If it's unavailable, just run the OCR
+    except SQLAlchemyError:
+        return None
+
+
+def store(digest, phash, blocks, confidences):
+    """
+    This function caches the OCR results for an image, evicting the least recently used
+    entries if the cache is full
+    """
+
+    bands = _bands(phash)
+    try:
+        with _get_engine().begin() as connection:
+            connection.execute(delete(ocr_results).where(ocr_results.c.digest == digest))
+            connection.execute(insert(ocr_results).values(digest=digest, phash=_to_signed(phash),
+                                                          band0=bands[0], band1=bands[1],
+                                                          band2=bands[2], band3=bands[3],
+                                                          strings=json.dumps(blocks),
+                                                          confidences=json.dumps(confidences),
+                                                          last_used=time.time()))
+
+            # Evict the least recently used entries beyond the size limit
+            count = connection.execute(select(func.count()).select_from(ocr_results)).scalar()
+            if count > CACHE_SIZE:
+                oldest = select(ocr_results.c.digest).order_by(ocr_results.c.last_used).limit(count - CACHE_SIZE)
+                connection.execute(delete(ocr_results).where(ocr_results.c.digest.in_(oldest)))
+    except SQLAlchemyError:
+        pass
+
+
+def stats():
+    """
+    This function returns the cache's hit and miss counters along with its current size
+    """
+
+    with _get_engine().connect() as connection:
+        counters = dict(connection.execute(select(cache_stats.c.name, cache_stats.c.value)).fetchall())
+        size = connection.execute(select(func.count()).select_from(ocr_results)).scalar()
+
+    return {"hits": counters.get("hits", 0), "misses": counters.get("misses", 0), "size": size}
+
+
+# Serve the counters at /metrics (see metrics.py). They're kept in the cache's database, so
+# they count the lookups of every worker process, not just this one
+register(Collector(stats, [
+    ("hits", "recipe_ocr_cache_hits_total", "counter", "OCR cache lookups that found the image"),
+    ("misses", "recipe_ocr_cache_misses_total", "counter", "OCR cache lookups that didn't"),
+    ("size", "recipe_ocr_cache_entries", "gauge", "Images in the OCR cache")]))
@@ -0,0 +1,224 @@
+# This module pulls recipes out of the html of recipe pages.
+#
+# Most recipe sites embed the recipe as schema.org JSON-LD for search engines, so we try
+# that first: the script block is found with a regular expression and read with json,
+# without building a DOM at all. Sites that don't (or whose JSON-LD is broken) fall back
+# to an adapter for their domain, which parses only the tags it needs (via SoupStrainer).
+#
+# To support a new site, write a function taking the html and returning
+# (title, ingredients, instructions) or None, and register it with @adapter("example.com").
+
+import html as htmllib
+import json
+import re
+from urllib.parse import urlsplit
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+from metrics import stage
+
+# Matches each JSON-LD script block in a page
+JSON_LD = re.compile(r"<script[^>]*type\s*=\s*[\"']?application/ld\+json[\"']?[^>]*>(.*?)</script\s*>",
+                     re.IGNORECASE | re.DOTALL)
+
+# Matches html tags, which some sites leave inside JSON-LD strings
+TAG = re.compile(r"<[^>]+>")
+
+# Domain -> adapter function
+ADAPTERS = {}
+
+
+def adapter(*domains):
+    """
+    This decorator registers a scraping function for the given domains
+    (subdomains included, e.g. "example.com" also covers "www.example.com")
+    """
+
+    def register(f):
+        for domain in domains:
+            ADAPTERS[domain] = f
+        return f
+    return register
+
+
+def find_adapter(url):
+    """
+    This function returns the adapter registered for a url's domain, or the default
+    adapter if there isn't one
+    """
+
+    host = (urlsplit(url or "").hostname or "").lower()
+
+    # Try the full host name, then each parent domain
+    parts = host.split(".")
+    for i in range(len(parts) - 1):
+        domain = ".".join(parts[i:])
+        if domain in ADAPTERS:
+            return ADAPTERS[domain]
+
+    return default_adapter
+
+
+@stage("parse")
+def scrape(html, url=None):
+    """
+    This function returns the (title, ingredients, instructions) of the recipe on a page,
+    or None if it can't find one
+    """
+
+    recipe = scrape_json_ld(html)
+    if recipe is None:
+        recipe = find_adapter(url)(html)
+
+    return recipe
+
+
+def _clean(text):
+    """
+    This function turns a JSON-LD string into plain text: unescaped, tag-free, whitespace collapsed
+    """
+
+    text = htmllib.unescape(TAG.sub(" ", text))
+    return " ".join(text.split())
+
+
+def _find_recipe(node):
+    """
+    This function walks a JSON-LD document and returns the first node of type Recipe
+    """
+
+    if isinstance(node, list):
+        for item in node:
+            recipe = _find_recipe(item)
+            if recipe is not None:
+                return recipe
+        return None
+
+    if not isinstance(node, dict):
+        return None
+
+    types = node.get("@type")
+    if not isinstance(types, list):
+        types = [types]
+    if "Recipe" in types:
+        return node
+
+    # Recipes are often nested in a @graph, or under mainEntity
+    for key in ("@graph", "mainEntity", "mainEntityOfPage"):
+        if key in node:
+            recipe = _find_recipe(node[key])
+            if recipe is not None:
+                return recipe
+
+    return None
+
+
+def _instruction_texts(node):
+    """
+    This function flattens schema.org recipeInstructions (a string, a list of strings,
+    HowToSteps or HowToSections of HowToSteps) into a list of steps
+    """
+
+    if isinstance(node, str):
+        # A single string usually holds one step per line
+        return [_clean(line) for line in node.splitlines() if _clean(line)]
+
+    if isinstance(node, list):
+        steps = []
+        for item in node:
+            steps.extend(_instruction_texts(item))
+        return steps
+
+    if isinstance(node, dict):
+        if "itemListElement" in node:
+            return _instruction_texts(node["itemListElement"])
+        text = node.get("text") or node.get("name")
+        if isinstance(text, str) and _clean(text):
+            return [_clean(text)]
+
+    return []
+
+
+def scrape_json_ld(html):
+    """
+    This function reads a recipe from the schema.org JSON-LD embedded in a page
+    """
+
+    for match in JSON_LD.finditer(html):
+        try:
+            document = json.loads(match.group(1), strict=False)
+        except ValueError:
+            continue
+
+        recipe = _find_recipe(document)
+        if recipe is None:
+            continue
+
+        title = recipe.get("name")
+        title = _clean(title) if isinstance(title, str) else ""
+
+        ingredients = recipe.get("recipeIngredient") or recipe.get("ingredients") or []
+        if isinstance(ingredients, str):
+            ingredients = [ingredients]
+        ingredients = [_clean(ingredient) for ingredient in ingredients if isinstance(ingredient, str)]
+        ingredients = [ingredient for ingredient in ingredients if ingredient]
+
+        instructions = _instruction_texts(recipe.get("recipeInstructions"))
+
+        if title and ingredients and instructions:
+            return title, ingredients, instructions
+
+    return None
+
+
+def html_to_string(recipe_part):
+    """
+    This function changes the html elements -- in a given list -- to clean strings
+    e.g. <li>List Item</li> --> "List Item"
+    """
+
+    # Elements with nested markup have no single .string, so fall back to their full text
+    for i in range(len(recipe_part)):
+        text = recipe_part[i].string or recipe_part[i].get_text()
+        recipe_part[i] = text.strip()
+    return [part for part in recipe_part if part]
+
+
+# The only tags the Purple Carrot adapter looks at, so the rest of the page (scripts,
+# styles, navigation and the like) is never built into a tree. The strainer goes by tag
+# name only, since bs4 4.13 and later don't show a strainer function the tag's attributes;
+# the adapter's selectors pick out the classes it wants
+PURPLE_CARROT_TAGS = ["h1", "ol", "div"]
+
+
+@adapter("purplecarrot.com")
+def purple_carrot_adapter(html):
+    """
+    This function scrapes a Purple Carrot recipe page
+    """
+
+    # Create an object containing the parts of the html Document Object Model (DOM) we need
+    soup = BeautifulSoup(html, "lxml", parse_only=SoupStrainer(PURPLE_CARROT_TAGS))
+
+    # Grab the recipe title from the DOM
+    title_tags = soup.select("h1.c-recipe-details-header__title")
+    if not title_tags or not title_tags[0].get_text(strip=True):
+        return None
+    recipe_title = title_tags[0].get_text(strip=True)
+
+    # Grab the ingredients list from the DOM
+    ingredients_data = html_to_string(soup.select("ol > li"))
+
+    # Grab the actual instructions from the DOM
+    instructions_body = html_to_string(soup.select("div.col-12 > p"))
+
+    # Check to make sure the last 3 'grabs' returned some value
+    if not recipe_title or not ingredients_data or not instructions_body:
+        return None
+
+    return recipe_title, ingredients_data, instructions_body
+
+
+# Sites we don't have an adapter for get the Purple Carrot selectors, which is what every
+# url was scraped with before adapters existed
+default_adapter = purple_carrot_adapter
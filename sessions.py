@@ -0,0 +1,124 @@
+# This module sets up where login sessions are kept. The session only holds the user id.
+#
+# RECIPE_SESSION_BACKEND picks the backend:
+#   cookie (the default) - the session lives in a signed cookie, so nothing is stored on the
+#                          server and any worker (or node) can read it
+#   redis                - the session lives in redis (RECIPE_SESSION_URL, needs the redis
+#                          package) via Flask-Session, so it can be revoked server side
+#
+# Either way sessions expire after RECIPE_SESSION_TTL seconds. They're signed with SECRET_KEY,
+# or else with a key generated once and kept in RECIPE_SECRET_KEY_FILE, so logins survive
+# restarts and every worker agrees on the key.
+#
+# To add a backend, write a function taking the flask app and configuring it, and register
+# it with @session_backend("name").
+
+import os
+import secrets
+from datetime import timedelta
+
+from flask_session import Session
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+SESSION_BACKEND = os.environ.get("RECIPE_SESSION_BACKEND", "cookie")
+SESSION_URL = os.environ.get("RECIPE_SESSION_URL", "redis://localhost:6379/0")
+
+# Seconds a session lasts
+SESSION_TTL = int(os.environ.get("RECIPE_SESSION_TTL", 7 * 24 * 60 * 60))
+
+# Where the generated signing key is kept when SECRET_KEY isn't set
+SECRET_KEY_FILE = os.environ.get("RECIPE_SECRET_KEY_FILE", ".secret_key")
+
+# Only send the cookie over https (turn this on wherever the app is served over https)
+COOKIE_SECURE = os.environ.get("RECIPE_SESSION_COOKIE_SECURE", "0") == "1"
+
+# Backend name -> function configuring an app to use it
+BACKENDS = {}
+
+
+def session_backend(name):
+    """
+    This decorator registers a function that configures a flask app for a session backend
+    """
+
+    def register(f):
+        BACKENDS[name] = f
+        return f
+    return register
+
+
+def load_secret_key():
+    """
+    This function returns the key sessions are signed with: SECRET_KEY if it's set, or else
+    the key in SECRET_KEY_FILE, which is generated the first time it's needed
+    """
+
+    key = os.environ.get("SECRET_KEY")
+    if key:
+        return key
+
+    if not os.path.exists(SECRET_KEY_FILE):
+        # Write the key to a file of our own, then link it into place. Linking fails if the
+        # file already exists, so when several workers start at once they all end up with
+        # the key of whichever got there first
+        temp_path = f"{SECRET_KEY_FILE}.{os.getpid()}"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(temp_path, SECRET_KEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+
+    with open(SECRET_KEY_FILE) as f:
+        return f.read().strip()
+
+
+@session_backend("cookie")
+def use_cookie_sessions(app):
+    """
+    This function keeps sessions in flask's signed cookies, which expire after SESSION_TTL
+    """
+
+    # Nothing to do: this is flask's own session interface
+
+
+@session_backend("redis")
+def use_redis_sessions(app):
+    """
+    This function keeps sessions in redis, where they expire after SESSION_TTL
+    """
+
+    if redis is None:
+        raise RuntimeError("RECIPE_SESSION_BACKEND is redis, but the redis package isn't installed")
+
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.Redis.from_url(SESSION_URL)
+    app.config["SESSION_KEY_PREFIX"] = "recipe:session:"
+    app.config["SESSION_USE_SIGNER"] = True
+    Session(app)
+
+
+def init_app(app):
+    """
+    This function configures a flask app's sessions
+    """
+
+    if SESSION_BACKEND not in BACKENDS:
+        raise RuntimeError(f"unknown RECIPE_SESSION_BACKEND: {SESSION_BACKEND} "
+                           f"(expected one of {', '.join(sorted(BACKENDS))})")
+
+    app.secret_key = load_secret_key()
+    app.config["SESSION_PERMANENT"] = False
+    app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(seconds=SESSION_TTL)
+    app.config["SESSION_COOKIE_HTTPONLY"] = True
+    app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+    app.config["SESSION_COOKIE_SECURE"] = COOKIE_SECURE
+
+    BACKENDS[SESSION_BACKEND](app)
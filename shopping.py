@@ -0,0 +1,48 @@
+# This module builds shopping lists: the ingredients of a group of recipes, with duplicates merged.
+#
+# The ingredients were parsed into quantity, unit and food when they were saved (see
+# ingredient_parser.py), so building a list is a single GROUP BY over those columns.
+
+from sqlalchemy import and_, func, select
+
+from db import get_db, ingredients, recipe_books
+from ingredient_parser import NOT_FOOD, format_amount
+
+# Most recipes that can go into one shopping list
+MAX_RECIPES = 100
+
+
+def build_shopping_list(title_ids, user_id):
+    """
+    This function returns the merged ingredients of the given recipes (those in the user's
+    library, anyway) as a list of (food, amounts) pairs, sorted by food. amounts is a list of
+    strings, since the same food can be bought in units that don't convert (e.g. "2 cans"
+    and "1 cup" of beans)
+    """
+
+    title_ids = list(title_ids)
+    if not title_ids:
+        return []
+
+    # One aggregation over the parsed columns, limited to recipes the user owns
+    owned = select(recipe_books.c.title_id).where(and_(recipe_books.c.user_id == user_id,
+                                                       recipe_books.c.title_id.in_(title_ids)))
+    stmt = (select(ingredients.c.food, ingredients.c.unit, func.sum(ingredients.c.quantity).label("quantity"))
+            .where(and_(ingredients.c.title_id.in_(owned), ingredients.c.food.is_not(None)))
+            .group_by(ingredients.c.food, ingredients.c.unit)
+            .order_by(ingredients.c.food, ingredients.c.unit))
+    rows = get_db().execute(stmt).fetchall()
+
+    shopping_list = []
+    for row in rows:
+        if row.food in NOT_FOOD:
+            continue
+
+        amount = format_amount(row.quantity, row.unit)
+        if shopping_list and shopping_list[-1][0] == row.food:
+            if amount:
+                shopping_list[-1][1].append(amount)
+        else:
+            shopping_list.append((row.food, [amount] if amount else []))
+
+    return shopping_list
@@ -0,0 +1,279 @@
+# This module turns the OCR of a recipe card into a recipe: a title, a list of ingredients
+# and a list of instructions.
+#
+# It works from the layout tesseract reports with each word (see ocr_region in buttress.py):
+# words are grouped into lines, each line keeping its height on the page. Each block of text
+# is classified by what its lines look like -- ingredient lines start with a quantity or a
+# unit, instructions are numbered steps or full sentences -- and the title is the tallest
+# line on the card. Nothing here touches the network or the image itself.
+
+import re
+
+from ingredient_parser import QUANTITY, UNIT, VULGAR_FRACTIONS
+
+# The number at the start of a numbered step, e.g. "1." "2)" "Step 3:"
+STEP_NUMBER = re.compile(r"^\s*(?:step\s*)?(\d{1,2})\s*[.):]\s+", re.IGNORECASE)
+
+# A bullet at the start of a line
+BULLET = re.compile(r"^\s*[•·*\-–]\s*")
+
+# Headings that say what a block holds
+HEADINGS = {"ingredients": "ingredients", "ingredient": "ingredients", "you will need": "ingredients",
+            "you'll need": "ingredients", "instructions": "instructions", "directions": "instructions",
+            "method": "instructions", "preparation": "instructions", "steps": "instructions"}
+
+# Lowest average word confidence (0-100) for a block to be used at all
+MIN_CONFIDENCE = 50
+
+# Share of a block's lines that must look like ingredients for it to be an ingredients list
+INGREDIENT_SHARE = 0.5
+
+# Average words per line above which an unnumbered block reads as prose, i.e. instructions
+PROSE_WORDS = 6
+
+
+def data_to_lines(data):
+    """
+    This function groups the word boxes returned by pytesseract.image_to_data into lines, in
+    reading order. Each line is a dictionary holding its text, its height in pixels (the
+    tallest word on it), its position, the paragraph it's in and its average word confidence
+    """
+
+    lines = []
+    current = None
+
+    for i in range(len(data["text"])):
+
+        # Only the word level entries carry text
+        word = data["text"][i].strip()
+        if data["level"][i] != 5 or not word:
+            continue
+
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        if current is None or current["key"] != key:
+            current = {"key": key, "words": [], "heights": [], "confs": [],
+                       "top": data["top"][i], "left": data["left"][i]}
+            lines.append(current)
+
+        current["words"].append(word)
+        current["heights"].append(data["height"][i])
+        current["confs"].append(max(float(data["conf"][i]), 0))
+        current["top"] = min(current["top"], data["top"][i])
+        current["left"] = min(current["left"], data["left"][i])
+
+    return [{"text": " ".join(line["words"]), "height": max(line["heights"]),
+             "top": line["top"], "left": line["left"], "par": list(line["key"][:2]),
+             "conf": sum(line["confs"]) / len(line["confs"])}
+            for line in lines]
+
+
+def block_confidence(lines):
+    """
+    This function returns the average word confidence of a block, weighting each line by its length
+    """
+
+    weights = [len(line["text"].split()) for line in lines]
+    if not sum(weights):
+        return 0
+    return sum(line["conf"] * weight for line, weight in zip(lines, weights)) / sum(weights)
+
+
+def _normalize(text):
+    """
+    This function reduces a line to lowercase words, for comparing against headings
+    """
+
+    return " ".join(re.findall(r"[a-z']+", text.lower()))
+
+
+def heading_kind(text):
+    """
+    This function returns what a heading line announces ("ingredients" or
+    "instructions"), or None if the line isn't a heading
+    """
+
+    return HEADINGS.get(_normalize(text))
+
+
+def starts_ingredient(text):
+    """
+    This function checks whether a line starts an ingredient: a quantity (that isn't a step
+    number), a unit or a bullet
+    """
+
+    if STEP_NUMBER.match(text):
+        return False
+    if BULLET.match(text):
+        return True
+
+    for fraction, plain in VULGAR_FRACTIONS.items():
+        text = text.replace(fraction, plain)
+    text = text.strip()
+
+    match = QUANTITY.match(text)
+    if match:
+        return True
+    return bool(UNIT.match(text)) and len(text.split()) > 1
+
+
+def classify_block(lines):
+    """
+    This function returns what a block of lines holds: "ingredients", "instructions" or "other"
+    """
+
+    texts = [line["text"] for line in lines if line["text"].strip()]
+    if not texts:
+        return "other"
+
+    # A heading settles it
+    kind = heading_kind(texts[0])
+    if kind:
+        return kind
+
+    # Lists of short lines that mostly start with a quantity or a unit
+    starts = sum(starts_ingredient(text) for text in texts)
+    if starts and starts >= INGREDIENT_SHARE * len(texts):
+        return "ingredients"
+
+    # Numbered steps, or paragraphs of full sentences
+    if any(STEP_NUMBER.match(text) for text in texts):
+        return "instructions"
+    words = sum(len(text.split()) for text in texts)
+    if words / len(texts) >= PROSE_WORDS and any(text.rstrip().endswith(".") for text in texts):
+        return "instructions"
+
+    return "other"
+
+
+def _join(previous, text):
+    """
+    This function continues a wrapped line, mending words hyphenated across the break
+    """
+
+    if previous.endswith("-") and text[:1].islower():
+        return previous[:-1] + text
+    return f"{previous} {text}"
+
+
+def split_ingredients(lines):
+    """
+    This function returns the ingredients in a block, one per entry. A line that doesn't
+    start an ingredient continues the one before it
+    """
+
+    ingredients = []
+    for line in lines:
+        text = line["text"].strip()
+        if not text or heading_kind(text):
+            continue
+
+        if ingredients and not starts_ingredient(text) and (text[:1].islower() or text[:1] in "(,"):
+            ingredients[-1] = _join(ingredients[-1], text)
+        else:
+            ingredients.append(BULLET.sub("", text))
+
+    return ingredients
+
+
+def split_steps(lines):
+    """
+    This function returns the instructions in a block, one step per entry. Numbered steps run
+    until the next number; without numbers, each paragraph is a step
+    """
+
+    steps = []
+    numbered = False
+    paragraph = None
+
+    for line in lines:
+        text = line["text"].strip()
+        if not text or heading_kind(text):
+            continue
+
+        match = STEP_NUMBER.match(text)
+        if match:
+            steps.append(text[match.end():])
+            numbered = True
+        elif steps and (numbered or line["par"] == paragraph):
+            steps[-1] = _join(steps[-1], text)
+        else:
+            steps.append(text)
+        paragraph = line["par"]
+
+    return steps
+
+
+def first_step_number(lines):
+    """
+    This function returns the number of the first step in a block of instructions, or None
+    if the block doesn't start with a numbered step
+    """
+
+    for line in lines:
+        text = line["text"].strip()
+        if text and not heading_kind(text):
+            match = STEP_NUMBER.match(text)
+            return int(match.group(1)) if match else None
+    return None
+
+
+def find_title(blocks):
+    """
+    This function finds the title of the recipe: the tallest line on the card, along with
+    the lines right after it in the same paragraph set in (nearly) the same size. Returns
+    the title and the (block, line) positions of the lines it's made of
+    """
+
+    best = None
+    for b, lines in enumerate(blocks):
+        for i, line in enumerate(lines):
+            text = line["text"].strip()
+            if len(re.findall(r"[A-Za-z]", text)) < 3 or heading_kind(text) or STEP_NUMBER.match(text):
+                continue
+            if best is None or line["height"] > blocks[best[0]][best[1]]["height"]:
+                best = (b, i)
+
+    if best is None:
+        return "", []
+
+    b, i = best
+    lines = blocks[b]
+    positions = [(b, i)]
+    for j in range(i + 1, len(lines)):
+        if lines[j]["par"] != lines[i]["par"] or lines[j]["height"] < 0.85 * lines[i]["height"]:
+            break
+        positions.append((b, j))
+
+    return " ".join(lines[j]["text"].strip() for _, j in positions), positions
+
+
+def structure_recipe(blocks):
+    """
+    This function turns the OCRed blocks of a recipe card (each a list of lines, as returned
+    by data_to_lines) into a dictionary holding its title, ingredients and instructions
+    """
+
+    blocks = [lines for lines in blocks if lines and block_confidence(lines) >= MIN_CONFIDENCE]
+
+    # The title's lines are taken out of their block, so they aren't read as an ingredient too
+    title, positions = find_title(blocks)
+    taken = set(positions)
+    blocks = [[line for i, line in enumerate(lines) if (b, i) not in taken] for b, lines in enumerate(blocks)]
+
+    ingredients = []
+    instruction_blocks = []
+    for lines in blocks:
+        kind = classify_block(lines)
+        if kind == "ingredients":
+            ingredients.extend(split_ingredients(lines))
+        elif kind == "instructions":
+            instruction_blocks.append(lines)
+
+    # Blocks of numbered steps are read in the order of their numbers, since the blocks
+    # aren't found in reading order
+    numbers = [first_step_number(lines) for lines in instruction_blocks]
+    if all(number is not None for number in numbers):
+        instruction_blocks = [lines for _, lines in sorted(zip(numbers, instruction_blocks), key=lambda pair: pair[0])]
+    instructions = [step for lines in instruction_blocks for step in split_steps(lines)]
+
+    return {"title": title, "ingredients": ingredients, "instructions": instructions}
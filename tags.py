@@ -0,0 +1,190 @@
+# This module organizes recipes with tags. Each user has their own tags, which they can
+# put on any recipe in their library.
+#
+# Tags live in the tags table, and which recipes carry them in recipe_tags (see migration 6).
+# recipe_tags repeats the user id, so filtering a library by tag and showing a page of
+# recipes with their tags are both answered from an index, however big the library gets.
+
+import re
+
+from sqlalchemy import and_, delete, exists, func, insert, select
+
+import cache
+from db import engine, get_db, recipe_books, recipe_tags, tags, titles
+
+# Longest tag name, and most tags put on (or taken off) recipes at once
+MAX_TAG_LENGTH = 40
+MAX_TAGS = 20
+
+# Number of ids sent to the database per query, to stay under its parameter limits
+CHUNK_SIZE = 500
+
+
+def clean_tags(names):
+    """
+    This function turns user input (a comma separated string, or a list of names) into a
+    list of tag names: lowercased, whitespace collapsed, de-duplicated, in the order given
+    """
+
+    if isinstance(names, str):
+        names = names.split(",")
+
+    cleaned = []
+    for name in names:
+        name = re.sub(r"\s+", " ", name if isinstance(name, str) else "").strip().lower()
+        name = name[:MAX_TAG_LENGTH]
+        if name and name not in cleaned:
+            cleaned.append(name)
+
+    return cleaned
+
+
+def get_tags(user_id):
+    """
+    This function returns all of a user's tags as rows (id, name), alphabetically
+    """
+
+    stmt = select(tags.c.id, tags.c.name).where(tags.c.user_id == user_id).order_by(tags.c.name)
+    return get_db().execute(stmt).fetchall()
+
+
+def find_tag_ids(user_id, names, conn=None):
+    """
+    This function returns a dictionary of the ids of the user's tags with the given names.
+    Names the user has no tag for are left out
+    """
+
+    names = list(names)
+    if not names:
+        return {}
+
+    conn = conn or get_db()
+    stmt = select(tags.c.name, tags.c.id).where(and_(tags.c.user_id == user_id, tags.c.name.in_(names)))
+    return {row.name: row.id for row in conn.execute(stmt)}
+
+
+def tag_filter(user_id, tag_ids, match_all=False):
+    """
+    This function returns a clause on titles.c.id selecting the user's recipes tagged with
+    any (or, if match_all, every one) of the given tags
+    """
+
+    tag_ids = list(tag_ids)
+    tagged = select(recipe_tags.c.title_id).where(and_(recipe_tags.c.user_id == user_id,
+                                                       recipe_tags.c.tag_id.in_(tag_ids)))
+    if match_all:
+        tagged = (tagged.group_by(recipe_tags.c.title_id)
+                  .having(func.count(recipe_tags.c.tag_id) == len(set(tag_ids))))
+
+    return titles.c.id.in_(tagged)
+
+
+def tags_for_titles(user_id, title_ids, conn=None):
+    """
+    This function returns the user's tags on each of the given recipes, as a dictionary
+    of title id -> list of tag names (alphabetical). Untagged recipes are left out
+    """
+
+    conn = conn or get_db()
+    title_ids = list(title_ids)
+    found = {}
+    for i in range(0, len(title_ids), CHUNK_SIZE):
+        stmt = (select(recipe_tags.c.title_id, tags.c.name)
+                .join(tags, tags.c.id == recipe_tags.c.tag_id)
+                .where(and_(recipe_tags.c.user_id == user_id,
+                            recipe_tags.c.title_id.in_(title_ids[i: i + CHUNK_SIZE])))
+                .order_by(recipe_tags.c.title_id, tags.c.name))
+        for row in conn.execute(stmt):
+            found.setdefault(row.title_id, []).append(row.name)
+
+    return found
+
+
+def _owned_titles(conn, user_id, title_ids):
+    """
+    This function returns the set of the given title ids that are in the user's library
+    """
+
+    title_ids = list(title_ids)
+    owned = set()
+    for i in range(0, len(title_ids), CHUNK_SIZE):
+        stmt = select(recipe_books.c.title_id).where(and_(recipe_books.c.user_id == user_id,
+                                                          recipe_books.c.title_id.in_(title_ids[i: i + CHUNK_SIZE])))
+        owned.update(conn.execute(stmt).scalars())
+
+    return owned
+
+
+def tag_titles(user_id, title_ids, names):
+    """
+    This function puts the named tags (creating any the user doesn't have yet) on each of
+    the given recipes in the user's library, all in one transaction. Returns the number of
+    tags added
+    """
+
+    names = clean_tags(names)[:MAX_TAGS]
+    if not names:
+        return 0
+
+    with engine.begin() as conn:
+        owned = sorted(_owned_titles(conn, user_id, title_ids))
+        if not owned:
+            return 0
+
+        # Create the tags the user doesn't have yet
+        tag_ids = find_tag_ids(user_id, names, conn)
+        missing = [name for name in names if name not in tag_ids]
+        if missing:
+            conn.execute(insert(tags), [{"user_id": user_id, "name": name} for name in missing])
+            tag_ids = find_tag_ids(user_id, names, conn)
+
+        # Leave out the recipes that already carry a tag, so nothing is inserted twice
+        added = 0
+        for tag_id in tag_ids.values():
+            for i in range(0, len(owned), CHUNK_SIZE):
+                chunk = owned[i: i + CHUNK_SIZE]
+                stmt = select(recipe_tags.c.title_id).where(and_(recipe_tags.c.tag_id == tag_id,
+                                                                 recipe_tags.c.title_id.in_(chunk)))
+                tagged = set(conn.execute(stmt).scalars())
+                rows = [{"tag_id": tag_id, "title_id": title_id, "user_id": user_id}
+                        for title_id in chunk if title_id not in tagged]
+                if rows:
+                    conn.execute(insert(recipe_tags), rows)
+                    added += len(rows)
+
+    # New tags show up in the user's recipe book (and its filters), so drop the cached pages
+    cache.invalidate_user(user_id)
+
+    return added
+
+
+def untag_titles(user_id, title_ids, names):
+    """
+    This function takes the named tags off each of the given recipes, all in one
+    transaction. Tags left on no recipe at all are deleted. Returns the number of tags removed
+    """
+
+    names = clean_tags(names)[:MAX_TAGS]
+    title_ids = list(title_ids)
+    if not names or not title_ids:
+        return 0
+
+    with engine.begin() as conn:
+        tag_ids = list(find_tag_ids(user_id, names, conn).values())
+        if not tag_ids:
+            return 0
+
+        removed = 0
+        for i in range(0, len(title_ids), CHUNK_SIZE):
+            stmt = delete(recipe_tags).where(and_(recipe_tags.c.user_id == user_id,
+                                                  recipe_tags.c.tag_id.in_(tag_ids),
+                                                  recipe_tags.c.title_id.in_(title_ids[i: i + CHUNK_SIZE])))
+            removed += conn.execute(stmt).rowcount
+
+        # Drop the tags that are no longer on anything, so they stop showing up as filters
+        in_use = exists().where(recipe_tags.c.tag_id == tags.c.id)
+        conn.execute(delete(tags).where(and_(tags.c.user_id == user_id, tags.c.id.in_(tag_ids), ~in_use)))
+
+    cache.invalidate_user(user_id)
+
+    return removed
@@ -0,0 +1,19 @@
+# Shared setup for the tests. Run them from the repository root with
+#
+#     python -m pytest
+#
+# Tests needing a package that isn't installed (e.g. sqlalchemy or bs4) are skipped.
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Importing db.py connects to (and migrates) DATABASE_URL, so point it, and everything
+# else the app keeps on disk, at a scratch directory rather than the real ones
+scratch = tempfile.mkdtemp(prefix="recipe-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(scratch, "recipe.db")
+os.environ["RECIPE_OCR_CACHE_URL"] = "sqlite:///" + os.path.join(scratch, "ocr_cache.db")
+os.environ["RECIPE_HTTP_CACHE_DIR"] = os.path.join(scratch, "http_cache")
+os.environ["SECRET_KEY"] = "test"
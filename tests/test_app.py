@@ -0,0 +1,165 @@
+# Tests for the routes in app.py, through flask's test client. Pages are "fetched" from
+# PAGES instead of the network, and parsed on threads instead of worker processes
+
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("bs4")
+pytest.importorskip("cv2")
+
+from sqlalchemy import insert  # noqa: E402
+
+import app as app_module  # noqa: E402
+import bulk_import  # noqa: E402
+from app import app  # noqa: E402
+from db import engine, users  # noqa: E402
+from fetch import FetchError  # noqa: E402
+
+
+def recipe_page(title, ingredients, instructions):
+    """
+    This function makes a page holding a recipe as JSON-LD
+    """
+
+    document = {"@type": "Recipe", "name": title, "recipeIngredient": ingredients,
+                "recipeInstructions": instructions}
+    return f'<script type="application/ld+json">{json.dumps(document)}</script>'
+
+
+PAGES = {
+    "https://a.example/bread": recipe_page("Banana Bread", ["3 ripe bananas", "2 cups flour"],
+                                           ["Mash the bananas with a fork.", "Stir in the flour and bake."]),
+    "https://a.example/soup": recipe_page("Lentil Soup", ["1 cup lentils", "1/0 cup stock"],
+                                          ["Simmer the lentils in the stock until soft."]),
+    "https://a.example/about": "<html><body><p>Nothing to see</p></body></html>",
+}
+
+
+def fetch(url):
+    if url not in PAGES:
+        raise FetchError("that page couldn't be found")
+    return PAGES[url]
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(bulk_import, "fetch", fetch)
+    monkeypatch.setattr(app_module, "fetch", fetch)
+    monkeypatch.setattr(bulk_import, "_get_parse_executor", lambda: executor)
+    yield
+    executor.shutdown()
+
+
+def client_for_new_user():
+    """
+    This function returns a test client logged in as a new user
+    """
+
+    with engine.begin() as conn:
+        user_id = conn.execute(insert(users).values(username=uuid.uuid4().hex, passhash="x")).inserted_primary_key[0]
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+    return client
+
+
+@pytest.fixture
+def client():
+    return client_for_new_user()
+
+
+def wait_for(client, poll):
+    """
+    This function polls a job until it's finished, and returns its status as JSON
+    """
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        job = client.get(poll).get_json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.02)
+    pytest.fail(f"{poll} never finished")
+
+
+def test_import_runs_as_a_job(client):
+    urls = ["https://a.example/bread", "https://a.example/soup", "https://a.example/about",
+            "https://a.example/missing", "not a url"]
+    response = client.post("/import", json={"urls": urls})
+    assert response.status_code == 202
+    job = wait_for(client, response.get_json()["poll"])
+
+    assert job["status"] == "done"
+    statuses = {result["url"]: result["status"] for result in job["results"]}
+    assert statuses == {"https://a.example/bread": "imported", "https://a.example/soup": "imported",
+                        "https://a.example/about": "error", "https://a.example/missing": "error",
+                        "not a url": "error"}
+
+    # The recipes are in the user's book
+    page = client.get("/recipebook").get_data(as_text=True)
+    assert "Banana Bread" in page and "Lentil Soup" in page
+
+    # Importing them again finds them already there
+    response = client.post("/import", json={"urls": urls[:1]})
+    job = wait_for(client, response.get_json()["poll"])
+    assert [result["status"] for result in job["results"]] == ["owned"]
+
+
+def test_the_same_recipe_from_another_url_is_linked(client, monkeypatch):
+    monkeypatch.setitem(PAGES, "https://copy.example/bread", PAGES["https://a.example/bread"])
+    fetched = []
+    monkeypatch.setattr(bulk_import, "fetch", lambda url: fetched.append(url) or fetch(url))
+
+    response = client.post("/import", json={"urls": ["https://a.example/bread"]})
+    original = wait_for(client, response.get_json()["poll"])["results"][0]
+
+    # The copy is the recipe already in the user's book
+    response = client.post("/import", json={"urls": ["https://copy.example/bread"]})
+    copy = wait_for(client, response.get_json()["poll"])["results"][0]
+    assert (copy["status"], copy["title_id"]) == ("owned", original["title_id"])
+
+    # Someone else gets the one stored copy, and the copy's url is known from now on
+    other = client_for_new_user()
+    for expected in ("linked", "owned"):
+        response = other.post("/import", json={"urls": ["https://copy.example/bread"]})
+        result = wait_for(other, response.get_json()["poll"])["results"][0]
+        assert (result["status"], result["title_id"]) == (expected, original["title_id"])
+    assert fetched.count("https://copy.example/bread") == 1
+
+
+def test_posting_a_copy_of_a_recipe_already_owned(client, monkeypatch):
+    monkeypatch.setitem(PAGES, "https://mirror.example/soup", PAGES["https://a.example/soup"])
+
+    assert client.post("/", data={"url": "https://a.example/soup"}).status_code == 302
+    page = client.post("/", data={"url": "https://mirror.example/soup"}).get_data(as_text=True)
+    assert "you already have that recipe in your library" in page
+
+
+def test_import_from_the_form(client):
+    response = client.post("/import", data={"urls": "https://a.example/bread\n"})
+    assert response.status_code == 302
+    poll = response.headers["Location"]
+    assert poll.startswith("/jobs/")
+
+    assert wait_for(client, f"{poll}?format=json")["status"] == "done"
+    assert "a.example/bread" in client.get(poll).get_data(as_text=True)
+
+
+def test_import_checks_what_it_is_sent(client):
+    assert client.post("/import", json={"urls": "https://a.example/bread"}).status_code == 400
+    assert client.post("/import", json={"urls": []}).status_code == 400
+    assert client.get("/jobs/nope?format=json").status_code == 404
+
+
+def test_import_needs_a_login():
+    response = app.test_client().post("/import", json={"urls": ["https://a.example/bread"]})
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/login")
@@ -0,0 +1,73 @@
+# Tests for app_model.py
+
+import base64
+import uuid
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy import insert  # noqa: E402
+
+from app_model import (decode_cursor, encode_cursor, find_titles_by_url,  # noqa: E402
+                       insert_recipes)
+from db import engine, users  # noqa: E402
+
+STEW = ("Bean Stew", ["Soften the onion in the oil.", "Add the beans and simmer for an hour."],
+        ["1 onion", "2 tbsp oil", "2 cans beans"])
+
+
+def new_user():
+    with engine.begin() as conn:
+        return conn.execute(insert(users).values(username=uuid.uuid4().hex, passhash="x")).inserted_primary_key[0]
+
+
+def test_insert_recipes_says_what_became_of_each_recipe():
+    first, second = new_user(), new_user()
+
+    [(title_id, status)] = insert_recipes([STEW + ("https://e.example/stew",)], first)
+    assert status == "imported"
+
+    # The same content under another url, in different case and spacing, is the same recipe
+    retyped = ("bean  stew", [line.upper() for line in STEW[1]], STEW[2], "https://f.example/stew")
+    assert insert_recipes([retyped], first) == [(title_id, "owned")]
+    assert insert_recipes([retyped, STEW + (None,)], second) == [(title_id, "linked"), (title_id, "linked")]
+    assert insert_recipes([STEW + (None,)], None) == [(title_id, "owned")]
+
+    # Both urls lead to it
+    with engine.connect() as conn:
+        assert find_titles_by_url(["https://e.example/stew", "https://f.example/stew", "https://g.example"], conn) == {
+            "https://e.example/stew": title_id, "https://f.example/stew": title_id}
+
+
+def test_insert_recipes_links_repeats_within_a_batch():
+    user_id = new_user()
+    soup = ("Pea Soup", ["Simmer the peas in the stock until soft."], ["2 cups peas", "1 quart stock"])
+
+    saved = insert_recipes([soup + ("https://h.example/soup",), soup + ("https://i.example/soup",)], user_id)
+    assert [status for title_id, status in saved] == ["imported", "linked"]
+    assert saved[0][0] == saved[1][0]
+    with engine.connect() as conn:
+        assert set(find_titles_by_url(["https://h.example/soup", "https://i.example/soup"], conn).values()) == {saved[0][0]}
+
+
+@pytest.mark.parametrize("title, title_id", [("Banana Bread", 12), ("Crème brûlée / \"best\"", 3), ("", 0)])
+def test_cursor_round_trip(title, title_id):
+    cursor = encode_cursor(title, title_id)
+    assert decode_cursor(cursor) == (title, title_id)
+
+    # It goes in a url as is
+    assert all(c.isalnum() or c in "-_=" for c in cursor)
+
+
+def _token(value):
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+@pytest.mark.parametrize("cursor", [
+    "", "not base64!", _token("not json"), _token('{"title": "x"}'), _token('["x"]'),
+    _token('["x", "12"]'), _token('[12, 12]'), _token('["x", 1, 2]'), None,
+])
+def test_decode_cursor_rejects_tampered_tokens(cursor):
+    assert decode_cursor(cursor) is None
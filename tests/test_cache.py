@@ -0,0 +1,57 @@
+import cache
+
+
+def counting(value):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return value
+
+    return compute, calls
+
+
+def test_pages_that_change_are_cached_without_a_shared_store(monkeypatch):
+    monkeypatch.setattr(cache, "_shared", None)
+    compute, calls = counting({"titles": []})
+
+    assert cache.get_or_set("user:101", "page", compute, changes=True) == {"titles": []}
+    assert cache.get_or_set("user:101", "page", compute, changes=True) == {"titles": []}
+    assert len(calls) == 1
+
+
+def test_invalidating_a_user_drops_their_pages(monkeypatch):
+    monkeypatch.setattr(cache, "_shared", None)
+    compute, calls = counting({"titles": []})
+
+    cache.get_or_set("user:102", "page", compute, changes=True)
+    cache.invalidate_user(102)
+    cache.get_or_set("user:102", "page", compute, changes=True)
+    cache.get_or_set("user:103", "page", compute, changes=True)
+    assert len(calls) == 3
+
+
+def test_pages_that_change_expire_sooner_without_a_shared_store(monkeypatch):
+    monkeypatch.setattr(cache, "_shared", None)
+    monkeypatch.setattr(cache, "CACHE_LOCAL_TTL", -1)
+    compute, calls = counting({"titles": []})
+
+    cache.get_or_set("user:104", "page", compute, changes=True)
+    cache.get_or_set("user:104", "page", compute, changes=True)
+    assert len(calls) == 2
+
+    # Values that never change keep the full TTL
+    cache.get_or_set("title:104", "page", compute)
+    cache.get_or_set("title:104", "page", compute)
+    assert len(calls) == 3
+
+
+def test_a_shared_store_is_used_across_processes(monkeypatch):
+    monkeypatch.setattr(cache, "_shared", cache.MemoryBackend())
+    compute, calls = counting({"titles": []})
+
+    cache.get_or_set("user:105", "page", compute, changes=True)
+    # Another process starts with an empty LRU of its own
+    monkeypatch.setattr(cache, "_local", cache.LRUCache(cache.CACHE_SIZE))
+    assert cache.get_or_set("user:105", "page", compute, changes=True) == {"titles": []}
+    assert len(calls) == 1
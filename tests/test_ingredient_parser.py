@@ -0,0 +1,102 @@
+# Tests for ingredient_parser.py
+
+import pytest
+
+from ingredient_parser import format_amount, format_quantity, normalize_food, parse_ingredient, singular
+
+
+def test_parses_the_header_example():
+    quantity, unit, food = parse_ingredient("1 1/2 cups shredded carrots, packed")
+    assert quantity == pytest.approx(354.882)
+    assert (unit, food) == ("ml", "carrot")
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("2 tbsp olive oil", (29.5736, "ml", "olive oil")),
+    ("½ tsp salt", (2.46446, "ml", "salt")),
+    ("1 fl oz lemon juice", (29.5735, "ml", "lemon juice")),
+    ("2 lbs potatoes", (907.184, "g", "potato")),
+    ("8 oz. cream cheese, softened", (226.796, "g", "cream cheese")),
+    (".5 kg flour", (500, "g", "flour")),
+])
+def test_converts_volumes_and_weights(line, expected):
+    quantity, unit, food = parse_ingredient(line)
+    assert quantity == pytest.approx(expected[0])
+    assert (unit, food) == expected[1:]
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("3 cloves garlic, minced", (3, "clove", "garlic")),
+    ("2 (15 oz) cans black beans, rinsed", (2, "can", "black bean")),
+    ("2 large eggs", (2, "", "egg")),
+    ("2-3 tomatoes", (3, "", "tomato")),
+    ("1 to 2 cups of berries", (473.176, "ml", "berry")),
+])
+def test_reads_counts_ranges_and_sizes(line, expected):
+    quantity, unit, food = parse_ingredient(line)
+    assert quantity == pytest.approx(expected[0])
+    assert (unit, food) == expected[1:]
+
+
+@pytest.mark.parametrize("line, food", [
+    ("1/0 cup flour", "cup flour"),
+    ("0/0 eggs", "egg"),
+    ("2 1/0 cups sugar", "cups sugar"),
+    ("1-1/00 cups milk", "cups milk"),
+])
+def test_a_fraction_over_zero_is_no_quantity(line, food):
+    # e.g. an OCR misreading of "1/2"
+    assert parse_ingredient(line) == (None, "", food)
+
+
+def test_a_zero_numerator_is_still_a_quantity():
+    assert parse_ingredient("0/2 cups water") == (0, "ml", "water")
+    assert parse_ingredient("1/10 cup oats")[0] == pytest.approx(23.6588)
+
+
+def test_a_line_without_a_quantity():
+    assert parse_ingredient("salt, to taste") == (None, "", "salt")
+    assert parse_ingredient("Freshly ground black pepper") == (None, "", "ground black pepper")
+
+
+@pytest.mark.parametrize("word, expected", [
+    ("berries", "berry"), ("tomatoes", "tomato"), ("onions", "onion"),
+    ("grass", "grass"), ("asparagus", "asparagus"), ("peas", "pea"),
+])
+def test_singular(word, expected):
+    assert singular(word) == expected
+
+
+def test_normalize_food_drops_notes_and_preparation():
+    assert normalize_food("Finely Chopped Red Onions (about 2), divided") == "red onion"
+    assert normalize_food("(optional)") == ""
+
+
+@pytest.mark.parametrize("quantity, expected", [
+    (1.5, "1 1/2"), (0.25, "1/4"), (2, "2"), (0.01, "0.01"),
+])
+def test_format_quantity(quantity, expected):
+    assert format_quantity(quantity) == expected
+
+
+@pytest.mark.parametrize("quantity, unit, expected", [
+    (44.3604, "ml", "3 tbsp"),
+    (473.176, "ml", "2 cups"),
+    (4.92892, "ml", "1 tsp"),
+    (907.184, "g", "2 lb"),
+    (113.398, "g", "4 oz"),
+    (3, "clove", "3 cloves"),
+    (2, "bunch", "2 bunches"),
+    (1, "can", "1 can"),
+    (2, "", "2"),
+    (None, "", ""),
+])
+def test_format_amount(quantity, unit, expected):
+    assert format_amount(quantity, unit) == expected
+
+
+def test_parsed_amounts_add_up_across_units():
+    # 2 tbsp in one recipe and 1/4 cup in another are 6 tbsp, i.e. 3/8 cup
+    first, unit, _ = parse_ingredient("2 tbsp olive oil")
+    second, _, _ = parse_ingredient("1/4 cup olive oil")
+    assert format_amount(first + second, unit) == "3/8 cup"
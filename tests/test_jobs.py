@@ -0,0 +1,142 @@
+# Tests for jobs.py. OCR jobs run on a thread here instead of in a worker process, so
+# parts of the pipeline can be swapped out
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("cv2")
+pytest.importorskip("pytesseract")
+
+from sqlalchemy import insert, select  # noqa: E402
+
+import jobs  # noqa: E402
+from db import engine, recipe_books, users  # noqa: E402
+
+RECIPE = {"title": "Banana Bread",
+          "ingredients": ["3 ripe bananas", "2 cups flour"],
+          "instructions": ["Mash the bananas with a fork.", "Stir in the flour and bake for an hour."]}
+
+
+@pytest.fixture
+def user_id():
+    with engine.begin() as conn:
+        return conn.execute(insert(users).values(username=uuid.uuid4().hex, passhash="x")).inserted_primary_key[0]
+
+
+@pytest.fixture(autouse=True)
+def executor(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(jobs, "_get_executor", lambda: executor)
+    yield executor
+    executor.shutdown()
+
+
+def wait_for(job_id, user_id):
+    """
+    This function polls a job until it's finished, and returns it
+    """
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        job = jobs.get_job(job_id, user_id)
+        if job["status"] not in jobs.UNFINISHED:
+            return job
+        time.sleep(0.02)
+    pytest.fail(f"job {job_id} never finished")
+
+
+def library(user_id):
+    with engine.connect() as conn:
+        return {row.title_id for row in conn.execute(select(recipe_books.c.title_id)
+                                                      .where(recipe_books.c.user_id == user_id))}
+
+
+def test_a_recipe_is_saved_when_its_job_finishes(monkeypatch, user_id):
+    monkeypatch.setattr(jobs, "run_pipeline", lambda data: RECIPE)
+
+    job = wait_for(jobs.submit_job(b"image", user_id), user_id)
+    assert job["status"] == "done"
+    assert library(user_id) == {job["result"]["title_id"]}
+
+
+def test_a_recipe_already_in_the_library_is_reported(monkeypatch, user_id):
+    recipe = {**RECIPE, "title": "Twice Read Bread"}
+    monkeypatch.setattr(jobs, "run_pipeline", lambda data: recipe)
+
+    first = wait_for(jobs.submit_job(b"image", user_id), user_id)
+    again = wait_for(jobs.submit_job(b"image", user_id), user_id)
+    assert first["result"]["status"] == "imported"
+    assert again["result"] == {"title_id": first["result"]["title_id"], "status": "owned"}
+
+
+def test_an_unreadable_image_fails(user_id):
+    job = wait_for(jobs.submit_job(b"not an image", user_id), user_id)
+    assert job["status"] == "failed"
+    assert job["error"].startswith("We couldn't read that image")
+    assert library(user_id) == set()
+
+
+def test_a_card_without_ingredients_fails(monkeypatch, user_id):
+    monkeypatch.setattr(jobs, "run_pipeline", lambda data: {**RECIPE, "ingredients": []})
+
+    job = wait_for(jobs.submit_job(b"image", user_id), user_id)
+    assert job["status"] == "failed"
+    assert job["error"].startswith("Highly uncertain")
+    assert library(user_id) == set()
+
+
+def test_a_misread_fraction_is_saved_without_a_quantity(monkeypatch, user_id):
+    recipe = {**RECIPE, "ingredients": ["1/0 cup flour", "2 1/0 cups sugar"]}
+    monkeypatch.setattr(jobs, "run_pipeline", lambda data: recipe)
+
+    job = wait_for(jobs.submit_job(b"image", user_id), user_id)
+    assert job["status"] == "done"
+    assert library(user_id) == {job["result"]["title_id"]}
+
+
+def test_an_error_saving_the_recipe_fails_the_job(monkeypatch, user_id):
+    def save_recipe(job_id, user_id, recipe_data):
+        raise ValueError("unexpected")
+
+    monkeypatch.setattr(jobs, "run_pipeline", lambda data: RECIPE)
+    monkeypatch.setattr(jobs, "save_recipe", save_recipe)
+
+    job = wait_for(jobs.submit_job(b"image", user_id), user_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "we couldn't save that recipe"
+
+
+def test_a_full_queue_turns_uploads_away(monkeypatch, executor, user_id):
+    release = threading.Event()
+    monkeypatch.setattr(jobs, "_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(jobs, "run_pipeline", lambda data: release.wait(5) and RECIPE)
+
+    first = jobs.submit_job(b"image", user_id)
+    assert jobs.submit_job(b"image", user_id) is None
+
+    # The slot is handed back once the first job is done (its callback runs on the one
+    # worker thread, so it's finished by the time the next task there is)
+    release.set()
+    executor.submit(lambda: None).result()
+    assert wait_for(first, user_id)["status"] == "done"
+    assert jobs.submit_job(b"image", user_id) is not None
+
+
+def test_a_lost_job_is_given_up_on(monkeypatch, user_id):
+    job_id = jobs.create_job(user_id, "ocr")
+    monkeypatch.setattr(jobs, "JOB_TIMEOUT", -1)
+
+    job = jobs.get_job(job_id, user_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "That took too long. Please try again."
+
+
+def test_jobs_are_private(user_id):
+    job_id = jobs.create_job(user_id, "ocr")
+    assert jobs.get_job(job_id, user_id + 1) is None
@@ -0,0 +1,158 @@
+# Tests for migrations.py, run against a SQLite file seeded the way a production database
+# would look before the migration under test
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy import create_engine, inspect, text  # noqa: E402
+from sqlalchemy.exc import IntegrityError  # noqa: E402
+
+import migrations  # noqa: E402
+from compact import content_hash, pack_recipe  # noqa: E402
+from ingredient_parser import parse_ingredient  # noqa: E402
+
+BREAD = (["3 ripe bananas", "2 cups flour"], ["Mash the bananas.", "Stir in the flour and bake."])
+
+# The same recipe, as written down by someone else
+BREAD_RETYPED = (["3 Ripe bananas", "2 cups  flour"], ["Mash the bananas. ", "Stir in the flour and bake."])
+
+PANCAKES = (["1 cup flour", "1 egg"], ["Whisk.", "Fry."])
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'recipe.db'}", future=True)
+    yield engine
+    engine.dispose()
+
+
+def migrate_to(engine, version, monkeypatch):
+    """
+    This function brings a database up to the given migration version only
+    """
+
+    with monkeypatch.context() as m:
+        m.setattr(migrations, "MIGRATIONS", [mig for mig in migrations.MIGRATIONS if mig[0] <= version])
+        migrations.migrate(engine)
+
+
+def add_recipe(conn, title_id, title, url, recipe, blob=True):
+    """
+    This function stores a recipe the way the app did as of migration 7: its rows, its
+    blob and its entry in the search index
+    """
+
+    ingredients_list, instructions_body = recipe
+    conn.execute(text("INSERT INTO titles (id, title, url) VALUES (:id, :title, :url)"),
+                 {"id": title_id, "title": title, "url": url})
+    conn.execute(text("INSERT INTO ingredients (title_id, ingredient, position, quantity, unit, food) "
+                      "VALUES (:title_id, :ingredient, :position, :quantity, :unit, :food)"),
+                 [dict(zip(("quantity", "unit", "food"), parse_ingredient(ingredient)),
+                       title_id=title_id, ingredient=ingredient, position=i)
+                  for i, ingredient in enumerate(ingredients_list)])
+    conn.execute(text("INSERT INTO instructions (title_id, instruction, position) "
+                      "VALUES (:title_id, :instruction, :position)"),
+                 [{"title_id": title_id, "instruction": instruction, "position": i}
+                  for i, instruction in enumerate(instructions_body)])
+    if blob:
+        conn.execute(text("INSERT INTO recipe_blobs (title_id, body) VALUES (:title_id, :body)"),
+                     {"title_id": title_id, "body": pack_recipe(ingredients_list, instructions_body)})
+    if migrations.has_fts5(conn):
+        conn.execute(text("INSERT INTO recipe_search (rowid, title, ingredients, instructions) "
+                          "VALUES (:id, :title, :ingredients, :instructions)"),
+                     {"id": title_id, "title": title, "ingredients": "\n".join(ingredients_list),
+                      "instructions": "\n".join(instructions_body)})
+
+
+def rows(conn, sql):
+    return {tuple(row) for row in conn.execute(text(sql))}
+
+
+def test_migrates_a_new_database_once(engine):
+    versions = [mig[0] for mig in migrations.MIGRATIONS]
+    assert migrations.migrate(engine) == versions
+    assert migrations.migrate(engine) == []
+    assert migrations.applied_versions(engine) == set(versions)
+
+
+def test_parses_existing_ingredients_even_misread_ones(engine, monkeypatch):
+    migrate_to(engine, 4, monkeypatch)
+
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO titles (id, title) VALUES (1, 'Scones')"))
+        conn.execute(text("INSERT INTO ingredients (title_id, ingredient, position) VALUES (1, :ingredient, :position)"),
+                     [{"ingredient": "2 cups flour", "position": 0}, {"ingredient": "1/0 cup sugar", "position": 1}])
+
+    migrate_to(engine, 5, monkeypatch)
+
+    with engine.connect() as conn:
+        parsed = sorted(rows(conn, "SELECT position, quantity, unit, food FROM ingredients"))
+    assert parsed == [(0, pytest.approx(473.176), "ml", "flour"), (1, None, "", "cup sugar")]
+
+
+def test_content_hashes_merge_duplicate_recipes(engine, tmp_path, monkeypatch):
+    migrate_to(engine, 7, monkeypatch)
+
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (id, username, passhash) VALUES (:id, :name, 'x')"),
+                     [{"id": 1, "name": "ana"}, {"id": 2, "name": "ben"}, {"id": 3, "name": "cy"}])
+
+        # Recipes 2 and 3 are copies of 1 (up to case and spacing), from other urls
+        add_recipe(conn, 1, "Banana Bread", "https://a.example/bread", BREAD)
+        add_recipe(conn, 2, "banana  bread", "https://b.example/bread", BREAD_RETYPED)
+        add_recipe(conn, 3, "Banana Bread", None, BREAD)
+        add_recipe(conn, 4, "Pancakes", None, PANCAKES)
+
+        # A recipe whose blob is missing is left as it is
+        add_recipe(conn, 5, "Banana Bread", None, BREAD, blob=False)
+
+        # ana has the original and a copy, ben and cy only a copy
+        conn.execute(text("INSERT INTO recipe_books (title_id, user_id) VALUES (:title_id, :user_id)"),
+                     [{"title_id": 1, "user_id": 1}, {"title_id": 2, "user_id": 1}, {"title_id": 4, "user_id": 1},
+                      {"title_id": 2, "user_id": 2}, {"title_id": 3, "user_id": 3}, {"title_id": 5, "user_id": 3}])
+
+        # ana tagged both of her copies "baking", and only the copy "breakfast"
+        conn.execute(text("INSERT INTO tags (id, user_id, name) VALUES (:id, :user_id, :name)"),
+                     [{"id": 10, "user_id": 1, "name": "baking"}, {"id": 11, "user_id": 1, "name": "breakfast"},
+                      {"id": 12, "user_id": 2, "name": "sweet"}])
+        conn.execute(text("INSERT INTO recipe_tags (tag_id, title_id, user_id) VALUES (:tag_id, :title_id, :user_id)"),
+                     [{"tag_id": 10, "title_id": 1, "user_id": 1}, {"tag_id": 10, "title_id": 2, "user_id": 1},
+                      {"tag_id": 11, "title_id": 2, "user_id": 1}, {"tag_id": 12, "title_id": 2, "user_id": 2}])
+
+    assert migrations.migrate(engine) == [8, 9]
+
+    # The database was saved before the upgrade
+    assert list(tmp_path.glob("recipe.db.bak-v7-*"))
+
+    with engine.connect() as conn:
+        # The copies are gone, and the oldest copy kept
+        assert rows(conn, "SELECT id, url, content_hash FROM titles") == {
+            (1, "https://a.example/bread", content_hash("Banana Bread", *BREAD)),
+            (4, None, content_hash("Pancakes", *PANCAKES)),
+            (5, None, None),
+        }
+        assert rows(conn, "SELECT position, ingredient FROM ingredients WHERE title_id = 1") == set(enumerate(BREAD[0]))
+        assert rows(conn, "SELECT position, instruction FROM instructions WHERE title_id = 1") == set(enumerate(BREAD[1]))
+
+        # The copies' urls still lead to the recipe
+        assert rows(conn, "SELECT url, title_id FROM title_urls") == {("https://b.example/bread", 1)}
+
+        # Everyone who had a copy has the original, once
+        assert rows(conn, "SELECT title_id, user_id FROM recipe_books") == {(1, 1), (4, 1), (1, 2), (1, 3), (5, 3)}
+
+        # And its tags, once
+        assert rows(conn, "SELECT tag_id, title_id, user_id FROM recipe_tags") == {(10, 1, 1), (11, 1, 1), (12, 1, 2)}
+
+        # Nothing is left pointing at a recipe that's gone
+        for table in ("ingredients", "instructions", "recipe_blobs", "recipe_books", "recipe_tags", "title_urls"):
+            assert not rows(conn, f"SELECT title_id FROM {table} WHERE title_id NOT IN (SELECT id FROM titles)"), table
+        if migrations.has_fts5(conn):
+            assert rows(conn, "SELECT rowid FROM recipe_search") == {(1,), (4,), (5,)}
+
+        assert "ux_titles_content_hash" in {index["name"] for index in inspect(conn).get_indexes("titles")}
+
+    # The same content can't be stored twice from now on
+    with pytest.raises(IntegrityError), engine.begin() as conn:
+        conn.execute(text("INSERT INTO titles (title, content_hash) VALUES ('Banana Bread', :digest)"),
+                     {"digest": content_hash("Banana Bread", *BREAD)})
@@ -0,0 +1,83 @@
+# Tests for scrapers.py
+
+import json
+
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("lxml")
+pytest.importorskip("flask")
+
+from scrapers import default_adapter, find_adapter, purple_carrot_adapter, scrape, scrape_json_ld  # noqa: E402
+
+
+def json_ld_page(document):
+    """
+    This function wraps a JSON-LD document in a page, as a recipe site would
+    """
+
+    return (f'<html><head><script type="application/ld+json">{json.dumps(document)}</script></head>'
+            f"<body><h1>Not the recipe</h1></body></html>")
+
+
+RECIPE = {"@type": "Recipe",
+          "name": "Lentil &amp; <b>Kale</b>  Soup",
+          "recipeIngredient": ["1 cup lentils", "  2 cups   kale ", ""],
+          "recipeInstructions": [
+              {"@type": "HowToSection", "name": "Soup",
+               "itemListElement": [{"@type": "HowToStep", "text": "Simmer the lentils."},
+                                   {"@type": "HowToStep", "text": "Stir in the kale."}]},
+              "Serve hot."]}
+
+
+def test_reads_json_ld():
+    assert scrape_json_ld(json_ld_page(RECIPE)) == (
+        "Lentil & Kale Soup", ["1 cup lentils", "2 cups kale"],
+        ["Simmer the lentils.", "Stir in the kale.", "Serve hot."])
+
+
+def test_finds_the_recipe_in_a_graph():
+    page = json_ld_page({"@context": "https://schema.org",
+                         "@graph": [{"@type": "WebPage"}, {**RECIPE, "@type": ["Recipe", "NewsArticle"]}]})
+    assert scrape_json_ld(page)[0] == "Lentil & Kale Soup"
+
+
+def test_splits_a_single_string_of_instructions():
+    page = json_ld_page({**RECIPE, "recipeInstructions": "Simmer the lentils.\n\nServe hot."})
+    assert scrape_json_ld(page)[2] == ["Simmer the lentils.", "Serve hot."]
+
+
+def test_skips_broken_or_incomplete_json_ld():
+    broken = '<script type="application/ld+json">{not json</script>'
+    assert scrape_json_ld(broken) is None
+    assert scrape_json_ld(json_ld_page({**RECIPE, "recipeIngredient": []})) is None
+    assert scrape_json_ld(broken + json_ld_page(RECIPE))[0] == "Lentil & Kale Soup"
+
+
+PURPLE_CARROT = """
+<html><body>
+  <h1 class="c-recipe-details-header__title"> Green Curry </h1>
+  <ol><li>1 can coconut milk</li><li> <span>2 tbsp</span> curry paste </li><li> </li></ol>
+  <div class="col-12 other"><p>Warm the milk.</p><p>Whisk in the <b>paste</b>.</p></div>
+  <div class="sidebar"><p>Not a step.</p></div>
+</body></html>
+"""
+
+
+def test_purple_carrot_adapter():
+    assert purple_carrot_adapter(PURPLE_CARROT) == (
+        "Green Curry", ["1 can coconut milk", "2 tbsp curry paste"],
+        ["Warm the milk.", "Whisk in the paste."])
+    assert purple_carrot_adapter("<html><body><ol><li>salt</li></ol></body></html>") is None
+
+
+def test_find_adapter_matches_subdomains():
+    assert find_adapter("https://www.purplecarrot.com/recipe/x") is purple_carrot_adapter
+    assert find_adapter("https://example.com/recipe") is default_adapter
+    assert find_adapter(None) is default_adapter
+
+
+def test_scrape_prefers_json_ld_and_falls_back_to_the_adapter():
+    assert scrape(json_ld_page(RECIPE) + PURPLE_CARROT, "https://www.purplecarrot.com/x")[0] == "Lentil & Kale Soup"
+    assert scrape(PURPLE_CARROT, "https://www.purplecarrot.com/x")[0] == "Green Curry"
+    assert scrape("<html></html>", "https://example.com") is None
@@ -0,0 +1,84 @@
+# Tests for structure.py
+
+from structure import (classify_block, data_to_lines, find_title, split_ingredients,
+                       split_steps, starts_ingredient, structure_recipe)
+
+
+def line(text, height=20, par=(1, 1), conf=90):
+    """
+    This function makes a line as data_to_lines returns it
+    """
+
+    return {"text": text, "height": height, "top": 0, "left": 0, "par": list(par), "conf": conf}
+
+
+def test_data_to_lines_groups_words_in_reading_order():
+    data = {"level": [4, 5, 5, 5, 5, 5],
+            "text": ["", "Tomato", "Soup", " ", "2", "cups"],
+            "block_num": [1, 1, 1, 1, 1, 1], "par_num": [1, 1, 1, 1, 2, 2],
+            "line_num": [1, 1, 1, 1, 1, 1],
+            "height": [0, 40, 38, 0, 12, 14], "top": [0, 10, 12, 0, 60, 58],
+            "left": [0, 5, 80, 0, 5, 20], "conf": ["-1", "90", "80", "-1", "70", "-1"]}
+
+    assert data_to_lines(data) == [
+        {"text": "Tomato Soup", "height": 40, "top": 10, "left": 5, "par": [1, 1], "conf": 85},
+        {"text": "2 cups", "height": 14, "top": 58, "left": 5, "par": [1, 2], "conf": 35},
+    ]
+
+
+def test_starts_ingredient():
+    assert starts_ingredient("2 cups flour")
+    assert starts_ingredient("½ tsp salt")
+    assert starts_ingredient("• salt")
+    assert starts_ingredient("cups of sugar")
+    assert not starts_ingredient("1. Preheat the oven.")
+    assert not starts_ingredient("Stir well")
+
+
+def test_classify_block():
+    assert classify_block([line("Directions"), line("Bake it.")]) == "instructions"
+    assert classify_block([line("2 cups flour"), line("1 tsp salt"), line("butter")]) == "ingredients"
+    assert classify_block([line("1. Mix."), line("2. Bake.")]) == "instructions"
+    assert classify_block([line("Preheat the oven and grease a loaf pan well.")]) == "instructions"
+    assert classify_block([line("Serves 4")]) == "other"
+    assert classify_block([]) == "other"
+
+
+def test_split_ingredients_joins_wrapped_lines():
+    lines = [line("Ingredients"), line("2 cups all-purpose"), line("flour, sifted"),
+             line("- 1 tsp baking soda"), line("(or powder)")]
+    assert split_ingredients(lines) == ["2 cups all-purpose flour, sifted", "1 tsp baking soda (or powder)"]
+
+
+def test_split_steps():
+    numbered = [line("1. Mix the dry ingre-"), line("dients."), line("2) Bake for 20 minutes.")]
+    assert split_steps(numbered) == ["Mix the dry ingredients.", "Bake for 20 minutes."]
+
+    paragraphs = [line("Mix everything", par=(1, 1)), line("together.", par=(1, 1)),
+                  line("Bake until golden.", par=(1, 2))]
+    assert split_steps(paragraphs) == ["Mix everything together.", "Bake until golden."]
+
+
+def test_find_title_takes_the_tallest_lines():
+    blocks = [[line("2 cups flour", height=12)],
+              [line("Grandma's Banana", height=40), line("Bread", height=38), line("Serves 8", height=14)]]
+    assert find_title(blocks) == ("Grandma's Banana Bread", [(1, 0), (1, 1)])
+    assert find_title([[line("1. Mix.", height=50)]]) == ("", [])
+
+
+def test_structure_recipe():
+    blocks = [
+        [line("3. Bake for 30 minutes.", par=(3, 1)), line("4. Let cool.", par=(3, 1))],
+        [line("Banana Bread", height=40, par=(1, 1)),
+         line("3 ripe bananas", par=(1, 2)), line("2 cups flour", par=(1, 2)), line("1 tsp baking soda", par=(1, 2))],
+        [line("1. Mash the bananas.", par=(2, 1)), line("2. Stir in the flour", par=(2, 1)),
+         line("and soda.", par=(2, 1))],
+        # Too uncertain to use
+        [line("4 cups glitter", conf=20)],
+    ]
+
+    assert structure_recipe(blocks) == {
+        "title": "Banana Bread",
+        "ingredients": ["3 ripe bananas", "2 cups flour", "1 tsp baking soda"],
+        "instructions": ["Mash the bananas.", "Stir in the flour and soda.", "Bake for 30 minutes.", "Let cool."],
+    }
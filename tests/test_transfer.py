@@ -0,0 +1,138 @@
+# Tests for transfer.py: a library exported at /export and uploaded at /import/file comes
+# back whole, tags and all
+
+import gzip
+import io
+import json
+import time
+import uuid
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("bs4")
+pytest.importorskip("cv2")
+
+from sqlalchemy import insert  # noqa: E402
+
+from app import app  # noqa: E402
+from app_model import insert_recipes  # noqa: E402
+from db import engine, users  # noqa: E402
+from tags import tag_titles  # noqa: E402
+from transfer import TransferError, import_records, read_records  # noqa: E402
+
+RECIPES = [
+    ("Oat Pancakes", ["Whisk the oats, egg and milk together.", "Fry spoonfuls until golden."],
+     ["1 cup oats", "1 egg", "1 cup milk"], "https://b.example/pancakes"),
+    ("Tomato Salad", ["Slice the tomatoes and dress them with the oil."],
+     ["4 tomatoes", "2 tbsp olive oil"], None),
+]
+
+
+def new_user():
+    with engine.begin() as conn:
+        return conn.execute(insert(users).values(username=uuid.uuid4().hex, passhash="x")).inserted_primary_key[0]
+
+
+def client_for(user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+    return client
+
+
+def records(export):
+    """
+    This function reads the recipes in an export, leaving out the header
+    """
+
+    return list(read_records(io.BytesIO(export)))
+
+
+def export(client):
+    response = client.get("/export")
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"].startswith("attachment")
+    return response.get_data()
+
+
+def upload(client, data):
+    """
+    This function uploads an export at /import/file and returns the finished job, as JSON
+    """
+
+    response = client.post("/import/file", data={"file": (io.BytesIO(data), "recipes.ndjson.gz")},
+                           content_type="multipart/form-data")
+    assert response.status_code == 302
+    poll = response.headers["Location"] + "?format=json"
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        job = client.get(poll).get_json()
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.02)
+    pytest.fail(f"{poll} never finished")
+
+
+def test_a_library_survives_a_round_trip():
+    owner = new_user()
+    title_ids = [title_id for title_id, status in insert_recipes(RECIPES, owner)]
+    tag_titles(owner, title_ids, ["quick"])
+    tag_titles(owner, title_ids[:1], ["breakfast"])
+    exported = export(client_for(owner))
+
+    assert [(record["title"], record["tags"]) for record in records(exported)] == [
+        ("Oat Pancakes", ["breakfast", "quick"]), ("Tomato Salad", ["quick"])]
+
+    # Someone else imports it: the recipes are already stored, so they're linked
+    reader = client_for(new_user())
+    job = upload(reader, exported)
+    assert job["status"] == "done"
+    assert job["summary"] == {"imported": 0, "linked": 2, "existing": 0, "duplicates": 0, "skipped": 0}
+
+    # And their own export holds the same recipes, with the same tags
+    assert [(r["title"], r["ingredients"], r["instructions"], r["hash"], r["tags"])
+            for r in records(export(reader))] == \
+        [(r["title"], r["ingredients"], r["instructions"], r["hash"], r["tags"]) for r in records(exported)]
+
+    # Importing it a second time changes nothing
+    assert upload(reader, exported)["summary"] == {"imported": 0, "linked": 0, "existing": 2,
+                                                   "duplicates": 0, "skipped": 0}
+
+
+def test_new_recipes_in_an_upload_are_stored_without_their_urls():
+    lines = [{"format": "recipe-export", "version": 1},
+             {"title": "Plum Jam", "url": "https://c.example/jam", "ingredients": ["2 lb plums", "1 lb sugar"],
+              "instructions": ["Boil the plums and sugar until thick."], "tags": ["preserves"]},
+             {"title": "Plum Jam", "url": None, "ingredients": ["2 lb plums", "1 lb sugar"],
+              "instructions": ["Boil the plums and sugar until thick."]},
+             {"title": "", "ingredients": [], "instructions": []}]
+    data = gzip.compress(b"".join(json.dumps(line).encode() + b"\n" for line in lines))
+
+    client = client_for(new_user())
+    job = upload(client, data)
+    assert job["summary"] == {"imported": 1, "linked": 0, "existing": 0, "duplicates": 1, "skipped": 1}
+    assert [(r["title"], r["url"], r["tags"]) for r in records(export(client))] == [("Plum Jam", None, ["preserves"])]
+
+
+def test_a_broken_upload_fails_its_job():
+    client = client_for(new_user())
+    exported = export(client)
+
+    job = upload(client, b"title,ingredients\n")
+    assert job == {"status": "failed", "error": "that isn't a recipe export"}
+
+    job = upload(client, exported[:-8] + b"\x00" * 8)
+    assert job["status"] == "failed"
+
+
+def test_import_records_from_the_command_line_keeps_urls():
+    data = gzip.compress(b'{"format": "recipe-export", "version": 1}\n'
+                         b'{"title": "Fig Tart", "url": "https://d.example/tart", "ingredients": ["6 figs"], '
+                         b'"instructions": ["Bake the figs on the pastry for 30 minutes."]}\n')
+    assert import_records(io.BytesIO(data), trust_urls=True)["imported"] == 1
+
+    with pytest.raises(TransferError):
+        import_records(io.BytesIO(b'{"format": "recipe-export", "version": 99}\n'))
@@ -0,0 +1,361 @@
+# This module moves recipes in and out of the app in bulk, e.g. to back up a library, or
+# to copy the whole corpus to another node.
+#
+# The format is gzipped NDJSON: a header line, then one line per recipe holding its title,
+# url, ingredients, instructions, content hash and (for a user's library) tags. Exports are
+# streamed straight from a server-side cursor and compressed as they go, and imports are
+# read a line at a time and written in batches, so neither holds more than a batch of
+# recipes in memory, however big the file.
+#
+# Imports skip what's already there: a recipe whose url or content hash matches one already
+# stored is just added to the user's library.
+#
+# An uploaded file can claim any url for any content, and a url in the database is trusted
+# by every later import of it (see index in app.py), so files uploaded at /import/file are
+# matched by content alone and their recipes are stored without urls. Only imports from the
+# command line, whose files the operator vouches for, keep the urls.
+#
+# Users export their library at /export, and import a file at /import/file. The users named
+# in RECIPE_ADMIN_USERS can also export every recipe at /export/all. From the command line:
+#
+#     python transfer.py export [--user NAME] [-o recipes.ndjson.gz]
+#     python transfer.py import recipes.ndjson.gz [--user NAME]
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+
+from sqlalchemy import and_, select
+from sqlalchemy.exc import IntegrityError
+
+import cache
+from app_model import (clean_ingredients, clean_instructions,
+                       find_titles_by_url, insert_recipes, link_titles)
+from compact import content_hash, unpack_recipe
+from db import (engine, ingredients, instructions, recipe_blobs, recipe_books,
+                titles, users)
+from tags import clean_tags, tag_titles, tags_for_titles
+
+FORMAT = "recipe-export"
+FORMAT_VERSION = 1
+
+# Recipes read from the database, or written to it, at a time
+BATCH_SIZE = int(os.environ.get("RECIPE_TRANSFER_BATCH_SIZE", 500))
+
+# Usernames allowed to export every recipe in the database
+ADMIN_USERS = {name.strip() for name in os.environ.get("RECIPE_ADMIN_USERS", "").split(",") if name.strip()}
+
+# Longest line accepted in an import, so a corrupt file can't make us read gigabytes at once
+MAX_LINE_LENGTH = 4 * 1024 * 1024
+
+
+class TransferError(Exception):
+    """
+    Raised when a file isn't a recipe export. The message is fit to show the user
+    """
+
+
+def is_admin(user_id):
+    """
+    This function checks whether a user may export every recipe in the database
+    """
+
+    if not ADMIN_USERS:
+        return False
+    with engine.connect() as conn:
+        username = conn.execute(select(users.c.username).where(users.c.id == user_id)).scalar()
+    return username in ADMIN_USERS
+
+
+def _lines_from_rows(conn, title_id):
+    """
+    This function reads a recipe's ingredients and instructions from their rows, for a
+    recipe without a blob
+    """
+
+    ingredients_list = conn.execute(select(ingredients.c.ingredient)
+                                    .where(ingredients.c.title_id == title_id)
+                                    .order_by(ingredients.c.position)).scalars().all()
+    instructions_body = conn.execute(select(instructions.c.instruction)
+                                     .where(instructions.c.title_id == title_id)
+                                     .order_by(instructions.c.position)).scalars().all()
+    return ingredients_list, instructions_body
+
+
+def iter_recipes(conn, user_id=None):
+    """
+    This function yields the recipes in a user's library (or, if user_id is None, every
+    recipe in the database) as dictionaries, in the order they were stored. Rows are read
+    from a server-side cursor, BATCH_SIZE at a time
+    """
+
+    stmt = select(titles.c.id, titles.c.title, titles.c.url, recipe_blobs.c.body).select_from(titles)
+    if user_id is not None:
+        stmt = stmt.join(recipe_books, and_(recipe_books.c.title_id == titles.c.id,
+                                            recipe_books.c.user_id == user_id))
+    stmt = stmt.outerjoin(recipe_blobs, recipe_blobs.c.title_id == titles.c.id).order_by(titles.c.id)
+
+    result = conn.execute(stmt.execution_options(stream_results=True, yield_per=BATCH_SIZE))
+    for rows in result.partitions():
+        title_tags = tags_for_titles(user_id, [row.id for row in rows], conn) if user_id is not None else {}
+
+        for row in rows:
+            if row.body is not None:
+                ingredients_list, instructions_body = unpack_recipe(row.body)
+            else:
+                ingredients_list, instructions_body = _lines_from_rows(conn, row.id)
+
+            recipe = {"title": row.title, "url": row.url, "ingredients": ingredients_list,
+                      "instructions": instructions_body,
+                      "hash": content_hash(row.title, ingredients_list, instructions_body)}
+            if user_id is not None:
+                recipe["tags"] = title_tags.get(row.id, [])
+            yield recipe
+
+
+def export_stream(user_id=None):
+    """
+    This function yields a gzipped NDJSON export of a user's library (or, if user_id is
+    None, of every recipe), a chunk at a time
+    """
+
+    header = {"format": FORMAT, "version": FORMAT_VERSION, "exported_at": int(time.time()),
+              "scope": "library" if user_id is not None else "all"}
+
+    # wbits=31 makes zlib write a gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    with engine.connect() as conn:
+        chunk = compressor.compress(_dump(header))
+        for recipe in iter_recipes(conn, user_id):
+            chunk += compressor.compress(_dump(recipe))
+            if chunk:
+                yield chunk
+                chunk = b""
+        yield chunk + compressor.flush()
+
+
+def _dump(record):
+    """
+    This function encodes a record as one line of NDJSON
+    """
+
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def read_records(fileobj):
+    """
+    This function yields the records in an export (gzipped or not), after checking its header
+    """
+
+    head = fileobj.read(2)
+    fileobj.seek(0)
+    stream = gzip.GzipFile(fileobj=fileobj) if head == b"\x1f\x8b" else fileobj
+
+    try:
+        header = json.loads(stream.readline(MAX_LINE_LENGTH) or b"null")
+    except (OSError, EOFError, zlib.error, ValueError):
+        raise TransferError("that isn't a recipe export")
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        raise TransferError("that isn't a recipe export")
+    if not isinstance(header.get("version"), int) or header["version"] > FORMAT_VERSION:
+        raise TransferError("that export was made by a newer version of the app")
+
+    while True:
+        try:
+            line = stream.readline(MAX_LINE_LENGTH)
+        except (OSError, EOFError, zlib.error):
+            raise TransferError("that export is corrupt or cut short")
+        if not line:
+            return
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def clean_record(record):
+    """
+    This function checks an imported record, returning the (title, instructions_body,
+    ingredients_list, url) tuple insert_recipes takes and its tags, or None if it isn't a recipe
+    """
+
+    if not isinstance(record, dict):
+        return None
+
+    title = record.get("title")
+    url = record.get("url")
+    ingredients_list = record.get("ingredients")
+    instructions_body = record.get("instructions")
+    if not isinstance(title, str) or not title.strip() or not (url is None or isinstance(url, str)):
+        return None
+    if not isinstance(ingredients_list, list) or not all(isinstance(line, str) for line in ingredients_list):
+        return None
+    if not isinstance(instructions_body, list) or not all(isinstance(line, str) for line in instructions_body):
+        return None
+
+    tags = record.get("tags")
+    tags = clean_tags(tags) if isinstance(tags, list) and all(isinstance(tag, str) for tag in tags) else []
+
+    recipe = (title.strip(), clean_instructions(instructions_body), clean_ingredients(ingredients_list), url or None)
+    return recipe, tags
+
+
+def _write_batch(batch, user_id, summary):
+    """
+    This function writes a batch of cleaned records in one transaction, linking the ones
+    already stored instead. Returns the title id of each record, in order
+    """
+
+    # Records repeating an earlier one in the batch (by url or content) share its title
+    by_url = {}
+    by_hash = {}
+    leaders = []
+    for i, (recipe, tags) in enumerate(batch):
+        title, instructions_body, ingredients_list, url = recipe
+        digest = content_hash(title, ingredients_list, instructions_body)
+        leader = by_url.get(url) if url else None
+        if leader is None:
+            leader = by_hash.get(digest, i)
+        if url:
+            by_url.setdefault(url, leader)
+        by_hash.setdefault(digest, leader)
+        leaders.append(leader)
+
+    firsts = sorted(set(leaders))
+    with engine.begin() as conn:
+        # Recipes already stored under the same url are linked
+        stored_urls = find_titles_by_url([batch[i][0][3] for i in firsts if batch[i][0][3]], conn)
+        title_ids = {i: stored_urls[batch[i][0][3]] for i in firsts if batch[i][0][3] in stored_urls}
+
+        # The rest go to insert_recipes, which stores them, or links the copy stored already
+        # if the content is (keeping the url as another url of that copy)
+        new = [i for i in firsts if i not in title_ids]
+        saved = dict(zip(new, insert_recipes([batch[i][0] for i in new], user_id, conn)))
+        title_ids.update((i, title_id) for i, (title_id, status) in saved.items())
+
+        added = set()
+        if user_id is not None:
+            added = link_titles([title_ids[i] for i in firsts if i not in new], user_id, conn)
+
+    statuses = [status for title_id, status in saved.values()]
+    summary["imported"] += statuses.count("imported")
+    summary["linked"] += len(added) + statuses.count("linked")
+    summary["existing"] += len(firsts) - len(new) - len(added) + statuses.count("owned")
+    summary["duplicates"] += len(batch) - len(firsts)
+
+    # Only once the batch is committed, drop what's cached about it
+    if user_id is not None:
+        cache.invalidate_user(user_id)
+    for title_id, status in saved.values():
+        if status == "imported":
+            cache.invalidate_recipe(title_id)
+
+    return [title_ids[leader] for leader in leaders]
+
+
+def import_records(fileobj, user_id=None, trust_urls=False):
+    """
+    This function imports an export into a user's library (or, if user_id is None, into the
+    database without adding it to any library), a batch per transaction. Returns counts of
+    the recipes imported, linked into the library, already in it, repeated within the file,
+    and skipped as invalid.
+
+    Unless trust_urls is set, the file's urls are dropped, so recipes are only matched to
+    stored ones by content and none is stored under a url
+    """
+
+    summary = {"imported": 0, "linked": 0, "existing": 0, "duplicates": 0, "skipped": 0}
+
+    batch = []
+    for record in read_records(fileobj):
+        cleaned = clean_record(record)
+        if cleaned is None:
+            summary["skipped"] += 1
+            continue
+        if not trust_urls:
+            recipe, tags = cleaned
+            cleaned = recipe[:3] + (None,), tags
+        batch.append(cleaned)
+        if len(batch) >= BATCH_SIZE:
+            _import_batch(batch, user_id, summary)
+            batch = []
+    if batch:
+        _import_batch(batch, user_id, summary)
+
+    return summary
+
+
+def _import_batch(batch, user_id, summary):
+    """
+    This function writes a batch of records and puts their tags back on them. If another
+    import stored one of the urls in the meantime, the batch is simply tried again, and
+    that recipe linked
+    """
+
+    try:
+        title_ids = _write_batch(batch, user_id, summary)
+    except IntegrityError:
+        title_ids = _write_batch(batch, user_id, summary)
+
+    if user_id is None:
+        return
+
+    # Put the tags back, a transaction per tag
+    tagged = {}
+    for (recipe, tags), title_id in zip(batch, title_ids):
+        for tag in tags:
+            tagged.setdefault(tag, set()).add(title_id)
+    for tag, tag_title_ids in tagged.items():
+        tag_titles(user_id, tag_title_ids, [tag])
+
+
+def _find_user(username):
+    """
+    This function returns the id of the user with a username, or exits if there isn't one
+    """
+
+    with engine.connect() as conn:
+        user_id = conn.execute(select(users.c.id).where(users.c.username == username)).scalar()
+    if user_id is None:
+        sys.exit(f"no user named {username}")
+    return user_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import recipes as gzipped NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="export a user's library, or every recipe")
+    export_parser.add_argument("--user", help="export this user's library (default: every recipe)")
+    export_parser.add_argument("-o", "--output", default="recipes.ndjson.gz", help="file to write")
+
+    import_parser = commands.add_parser("import", help="import an export")
+    import_parser.add_argument("file", help="export to read")
+    import_parser.add_argument("--user", help="add the recipes to this user's library")
+
+    args = parser.parse_args()
+    user_id = _find_user(args.user) if args.user else None
+
+    if args.command == "export":
+        with open(args.output, "wb") as f:
+            for chunk in export_stream(user_id):
+                f.write(chunk)
+        print(f"wrote {args.output}")
+    else:
+        with open(args.file, "rb") as f:
+            try:
+                summary = import_records(f, user_id, trust_urls=True)
+            except TransferError as e:
+                sys.exit(str(e))
+        print(", ".join(f"{count} {name}" for name, count in summary.items()))
+
+
+if __name__ == "__main__":
+    main()